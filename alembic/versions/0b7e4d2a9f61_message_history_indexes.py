@@ -0,0 +1,30 @@
+"""Indexes for paging through message history
+
+Revision ID: 0b7e4d2a9f61
+Revises: 6c1e3a5f7b92
+Create Date: 2026-10-18 19:02:41.518207
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0b7e4d2a9f61'
+down_revision: Union[str, None] = '6c1e3a5f7b92'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_messages_sender_id_created_at', 'messages', ['sender_id', 'created_at'], unique=False)
+    op.create_index('ix_messages_recipient_id_created_at', 'messages', ['recipient_id', 'created_at'], unique=False)
+    op.create_index('ix_messages_recipient_type_id_recipient_id_created_at', 'messages',
+                    ['recipient_type_id', 'recipient_id', 'created_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_messages_recipient_type_id_recipient_id_created_at', table_name='messages')
+    op.drop_index('ix_messages_recipient_id_created_at', table_name='messages')
+    op.drop_index('ix_messages_sender_id_created_at', table_name='messages')
@@ -0,0 +1,41 @@
+"""Content addressed media with reference counts
+
+Revision ID: 2f8d4b6a9c13
+Revises: e7b2c9d4a150
+Create Date: 2026-10-18 17:02:44.518093
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '2f8d4b6a9c13'
+down_revision: Union[str, None] = 'e7b2c9d4a150'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('media', sa.Column('sha256', sa.String(length=64), nullable=True))
+    op.add_column('media', sa.Column('size', sa.Integer(), nullable=True))
+    op.add_column('media', sa.Column('ref_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('media', sa.Column('orphaned_at', sa.DateTime(), nullable=True))
+    op.add_column('media', sa.Column('created_at', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_media_sha256'), 'media', ['sha256'], unique=True)
+    op.create_index(op.f('ix_media_url'), 'media', ['url'], unique=False)
+    op.create_index(op.f('ix_media_orphaned_at'), 'media', ['orphaned_at'], unique=False)
+    # existing uploads/<filename> images stay where they are, only new uploads are content addressed
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_media_orphaned_at'), table_name='media')
+    op.drop_index(op.f('ix_media_url'), table_name='media')
+    op.drop_index(op.f('ix_media_sha256'), table_name='media')
+    op.drop_column('media', 'created_at')
+    op.drop_column('media', 'orphaned_at')
+    op.drop_column('media', 'ref_count')
+    op.drop_column('media', 'size')
+    op.drop_column('media', 'sha256')
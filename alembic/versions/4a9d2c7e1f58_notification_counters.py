@@ -0,0 +1,38 @@
+"""Unread notification counters and the per user notifications index
+
+Revision ID: 4a9d2c7e1f58
+Revises: 8e3f1a6c2d47
+Create Date: 2026-10-18 21:05:37.118204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4a9d2c7e1f58'
+down_revision: Union[str, None] = '8e3f1a6c2d47'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_notifications_user_id_notification_id', 'notifications', ['user_id', 'notification_id'], unique=False)
+    op.create_table(
+        'notification_counters',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('unread_count', sa.Integer(), server_default='0', nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.user_id']),
+        sa.PrimaryKeyConstraint('user_id'),
+    )
+    op.execute("""
+        INSERT INTO notification_counters (user_id, unread_count)
+        SELECT user_id, COUNT(*) FROM notifications WHERE is_read = false GROUP BY user_id
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table('notification_counters')
+    op.drop_index('ix_notifications_user_id_notification_id', table_name='notifications')
@@ -0,0 +1,28 @@
+"""Listing keyset pagination indexes
+
+Revision ID: 5d0e8f3a7c21
+Revises: c41d7a9e2b10
+Create Date: 2026-10-18 11:20:37.904512
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d0e8f3a7c21'
+down_revision: Union[str, None] = 'c41d7a9e2b10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_listings_created_listing_id', 'listings', ['created', 'listing_id'], unique=False)
+    op.create_index('ix_listings_price_listing_id', 'listings', ['price', 'listing_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_listings_price_listing_id', table_name='listings')
+    op.drop_index('ix_listings_created_listing_id', table_name='listings')
@@ -0,0 +1,27 @@
+"""Rendered image variants on media
+
+Revision ID: 6c1e3a5f7b92
+Revises: 2f8d4b6a9c13
+Create Date: 2026-10-18 18:11:27.904416
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '6c1e3a5f7b92'
+down_revision: Union[str, None] = '2f8d4b6a9c13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('media', sa.Column('variants', sa.JSON(), nullable=True))
+    # rendered by `python -m service.images backfill`
+
+
+def downgrade() -> None:
+    op.drop_column('media', 'variants')
@@ -0,0 +1,69 @@
+"""Conversations inbox table
+
+Revision ID: 8e3f1a6c2d47
+Revises: 0b7e4d2a9f61
+Create Date: 2026-10-18 19:40:12.730561
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e3f1a6c2d47'
+down_revision: Union[str, None] = '0b7e4d2a9f61'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'conversations',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('peer_type_id', sa.Integer(), nullable=False),
+        sa.Column('peer_id', sa.Integer(), nullable=False),
+        sa.Column('last_message_id', sa.Integer(), nullable=False),
+        sa.Column('last_sender_id', sa.Integer(), nullable=False),
+        sa.Column('last_message_preview', sa.String(), nullable=False),
+        sa.Column('last_activity_at', sa.DateTime(), nullable=False),
+        sa.Column('unread_count', sa.Integer(), server_default='0', nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.user_id']),
+        sa.ForeignKeyConstraint(['peer_type_id'], ['recipient_type.type_id']),
+        sa.ForeignKeyConstraint(['last_message_id'], ['messages.message_id']),
+        sa.ForeignKeyConstraint(['last_sender_id'], ['users.user_id']),
+        sa.PrimaryKeyConstraint('user_id', 'peer_type_id', 'peer_id'),
+    )
+    op.create_index('ix_conversations_user_id_last_activity_at', 'conversations', ['user_id', 'last_activity_at'], unique=False)
+
+    # existing history: the latest message of every conversation, nothing counted as unread
+    op.execute("""
+        INSERT INTO conversations (user_id, peer_type_id, peer_id, last_message_id, last_sender_id,
+                                   last_message_preview, last_activity_at, unread_count)
+        SELECT user_id, peer_type_id, peer_id, message_id, sender_id, substr(content, 1, 120), created_at, 0
+        FROM (
+            SELECT sides.*, ROW_NUMBER() OVER (
+                PARTITION BY user_id, peer_type_id, peer_id ORDER BY created_at DESC, message_id DESC
+            ) AS position
+            FROM (
+                SELECT sender_id AS user_id, 2 AS peer_type_id, recipient_id AS peer_id,
+                       message_id, sender_id, content, created_at
+                FROM messages WHERE recipient_type_id = 2
+                UNION ALL
+                SELECT recipient_id, 2, sender_id, message_id, sender_id, content, created_at
+                FROM messages WHERE recipient_type_id = 2 AND recipient_id != sender_id
+                UNION ALL
+                SELECT members.user_id, 1, m.recipient_id, m.message_id, m.sender_id, m.content, m.created_at
+                FROM messages m
+                JOIN (SELECT DISTINCT group_id, user_id FROM group_members) members ON members.group_id = m.recipient_id
+                WHERE m.recipient_type_id = 1
+            ) sides
+        ) ranked
+        WHERE position = 1
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_conversations_user_id_last_activity_at', table_name='conversations')
+    op.drop_table('conversations')
@@ -0,0 +1,57 @@
+"""FTS5 full-text index over listings
+
+Revision ID: 9a6c1f4b8e37
+Revises: 5d0e8f3a7c21
+Create Date: 2026-10-18 13:05:52.117630
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9a6c1f4b8e37'
+down_revision: Union[str, None] = '5d0e8f3a7c21'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts USING fts5(
+            title, description, location,
+            content='listings', content_rowid='listing_id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    op.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_fts_insert AFTER INSERT ON listings BEGIN
+            INSERT INTO listings_fts(rowid, title, description, location)
+            VALUES (new.listing_id, new.title, new.description, new.location);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_fts_delete AFTER DELETE ON listings BEGIN
+            INSERT INTO listings_fts(listings_fts, rowid, title, description, location)
+            VALUES ('delete', old.listing_id, old.title, old.description, old.location);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_fts_update AFTER UPDATE OF title, description, location ON listings BEGIN
+            INSERT INTO listings_fts(listings_fts, rowid, title, description, location)
+            VALUES ('delete', old.listing_id, old.title, old.description, old.location);
+            INSERT INTO listings_fts(rowid, title, description, location)
+            VALUES (new.listing_id, new.title, new.description, new.location);
+        END
+    """)
+    # index the rows that already exist
+    op.execute("INSERT INTO listings_fts(listings_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER IF EXISTS listings_fts_update")
+    op.execute("DROP TRIGGER IF EXISTS listings_fts_delete")
+    op.execute("DROP TRIGGER IF EXISTS listings_fts_insert")
+    op.execute("DROP TABLE IF EXISTS listings_fts")
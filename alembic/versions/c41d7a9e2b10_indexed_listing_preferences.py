@@ -0,0 +1,76 @@
+"""Indexed listing preference columns
+
+Revision ID: c41d7a9e2b10
+Revises: b3eeb135f396
+Create Date: 2026-10-18 10:02:11.482913
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c41d7a9e2b10'
+down_revision: Union[str, None] = 'b3eeb135f396'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+FLAG_COLUMNS = {
+    'pref_smoking': 'smoking',
+    'pref_pet_friendly': 'pet_friendly',
+    'pref_party_friendly': 'party_friendly',
+    'pref_vegan': 'vegan',
+}
+
+
+def upgrade() -> None:
+    for column in FLAG_COLUMNS:
+        op.add_column('listings', sa.Column(column, sa.Boolean(), nullable=True))
+        op.create_index(op.f(f'ix_listings_{column}'), 'listings', [column], unique=False)
+    op.add_column('listings', sa.Column('pref_quiet_start', sa.String(), nullable=True))
+    op.add_column('listings', sa.Column('pref_quiet_end', sa.String(), nullable=True))
+
+    op.create_table(
+        'listing_languages',
+        sa.Column('listing_id', sa.Integer(), nullable=False),
+        sa.Column('language', sa.String(), nullable=False),
+        sa.ForeignKeyConstraint(['listing_id'], ['listings.listing_id']),
+        sa.PrimaryKeyConstraint('listing_id', 'language'),
+    )
+    op.create_index('ix_listing_languages_language', 'listing_languages', ['language', 'listing_id'], unique=False)
+    op.create_table(
+        'listing_preferred_sexes',
+        sa.Column('listing_id', sa.Integer(), nullable=False),
+        sa.Column('sex', sa.String(), nullable=False),
+        sa.ForeignKeyConstraint(['listing_id'], ['listings.listing_id']),
+        sa.PrimaryKeyConstraint('listing_id', 'sex'),
+    )
+    op.create_index('ix_listing_preferred_sexes_sex', 'listing_preferred_sexes', ['sex', 'listing_id'], unique=False)
+
+    # backfill from the JSON column (sqlite json1)
+    for column, key in FLAG_COLUMNS.items():
+        op.execute(f"UPDATE listings SET {column} = json_extract(preferences, '$.{key}') WHERE preferences IS NOT NULL")
+    op.execute("UPDATE listings SET pref_quiet_start = json_extract(preferences, '$.quiet_hours.start'), "
+               "pref_quiet_end = json_extract(preferences, '$.quiet_hours.end') WHERE preferences IS NOT NULL")
+    op.execute("INSERT OR IGNORE INTO listing_languages (listing_id, language) "
+               "SELECT listings.listing_id, lower(trim(value)) FROM listings, json_each(listings.preferences, '$.language') "
+               "WHERE listings.preferences IS NOT NULL AND trim(value) != ''")
+    op.execute("INSERT OR IGNORE INTO listing_preferred_sexes (listing_id, sex) "
+               "SELECT listings.listing_id, lower(trim(value)) FROM listings, json_each(listings.preferences, '$.preferred_sex_of_the_flat') "
+               "WHERE listings.preferences IS NOT NULL AND trim(value) != ''")
+    op.execute("ANALYZE")
+
+
+def downgrade() -> None:
+    op.drop_index('ix_listing_preferred_sexes_sex', table_name='listing_preferred_sexes')
+    op.drop_table('listing_preferred_sexes')
+    op.drop_index('ix_listing_languages_language', table_name='listing_languages')
+    op.drop_table('listing_languages')
+    op.drop_column('listings', 'pref_quiet_end')
+    op.drop_column('listings', 'pref_quiet_start')
+    for column in FLAG_COLUMNS:
+        op.drop_index(op.f(f'ix_listings_{column}'), table_name='listings')
+        op.drop_column('listings', column)
@@ -0,0 +1,60 @@
+"""Listing coordinates and the listings_geo R*Tree
+
+Revision ID: c8e4b1f7a925
+Revises: a7f3c9e1d062
+Create Date: 2026-10-18 23:48:16.305721
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c8e4b1f7a925'
+down_revision: Union[str, None] = 'a7f3c9e1d062'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('listings', sa.Column('latitude', sa.Float(), nullable=True))
+    op.add_column('listings', sa.Column('longitude', sa.Float(), nullable=True))
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS listings_geo USING rtree(
+            listing_id, min_lat, max_lat, min_lon, max_lon
+        )
+    """)
+    op.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_geo_insert AFTER INSERT ON listings
+        WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL BEGIN
+            INSERT INTO listings_geo VALUES (new.listing_id, new.latitude, new.latitude, new.longitude, new.longitude);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_geo_delete AFTER DELETE ON listings BEGIN
+            DELETE FROM listings_geo WHERE listing_id = old.listing_id;
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_geo_update AFTER UPDATE OF latitude, longitude ON listings BEGIN
+            DELETE FROM listings_geo WHERE listing_id = old.listing_id;
+            INSERT INTO listings_geo SELECT new.listing_id, new.latitude, new.latitude, new.longitude, new.longitude
+            WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL;
+        END
+    """)
+    # existing listings get their coordinates from `python -m service.geo backfill`, the update trigger indexes them
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute("DROP TRIGGER IF EXISTS listings_geo_update")
+        op.execute("DROP TRIGGER IF EXISTS listings_geo_delete")
+        op.execute("DROP TRIGGER IF EXISTS listings_geo_insert")
+        op.execute("DROP TABLE IF EXISTS listings_geo")
+    with op.batch_alter_table('listings') as batch_op:
+        batch_op.drop_column('longitude')
+        batch_op.drop_column('latitude')
@@ -0,0 +1,53 @@
+"""Compatibility match index tables
+
+Revision ID: e7b2c9d4a150
+Revises: 9a6c1f4b8e37
+Create Date: 2026-10-18 15:41:09.336218
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7b2c9d4a150'
+down_revision: Union[str, None] = '9a6c1f4b8e37'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'user_listing_matches',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('listing_id', sa.Integer(), nullable=False),
+        sa.Column('score', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['listing_id'], ['listings.listing_id']),
+        sa.ForeignKeyConstraint(['user_id'], ['users.user_id']),
+        sa.PrimaryKeyConstraint('user_id', 'listing_id'),
+    )
+    op.create_index('ix_user_listing_matches_user_score', 'user_listing_matches', ['user_id', 'score'], unique=False)
+    op.create_index('ix_user_listing_matches_listing', 'user_listing_matches', ['listing_id'], unique=False)
+    op.create_table(
+        'listing_tenant_matches',
+        sa.Column('listing_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('score', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['listing_id'], ['listings.listing_id']),
+        sa.ForeignKeyConstraint(['user_id'], ['users.user_id']),
+        sa.PrimaryKeyConstraint('listing_id', 'user_id'),
+    )
+    op.create_index('ix_listing_tenant_matches_listing_score', 'listing_tenant_matches', ['listing_id', 'score'], unique=False)
+    op.create_index('ix_listing_tenant_matches_user', 'listing_tenant_matches', ['user_id'], unique=False)
+    # filled by `python -m service.match_index rebuild`
+
+
+def downgrade() -> None:
+    op.drop_index('ix_listing_tenant_matches_user', table_name='listing_tenant_matches')
+    op.drop_index('ix_listing_tenant_matches_listing_score', table_name='listing_tenant_matches')
+    op.drop_table('listing_tenant_matches')
+    op.drop_index('ix_user_listing_matches_listing', table_name='user_listing_matches')
+    op.drop_index('ix_user_listing_matches_user_score', table_name='user_listing_matches')
+    op.drop_table('user_listing_matches')
@@ -0,0 +1,114 @@
+"""Benchmark radius search: haversine over every listing vs the listings_geo R*Tree prefilter.
+
+Builds a throwaway SQLite database per size, listings spread around the cities
+of the gazetteer, and times both versions of the same radius queries.
+
+    PYTHONPATH=app python app/benchmarks/geo_search.py --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, create_engine, event, func, insert, select, text
+
+from database import Base, sqlite_functions
+from model.client_model import Listing
+from controller.listing_controller import build_listing_filters
+from service.geo import geocode
+
+BATCH_SIZE = 10_000
+CITIES = ["Warsaw", "Krakow", "Gdansk", "Wroclaw", "Lublin", "Poznan", "Lodz", "Elblag", "Berlin", "Praha", "Wien"]
+
+# (latitude, longitude, radius_km) around a campus in Krakow, the centre of Warsaw and a village
+SCENARIOS = {
+    "krakow campus 1km": (50.0614, 19.9366, 1),
+    "krakow campus 3km": (50.0614, 19.9366, 3),
+    "warsaw 10km": (52.2297, 21.0122, 10),
+    "warsaw 50km": (52.2297, 21.0122, 50),
+    "nowhere 5km": (51.0, 23.9, 5),
+}
+
+
+def populate(engine, size):
+    centres = [geocode(city) for city in CITIES]
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        for start in range(0, size, BATCH_SIZE):
+            listings = []
+            for listing_id in range(start + 1, min(start + BATCH_SIZE, size) + 1):
+                latitude, longitude = random.choice(centres)
+                listings.append({
+                    "listing_id": listing_id,
+                    "owner_id": 1,
+                    "title": f"Listing #{listing_id}",
+                    "description": "benchmark listing",
+                    "price": random.randint(1500, 3500),
+                    "isRental": True,
+                    "location": "benchmark",
+                    # most of them within ~15 km of the centre
+                    "latitude": random.gauss(latitude, 0.07),
+                    "longitude": random.gauss(longitude, 0.1),
+                    "images": [],
+                    "created": now - timedelta(seconds=listing_id),
+                    "updated": now,
+                    "status": "active",
+                })
+            conn.execute(insert(Listing), listings)
+        conn.execute(text("ANALYZE"))
+
+
+def full_scan(latitude, longitude, radius_km):
+    return [func.haversine_km(Listing.latitude, Listing.longitude, latitude, longitude) <= radius_km]
+
+
+def timed(conn, filters, repeat, page=None):
+    query = select(Listing.listing_id).where(and_(*filters))
+    if page:
+        # the first page of /listings/search, newest first
+        query = query.order_by(Listing.created.desc(), Listing.listing_id.desc()).limit(page)
+    samples, rows = [], 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = len(conn.execute(query).fetchall())
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples), rows
+
+
+def run(size, repeat):
+    path = os.path.join(tempfile.mkdtemp(), "geo_search.db")
+    engine = create_engine(f"sqlite:///{path}")
+    event.listen(engine, "connect", sqlite_functions)
+    Base.metadata.create_all(bind=engine)
+
+    started = time.perf_counter()
+    populate(engine, size)
+    print(f"\n{size:,} listings (populated in {time.perf_counter() - started:.1f}s)")
+    print(f"  {'scenario':<22}{'scan ms':>10}{'rows':>9}{'r*tree ms':>11}{'rows':>9}{'page ms':>10}{'speedup':>10}")
+
+    with engine.connect() as conn:
+        for name, (latitude, longitude, radius_km) in SCENARIOS.items():
+            scan_ms, scan_rows = timed(conn, full_scan(latitude, longitude, radius_km), repeat)
+            filters = build_listing_filters(lat=latitude, lon=longitude, radius_km=radius_km)
+            indexed_ms, indexed_rows = timed(conn, filters, repeat)
+            page_ms, _ = timed(conn, filters, repeat, page=20)
+            print(f"  {name:<22}{scan_ms:>10.1f}{scan_rows:>9}{indexed_ms:>11.1f}{indexed_rows:>9}{page_ms:>10.1f}"
+                  f"{scan_ms / max(indexed_ms, 0.001):>9.1f}x")
+
+    engine.dispose()
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    for size in args.sizes:
+        run(size, args.repeat)
@@ -0,0 +1,125 @@
+"""Benchmark /listings/search filters: legacy LIKE patterns vs the indexed preference columns and FTS.
+
+Builds a throwaway SQLite database per size and times both versions of the same filters.
+
+    PYTHONPATH=app python app/benchmarks/listing_search.py --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import and_, create_engine, insert, select, text
+
+from database import Base
+from model.client_model import Listing, ListingLanguage, ListingPreferredSex, preference_columns, preference_tags
+from controller.listing_controller import build_listing_filters
+from seed_data import random_preferences
+
+BATCH_SIZE = 10_000
+CITIES = ["Warsaw", "Krakow", "Gdansk", "Wroclaw", "Lublin", "Poznan", "Lodz", "Elblag"]
+
+SCENARIOS = {
+    "smoking=false": {"smoking": False},
+    "vegan+party": {"vegan": True, "party_friendly": True},
+    "language=Turkish": {"language": ["Turkish"]},
+    "all flags+German": {"smoking": False, "vegan": True, "party_friendly": True, "language": ["German"]},
+    "price+vegan+Spanish": {"min_price": 3000, "max_price": 3100, "vegan": True, "language": ["Spanish"]},
+    "location=gdan+vegan": {"location": "gdan", "vegan": True},
+}
+
+
+def legacy_filters(params):
+    # the substring patterns /listings/search used before the pref_* columns existed
+    filters = []
+    if params.get("location"):
+        filters.append(Listing.location.ilike(f"%{params['location']}%"))
+    if params.get("min_price") is not None:
+        filters.append(Listing.price >= params["min_price"])
+    if params.get("max_price") is not None:
+        filters.append(Listing.price <= params["max_price"])
+    if params.get("pet_friendly") is not None:
+        filters.append(Listing.preferences.like('%"pet_friendly": true%'))
+    for key in ("smoking", "party_friendly", "vegan"):
+        if params.get(key) is not None:
+            filters.append(Listing.preferences.like(f'%"{key}": {str(params[key]).lower()}%'))
+    for lang in params.get("language") or []:
+        filters.append(Listing.preferences.like(f'%"language": %%"{lang}"%'))
+    return filters
+
+
+def populate(engine, size):
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        for start in range(0, size, BATCH_SIZE):
+            listings, languages, sexes = [], [], []
+            for listing_id in range(start + 1, min(start + BATCH_SIZE, size) + 1):
+                preferences = random_preferences()
+                listings.append({
+                    "listing_id": listing_id,
+                    "owner_id": 1,
+                    "title": f"Listing #{listing_id}",
+                    "description": "benchmark listing",
+                    "price": random.randint(1500, 3500),
+                    "isRental": True,
+                    "location": random.choice(CITIES),
+                    "images": [],
+                    "preferences": preferences,
+                    "created": now,
+                    "updated": now,
+                    "status": "active",
+                    **preference_columns(preferences),
+                })
+                listing_languages, listing_sexes = preference_tags(preferences)
+                languages += [{"listing_id": listing_id, "language": l} for l in listing_languages]
+                sexes += [{"listing_id": listing_id, "sex": s} for s in listing_sexes]
+            conn.execute(insert(Listing), listings)
+            conn.execute(insert(ListingLanguage), languages)
+            conn.execute(insert(ListingPreferredSex), sexes)
+        conn.execute(text("ANALYZE"))
+
+
+def timed(conn, filters, repeat):
+    query = select(Listing.listing_id).where(and_(*filters))
+    samples, rows = [], 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = len(conn.execute(query).fetchall())
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples), rows
+
+
+def run(size, repeat):
+    path = os.path.join(tempfile.mkdtemp(), "listing_search.db")
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+
+    started = time.perf_counter()
+    populate(engine, size)
+    print(f"\n{size:,} listings (populated in {time.perf_counter() - started:.1f}s)")
+    print(f"  {'scenario':<24}{'legacy ms':>12}{'rows':>10}{'indexed ms':>12}{'rows':>10}{'speedup':>10}")
+
+    with engine.connect() as conn:
+        for name, params in SCENARIOS.items():
+            legacy_ms, legacy_rows = timed(conn, legacy_filters(params), repeat)
+            indexed_ms, indexed_rows = timed(conn, build_listing_filters(**params), repeat)
+            print(f"  {name:<24}{legacy_ms:>12.1f}{legacy_rows:>10}{indexed_ms:>12.1f}{indexed_rows:>10}"
+                  f"{legacy_ms / max(indexed_ms, 0.001):>9.1f}x")
+
+    engine.dispose()
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    for size in args.sizes:
+        run(size, args.repeat)
@@ -0,0 +1,52 @@
+"""Benchmark compatibility scoring + top-k over an in-memory listing matrix.
+
+    PYTHONPATH=app python app/benchmarks/recommendations.py --sizes 100000 1000000
+"""
+import argparse
+import random
+import statistics
+import time
+
+import numpy as np
+
+from seed_data import random_preferences
+from service.compatibility import LISTING_SEX_KEY, USER_SEX_KEY, PreferenceMatrix, encode_preferences, score, top_k
+
+
+def random_matrix(size, rng):
+    # encode a small sample for realistic bit patterns, then tile it up to the full size
+    sample = encode_preferences(range(10_000), [random_preferences() for _ in range(10_000)], LISTING_SEX_KEY)
+    picks = rng.integers(0, len(sample), size)
+    return PreferenceMatrix(
+        np.arange(size, dtype=np.int64), sample.flags[picks], sample.languages[picks], sample.sexes[picks], sample.quiet[picks]
+    )
+
+
+def run(size, repeat, k, rng):
+    matrix = random_matrix(size, rng)
+    user = encode_preferences([0], [{
+        "language": ["English", "Polish"], "smoking": False, "pet_friendly": True, "party_friendly": False,
+        "vegan": True, "preferred_sex_to_live_with": ["female"], "quiet_hours": {"start": "22:00", "end": "07:00"},
+    }], USER_SEX_KEY)
+    owners = rng.integers(0, 1000, size)
+
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        best = top_k(score(matrix, user), k, exclude=owners == 7)
+        samples.append((time.perf_counter() - started) * 1000)
+    print(f"{size:>10,} listings  median {statistics.median(samples):7.1f} ms  min {min(samples):7.1f} ms  (top {len(best)})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("-k", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    for size in args.sizes:
+        run(size, args.repeat, args.k, rng)
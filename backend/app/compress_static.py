@@ -0,0 +1,45 @@
+"""Write .br and .gz siblings next to every compressible file of the built frontend.
+
+Run once after `npm run build`, service/static_files.py serves them as they are:
+
+    python app/compress_static.py static
+"""
+import argparse
+import gzip
+import os
+
+import brotli
+
+COMPRESSIBLE = {".js", ".mjs", ".css", ".html", ".svg", ".json", ".map", ".txt", ".xml", ".wasm", ".ico"}
+MIN_SIZE = 512
+
+
+def compress_tree(root: str):
+    written = saved = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE or os.path.getsize(path) < MIN_SIZE:
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            for suffix, compressed in (
+                (".br", brotli.compress(data, quality=11)),
+                (".gz", gzip.compress(data, 9, mtime=0)),
+            ):
+                # not worth a sibling when it barely shrinks
+                if len(compressed) < len(data) * 0.9:
+                    with open(path + suffix, "wb") as f:
+                        f.write(compressed)
+                    written += 1
+                    saved += len(data) - len(compressed)
+    return written, saved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", nargs="?", default="static")
+    args = parser.parse_args()
+
+    written, saved = compress_tree(args.root)
+    print(f"wrote {written} precompressed files, {saved / 1024:.0f} KiB smaller in total")
@@ -1,22 +1,50 @@
 from fastapi import APIRouter, Depends, Form, HTTPException, BackgroundTasks  , Query
+from fastapi.concurrency import run_in_threadpool
 
 from sqlalchemy.orm import Session
 from sqlalchemy import JSON, Column, func
 
 from schemas.user_schemas import LoginRequest, RegisterRequest, PasswordResetRequest, UserListResponse, UserProfileResponse, UserProfileUpdateRequest
-from model.client_model import Group, GroupMember, Listing, User
-from service.auth import get_current_user, verify_password, get_password_hash, create_access_token, ALGORITHM, SECRET_KEY
+from model.client_model import User
+from service.auth import Principal, get_current_principal, invalidate_principal, verify_and_update_password, verify_password, get_password_hash, create_access_token, ALGORITHM, SECRET_KEY
+from service.cache import bump_users_version
+from service.match_index import schedule_user_refresh
+from service.jobs import enqueue
+from service.purge import after_user_purge, mark_deleted, needs_background_purge, run_steps, user_steps
+from service.write_queue import run_write
 from dependencies import get_db
 from jose import jwt, JWTError
 
 router = APIRouter()
 
 
+# register, login and the password endpoints are async: they await their bcrypt hash on the
+# hashing pool (service/password_hashing.py) without holding a threadpool thread, their
+# queries go to the threadpool with run_in_threadpool. what they read before the hash is
+# read through _read_and_release, so no pooled connection waits on bcrypt with them
+
+def _read_and_release(db: Session, read):
+    """`read(db)`, then the session's connection goes back to the pool (the session stays usable)."""
+    try:
+        return read(db)
+    finally:
+        db.close()
+
 @router.post("/register")
-def register(
+async def register(
     request: RegisterRequest, 
     db: Session = Depends(get_db)
     ):
+    await run_in_threadpool(_read_and_release, db, lambda db: _check_available(db, request))
+    hashed_password = await get_password_hash(request.password)
+    new_user = await run_in_threadpool(_insert_user, db, request, hashed_password)
+    if new_user.preference:
+        bump_users_version()
+        schedule_user_refresh(new_user.user_id)
+
+    return {"message": "User registered successfully"}
+
+def _check_available(db: Session, request: RegisterRequest):
     # validate if username or email already exists
     if request.email:
         existing_user = db.query(User).filter(User.email == request.email).first()
@@ -27,9 +55,8 @@ def register(
         existing_user = db.query(User).filter(User.username == request.username).first()
         if existing_user:
             raise HTTPException(status_code=400, detail="Username already taken")
-    
-    hashed_password = get_password_hash(request.password)
 
+def _insert_user(db: Session, request: RegisterRequest, hashed_password: str) -> User:
     # user creation
     new_user = User(
         name=request.name,
@@ -47,17 +74,30 @@ def register(
     db.add(new_user)
     db.commit()
     db.refresh(new_user)
-
-    return {"message": "User registered successfully"}
+    return new_user
 
 @router.post("/login")
-def login(request: LoginRequest, db: Session = Depends(get_db)):
+async def login(request: LoginRequest, db: Session = Depends(get_db)):
     # query the user by email
-    user = db.query(User).filter(User.email == request.email).first()
+    user = await run_in_threadpool(_read_and_release, db, lambda db: db.query(User.user_id, User.password).filter(
+        User.email == request.email, User.deleted_at.is_(None)
+    ).first())
 
     # Validatte user and password
-    if not user or not verify_password(request.password, user.password):
+    if not user:
         raise HTTPException(status_code=400, detail="Invalid credentials")
+    valid, new_hash = await verify_and_update_password(request.password, user.password)
+    if not valid:
+        raise HTTPException(status_code=400, detail="Invalid credentials")
+
+    # hashed with an older bcrypt cost, store it again with the current one
+    if new_hash:
+        user_id = user.user_id
+
+        def store_hash(db: Session):
+            db.query(User).filter(User.user_id == user_id).update({User.password: new_hash})
+
+        await run_in_threadpool(run_write, db, store_hash)
     
     # Create a jwt token
     token = create_access_token({"sub": str(user.user_id)})
@@ -66,19 +106,10 @@ def login(request: LoginRequest, db: Session = Depends(get_db)):
 
 
 @router.post("/password-reset")
-def password_reset(request: PasswordResetRequest, db: Session = Depends(get_db)):
+async def password_reset(request: PasswordResetRequest, db: Session = Depends(get_db)):
     # step 1 - token generation (requesting reset)
     if request.email:
-        user = db.query(User).filter(User.email == request.email).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        # Generate reset token
-        reset_token = create_access_token({"sub": user.email})
-        
-        # Simulate sending the token via email
-        print(f"Password reset token for {request.email}: {reset_token}")
-
+        await run_in_threadpool(_queue_reset_email, db, request.email)
         return {"message": "Password reset link has been sent to your email"}
 
     # step 2 -  password reset (updatting password)
@@ -91,32 +122,55 @@ def password_reset(request: PasswordResetRequest, db: Session = Depends(get_db))
         except JWTError:
             raise HTTPException(status_code=400, detail="Invalid token")
 
-        user = db.query(User).filter(User.email == email).first()
-        if not user:
+        user_id = await run_in_threadpool(
+            _read_and_release, db, lambda db: db.query(User.user_id).filter(User.email == email).scalar()
+        )
+        if not user_id:
             raise HTTPException(status_code=404, detail="User not found")
 
         # Hash and update the password
-        hashed_password = get_password_hash(request.new_password)
-        user.hashed_password = hashed_password
-        db.commit()
+        hashed_password = await get_password_hash(request.new_password)
+        await run_in_threadpool(run_write, db, _password_update(user_id, hashed_password))
+        invalidate_principal(user_id)
 
         return {"message": "Password has been reset successfully"}
 
     # Fallback for invalid requests
     raise HTTPException(status_code=400, detail="Invalid request. Provide email or token with new password.")
 
+def _queue_reset_email(db: Session, email: str):
+    user = db.query(User).filter(User.email == email).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    # the token is made and mailed by a job, the request only queues it
+    def queue_reset_email(db: Session):
+        enqueue(db, "password_reset_email", {"email": user.email})
+
+    run_write(db, queue_reset_email)
+
+def _password_update(user_id: int, hashed_password: str):
+    def job(db: Session):
+        db.query(User).filter(User.user_id == user_id).update({User.password: hashed_password})
+    return job
+
 @router.post("/change-password")
-def change_password(
+async def change_password(
     current_password: str = Form(...),
     new_password: str = Form(...),
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: Principal = Depends(get_current_principal)
 ):
-    if not verify_password(current_password, current_user.password):
+    # the same session as the principal lookup, released with it
+    stored_hash = await run_in_threadpool(
+        _read_and_release, db, lambda db: db.query(User.password).filter(User.user_id == current_user.user_id).scalar()
+    )
+    if not stored_hash or not await verify_password(current_password, stored_hash):
         raise HTTPException(status_code=400, detail="Current password is incorrect")
 
-    current_user.password = get_password_hash(new_password)
-    db.commit()
+    hashed_password = await get_password_hash(new_password)
+    await run_in_threadpool(run_write, db, _password_update(current_user.user_id, hashed_password))
+    invalidate_principal(current_user.user_id)
 
     return {"message": "Password changed successfully"}
 
@@ -125,7 +179,7 @@ def get_user_profile(
     user_id: int, 
     db: Session = Depends(get_db)):
 
-    user = db.query(User).filter(User.user_id == user_id).first()
+    user = db.query(User).filter(User.user_id == user_id, User.deleted_at.is_(None)).first()
 
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -167,11 +221,16 @@ def update_user_profile(
         user.bio = profile_update.bio
     if profile_update.pets is not None:
         user.pets = profile_update.pets.dict()
-    if profile_update.preferences is not None:
+    preferences_changed = profile_update.preferences is not None
+    if preferences_changed:
         user.preference = profile_update.preferences.dict()  
     
     db.commit()
     db.refresh(user)
+    invalidate_principal(user.user_id)
+    if preferences_changed:
+        bump_users_version()
+        schedule_user_refresh(user.user_id)
     
     return {
         "user_id": user.user_id,
@@ -194,8 +253,8 @@ def list_all_users(
     db: Session = Depends(get_db)
 ):
     # Fetch total count and results
-    total_users = db.query(func.count(User.user_id)).scalar()
-    users = db.query(User).offset(skip).limit(limit).all()
+    total_users = db.query(func.count(User.user_id)).filter(User.deleted_at.is_(None)).scalar()
+    users = db.query(User).filter(User.deleted_at.is_(None)).offset(skip).limit(limit).all()
     
     return {
         "total": total_users,
@@ -216,22 +275,29 @@ def list_all_users(
 def delete_user(
     user_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: Principal = Depends(get_current_principal)
 ):
     if current_user.role != "admin" and current_user.user_id != user_id:
         raise HTTPException(status_code=403, detail="Not authorized to delete this user")
 
-    user = db.query(User).filter(User.user_id == user_id).first()
+    user = db.query(User).filter(User.user_id == user_id, User.deleted_at.is_(None)).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    db.query(GroupMember).filter(GroupMember.user_id == user_id).delete()
+    # a big history is deleted in small batches in the background, the account is closed right away
+    if needs_background_purge(db, user_id):
+        def close_account(db: Session):
+            mark_deleted(db, user_id)
 
-    db.query(Group).filter(Group.owner_id == user_id).delete()
+        run_write(db, close_account)
+        invalidate_principal(user_id)
+        return {"message": f"User with ID {user_id} has been deleted, their data is being removed"}
 
-    db.query(Listing).filter(Listing.owner_id == user_id).delete()
+    def purge_account(db: Session):
+        return run_steps(db, user_steps(user_id))
 
-    db.delete(user)
-    db.commit()
+    deleted_listings = run_write(db, purge_account)
+    invalidate_principal(user_id)
+    after_user_purge(user_id, deleted_listings)
 
     return {"message": f"User with ID {user_id} has been deleted"}
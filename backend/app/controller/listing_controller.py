@@ -1,40 +1,94 @@
-import os
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, Query, UploadFile, status
-from sqlalchemy import and_, func
-from sqlalchemy.orm import Session, joinedload
-from service.auth import get_current_user, get_user_id
-from schemas.listing_schemas import GroupCreate, GroupResponse, ListingCreate, ListingResponse, ListingUpdateRequest, UpdateGroupPreferenceRequest
-from model.client_model import Group, GroupMember, Listing, User
-from dependencies import get_db
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, UploadFile, status
+from pydantic import TypeAdapter
+from sqlalchemy import and_, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload, selectinload
+from service.auth import Principal, get_current_principal, get_current_user, get_user_id
+from service.compatibility import USER_SEX_KEY, encode_preferences, listing_matrix_cache, score, top_k
+from service.cache import CachedResponse, bump_listings_version, cached_response, listings_cache, listings_etag, listings_version
+from service.match_index import schedule_listing_refresh
+from service.purge import group_steps, listing_steps, run_steps
+from service.notifications import notify
+from service.query_budget import query_budget
+from service.realtime import hub
+from service.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, paginate_listings
+from service.geo import MAX_RADIUS_KM, coordinates, within_radius
+from service.search import fts_query
+from service.listing_import import FORMATS, body_lines, import_listings, refresh_match_index
+from service.images import enqueue_variants, with_image_variants, with_image_variants_async
+from service.media import add_references
+from service.uploads import UploadRoute, save_uploads
+from service.write_queue import run_write
+from schemas.listing_schemas import GroupCreate, GroupResponse, ListingCreate, ListingResponse, ListingUpdateRequest, RecommendedListingResponse, TenantMatchResponse, UpdateGroupPreferenceRequest
+from model.client_model import Group, GroupMember, Listing, ListingLanguage, ListingPreferredSex, ListingStatus, ListingTenantMatch, User, UserListingMatch, listings_fts
+from dependencies import get_async_db, get_db
 import logging
 from fastapi import UploadFile, File, Form
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-router = APIRouter()
+# multipart files are hashed into place while the body arrives, see service.uploads
+router = APIRouter(route_class=UploadRoute)
 
 from pydantic import BaseModel
 
 class MemberActionRequest(BaseModel):
     user_id: int
 
+listing_list_adapter = TypeAdapter(List[ListingResponse])
+
+def variant_urls(listings):
+    # the listing's updated stamp doesn't move when its derivatives land, so they go into the ETag
+    return [variant["thumb"] for listing in listings for variant in listing.image_variants]
+
+def publish_membership_change(db: Session, group: Group, action: str, user_id: int):
+    # to the owner and the user concerned, and for changes to who is in the group to its active members too
+    recipients = {group.owner_id, user_id}
+    if action not in ("join_requested", "rejected"):
+        recipients.update(member_id for member_id, in db.query(GroupMember.user_id).filter(
+            GroupMember.group_id == group.group_id, GroupMember.status == "active"
+        ))
+    hub.publish(recipients, {"type": "membership", "action": action, "group_id": group.group_id, "user_id": user_id})
+
+def set_next_cursor(response: Response, next_cursor: Optional[str]):
+    # the body stays a plain list, the cursor for the following page travels in a header
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+
 @router.get("/listings", response_model=List[ListingResponse])
-def get_all_listings(db: Session = Depends(get_db)):
-    listings = db.query(Listing).all()
-    formatted_listings = [
-        {
-            **listing.__dict__,
-            "created": listing.created.isoformat(),
-            "updated": listing.updated.isoformat() if listing.updated else None,
-        }
-        for listing in listings
-    ]
-    return formatted_listings
+async def get_all_listings(
+    request: Request,
+    sort: str = "newest",
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db),
+):
+    # read the version before querying, a write racing with us then only lands under an already stale key
+    cache_key = ("listings", listings_version(), sort, cursor, limit)
+    entry = listings_cache.get(cache_key)
+    if entry is None:
+        listings, next_cursor = await paginate_listings(db, select(Listing), sort, cursor, limit)
+        await with_image_variants_async(db, listings)
+        formatted_listings = [
+            {
+                **listing.__dict__,
+                "created": listing.created.isoformat(),
+                "updated": listing.updated.isoformat() if listing.updated else None,
+            }
+            for listing in listings
+        ]
+        entry = CachedResponse(
+            body=listing_list_adapter.dump_json(listing_list_adapter.validate_python(formatted_listings)),
+            etag=listings_etag(((l.listing_id, l.updated) for l in listings), next_cursor, *variant_urls(listings)),
+            headers={"X-Next-Cursor": next_cursor} if next_cursor else {},
+        )
+        listings_cache.put(cache_key, entry)
+    return cached_response(request, entry)
 
 @router.post("/listings", status_code=status.HTTP_201_CREATED)
-async def create_listing(
+def create_listing(
     title: str = Form(...),
     description: str = Form(...),
     price: float = Form(...),
@@ -42,48 +96,85 @@ async def create_listing(
     isRental: bool = Form(...),
     status: Optional[str] = Form("active"),
     preferences: Optional[str] = Form(None),
+    latitude: Optional[float] = Form(None, ge=-90, le=90),
+    longitude: Optional[float] = Form(None, ge=-180, le=180),
     images: List[UploadFile] = File(None), 
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: Principal = Depends(get_current_principal)
 ):
+    # plain def on purpose: fastapi runs it in the threadpool, so moving the files
+    # and the commits below never block the event loop
     if price < 0:
         raise HTTPException(status_code=422, detail="Price must be a positive number.")
-
-    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) 
-    uploads_dir = os.path.join(base_dir, "uploads")
-    os.makedirs(uploads_dir, exist_ok=True)
-
-    saved_image_paths: List[str] = []
-    if images:
-        for img in images:
-            disk_path = os.path.join(uploads_dir, img.filename)
-            with open(disk_path, "wb") as buffer:
-                buffer.write(await img.read())
-            saved_image_paths.append(f"uploads/{img.filename}")
+    if (latitude is None) != (longitude is None):
+        raise HTTPException(status_code=422, detail="Give both latitude and longitude, or neither.")
 
     import json
     preferences_data = json.loads(preferences) if preferences else None
 
-    new_listing = Listing(
-        title=title,
-        description=description,
-        price=price,
-        location=location,
-        isRental=isRental,
-        status=status,
-        preferences=preferences_data,
-        owner_id=current_user.user_id,
-        images=saved_image_paths,
-    )
-
-    db.add(new_listing)
-    db.commit()
-    db.refresh(new_listing)
+    stored_images = save_uploads(images)
+    # from the bundled gazetteer when not given, no network call
+    latitude, longitude = coordinates(location, latitude, longitude)
+
+    def insert_listing(db: Session):
+        new_listing = Listing(
+            title=title,
+            description=description,
+            price=price,
+            location=location,
+            latitude=latitude,
+            longitude=longitude,
+            isRental=isRental,
+            status=status,
+            preferences=preferences_data,
+            owner_id=current_user.user_id,
+        )
+        # the urls of the Media rows, content seen before keeps the name it was first stored under
+        urls = add_references(db, stored_images, current_user.user_id)
+        new_listing.images = [urls[image.sha256] for image in stored_images]
+        db.add(new_listing)
+        db.flush()
+        # thumbnails are rendered by a job, committed together with the listing
+        enqueue_variants(db, [image.sha256 for image in stored_images])
+        db.refresh(new_listing)
+        return new_listing
+
+    new_listing = run_write(db, insert_listing)
+    bump_listings_version()
+    schedule_listing_refresh(new_listing.listing_id)
 
     return {"success": True, "data": new_listing}
 
-@router.get("/listings/search", response_model=List[ListingResponse])
-def search_listings(
+
+@router.post("/listings/import")
+def import_listings_endpoint(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+    owner_id: Optional[int] = Query(None),
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_principal)
+):
+    # plain def as well: the body is pulled from the event loop chunk by chunk while
+    # parsing and the inserts run here in the threadpool, see service/listing_import.py
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Only admins can import listings")
+
+    fmt = format or FORMATS.get(request.headers.get("content-type", "").split(";")[0].strip().lower())
+    if fmt is None:
+        raise HTTPException(status_code=415, detail="Send text/csv or application/x-ndjson, or pass ?format=")
+
+    owner_id = owner_id or current_user.user_id
+    if db.get(User, owner_id) is None:
+        raise HTTPException(status_code=404, detail="Owner not found")
+    db.commit()  # don't sit on a read transaction for the whole upload
+
+    report = import_listings(db, body_lines(request), fmt, owner_id)
+    if report.imported:
+        bump_listings_version()
+        refresh_match_index(report)
+    return report.as_dict()
+
+def build_listing_filters(
     location: Optional[str] = None,
     min_price: Optional[float] = None,
     max_price: Optional[float] = None,
@@ -93,17 +184,29 @@ def search_listings(
     vegan: Optional[bool] = None,
     quiet_hours_start: Optional[str] = None,
     quiet_hours_end: Optional[str] = None,
-    language: Optional[List[str]] = Query(None),
+    language: Optional[List[str]] = None,
+    preferred_sex: Optional[List[str]] = None,
     owner_id: Optional[int] = None,
-    db: Session = Depends(get_db),
+    lat: Optional[float] = None,
+    lon: Optional[float] = None,
+    radius_km: Optional[float] = None,
 ):
     filters = []
     
     if owner_id:
         filters.append(Listing.owner_id == owner_id)
     
+    # city goes through the FTS index as well (token prefix match instead of a leading-wildcard ILIKE)
     if location:
-        filters.append(Listing.location.ilike(f"%{location}%"))
+        location_match = fts_query(location, column="location")
+        if location_match:
+            filters.append(Listing.listing_id.in_(
+                select(listings_fts.c.rowid).where(listings_fts.c.listings_fts.match(location_match))
+            ))
+
+    # R*Tree bounding box first, exact distance on what is left
+    if lat is not None and lon is not None and radius_km is not None:
+        filters += within_radius(lat, lon, radius_km)
 
     if min_price is not None:
         filters.append(Listing.price >= min_price)
@@ -111,26 +214,96 @@ def search_listings(
         filters.append(Listing.price <= max_price)
 
     if pet_friendly is not None:
-        filters.append(Listing.preferences.like('%"pet_friendly": true%'))
+        filters.append(Listing.pref_pet_friendly == pet_friendly)
     if smoking is not None:
-        filters.append(Listing.preferences.like(f'%"smoking": {str(smoking).lower()}%'))
+        filters.append(Listing.pref_smoking == smoking)
     if party_friendly is not None:
-        filters.append(Listing.preferences.like(f'%"party_friendly": {str(party_friendly).lower()}%'))
+        filters.append(Listing.pref_party_friendly == party_friendly)
     if vegan is not None:
-        filters.append(Listing.preferences.like(f'%"vegan": {str(vegan).lower()}%'))
+        filters.append(Listing.pref_vegan == vegan)
 
     if quiet_hours_start:
-        filters.append(Listing.preferences.like(f'%"quiet_hours": "start": "{quiet_hours_start}"%'))
+        filters.append(Listing.pref_quiet_start == quiet_hours_start)
     if quiet_hours_end:
-        filters.append(Listing.preferences.like(f'%"quiet_hours": %%"end": "{quiet_hours_end}"%'))
+        filters.append(Listing.pref_quiet_end == quiet_hours_end)
 
+    # every requested language / sex has to be present, each one is an index lookup on the side table
     if language:
         for lang in language:
-            filters.append(Listing.preferences.like(f'%"language": %%"{lang}"%'))
+            filters.append(Listing.listing_id.in_(
+                select(ListingLanguage.listing_id).where(ListingLanguage.language == lang.strip().lower())
+            ))
+    if preferred_sex:
+        for sex in preferred_sex:
+            filters.append(Listing.listing_id.in_(
+                select(ListingPreferredSex.listing_id).where(ListingPreferredSex.sex == sex.strip().lower())
+            ))
+
+    return filters
+
+
+@router.get("/listings/search", response_model=List[ListingResponse])
+async def search_listings(
+    response: Response,
+    q: Optional[str] = None,
+    location: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    pet_friendly: Optional[bool] = None,
+    smoking: Optional[bool] = None,
+    party_friendly: Optional[bool] = None,
+    vegan: Optional[bool] = None,
+    quiet_hours_start: Optional[str] = None,
+    quiet_hours_end: Optional[str] = None,
+    language: Optional[List[str]] = Query(None),
+    preferred_sex: Optional[List[str]] = Query(None),
+    owner_id: Optional[int] = None,
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lon: Optional[float] = Query(None, ge=-180, le=180),
+    radius_km: Optional[float] = Query(None, gt=0, le=MAX_RADIUS_KM),
+    sort: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db),
+):
+    if len({lat is None, lon is None, radius_km is None}) > 1:
+        raise HTTPException(status_code=400, detail="A radius search needs lat, lon and radius_km")
+
+    query = select(Listing)
+
+    # full text over title/description/location, ranked by bm25 unless another sort is asked for
+    text_match = fts_query(q)
+    if text_match:
+        query = query.join(listings_fts, listings_fts.c.rowid == Listing.listing_id).where(
+            listings_fts.c.listings_fts.match(text_match)
+        )
+    sort = sort or ("relevance" if text_match else "newest")
+    if sort == "relevance" and not text_match:
+        raise HTTPException(status_code=400, detail="Sorting by relevance needs a search query (q)")
+
+    filters = build_listing_filters(
+        location=location,
+        min_price=min_price,
+        max_price=max_price,
+        pet_friendly=pet_friendly,
+        smoking=smoking,
+        party_friendly=party_friendly,
+        vegan=vegan,
+        quiet_hours_start=quiet_hours_start,
+        quiet_hours_end=quiet_hours_end,
+        language=language,
+        preferred_sex=preferred_sex,
+        owner_id=owner_id,
+        lat=lat,
+        lon=lon,
+        radius_km=radius_km,
+    )
 
     logger.info("Constructed filters: %s", filters)
 
-    listings = db.query(Listing).filter(and_(*filters)).all()
+    listings, next_cursor = await paginate_listings(db, query.where(and_(*filters)), sort, cursor, limit)
+    await with_image_variants_async(db, listings)
+    set_next_cursor(response, next_cursor)
 
     logger.info("Number of listings found: %d", len(listings))
 
@@ -150,25 +323,127 @@ def search_listings(
 
 
 
+@router.get("/listings/recommended", response_model=List[RecommendedListingResponse])
+def get_recommended_listings(
+    k: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    if not current_user.preference:
+        raise HTTPException(status_code=400, detail="Add your preferences to your profile to get recommendations")
+
+    # score the whole active catalog in one go and keep the k best, skipping the user's own listings
+    matrix, owners = listing_matrix_cache.get(db)
+    me = encode_preferences([current_user.user_id], [current_user.preference], USER_SEX_KEY)
+    scores = score(matrix, me)
+    best = top_k(scores, k, exclude=owners == current_user.user_id)
+
+    best_ids = matrix.ids[best].tolist()
+    # the cached matrix can be a few seconds old, so drop anything archived or deleted since
+    listings = {
+        listing.listing_id: listing
+        for listing in db.query(Listing).filter(Listing.listing_id.in_(best_ids), Listing.status == ListingStatus.active)
+    }
+    with_image_variants(db, listings.values())
+
+    return [
+        {
+            **listings[listing_id].__dict__,
+            "created": listings[listing_id].created.isoformat(),
+            "updated": listings[listing_id].updated.isoformat() if listings[listing_id].updated else None,
+            "score": round(float(scores[index]), 6),
+        }
+        for index, listing_id in zip(best.tolist(), best_ids)
+        if listing_id in listings
+    ]
+
+
+@router.get("/listings/best-matches", response_model=List[RecommendedListingResponse])
+def get_best_matching_listings(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_principal),
+):
+    # precomputed by service/match_index, an index range scan on (user_id, score)
+    matches = (
+        db.query(Listing, UserListingMatch.score)
+        .join(UserListingMatch, UserListingMatch.listing_id == Listing.listing_id)
+        .filter(UserListingMatch.user_id == current_user.user_id)
+        .order_by(UserListingMatch.score.desc())
+        .limit(limit)
+        .all()
+    )
+    with_image_variants(db, [listing for listing, _ in matches])
+    return [
+        {
+            **listing.__dict__,
+            "created": listing.created.isoformat(),
+            "updated": listing.updated.isoformat() if listing.updated else None,
+            "score": match_score,
+        }
+        for listing, match_score in matches
+    ]
+
+
 @router.get("/listings/{listing_id}", response_model=ListingResponse)
-def get_listing(listing_id: int, db: Session = Depends(get_db)):
+async def get_listing(listing_id: int, request: Request, db: AsyncSession = Depends(get_async_db)):
+    cache_key = ("listing", listings_version(), listing_id)
+    entry = listings_cache.get(cache_key)
+    if entry is None:
+        listing = await db.scalar(select(Listing).where(Listing.listing_id == listing_id))
+        if not listing:
+            raise HTTPException(status_code=404, detail="Listing not found")
+        await with_image_variants_async(db, [listing])
+        formatted_listing = {
+            "listing_id": listing.listing_id,
+            "owner_id" : listing.owner_id,
+            "title": listing.title,
+            "description": listing.description,
+            "price": listing.price,
+            "location": listing.location,
+            "latitude": listing.latitude,
+            "longitude": listing.longitude,
+            "isRental" : listing.isRental,
+            "images": listing.images,
+            "image_variants": listing.image_variants,
+            "created": listing.created.isoformat(),
+            "updated": listing.updated.isoformat(),
+            "status": listing.status,
+            "preferences": listing.preferences,
+        }
+        entry = CachedResponse(
+            body=ListingResponse.model_validate(formatted_listing).model_dump_json().encode(),
+            etag=listings_etag([(listing.listing_id, listing.updated)], *variant_urls([listing])),
+        )
+        listings_cache.put(cache_key, entry)
+    return cached_response(request, entry)
+
+
+@router.get("/listings/{listing_id}/best-tenants", response_model=List[TenantMatchResponse])
+def get_best_tenants(
+    listing_id: int,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_principal),
+):
     listing = db.query(Listing).filter(Listing.listing_id == listing_id).first()
     if not listing:
         raise HTTPException(status_code=404, detail="Listing not found")
-    return {
-        "listing_id": listing.listing_id,
-        "owner_id" : listing.owner_id,
-        "title": listing.title,
-        "description": listing.description,
-        "price": listing.price,
-        "location": listing.location,
-        "isRental" : listing.isRental,
-        "images": listing.images,
-        "created": listing.created.isoformat(),
-        "updated": listing.updated.isoformat(),
-        "status": listing.status,
-        "preferences": listing.preferences,
-    }
+    if current_user.role != "admin" and current_user.user_id != listing.owner_id:
+        raise HTTPException(status_code=403, detail="Only the owner can see matching tenants")
+
+    matches = (
+        db.query(User.user_id, User.name, User.surname, User.username, ListingTenantMatch.score)
+        .join(ListingTenantMatch, ListingTenantMatch.user_id == User.user_id)
+        .filter(ListingTenantMatch.listing_id == listing_id)
+        .order_by(ListingTenantMatch.score.desc())
+        .limit(limit)
+        .all()
+    )
+    return [
+        {"user_id": user_id, "name": name, "surname": surname, "username": username, "score": match_score}
+        for user_id, name, surname, username, match_score in matches
+    ]
 
 
 @router.put("/listings/{listing_id}", response_model=ListingResponse)
@@ -190,6 +465,13 @@ def update_listing(
         listing.description = listing_update.description
     if listing_update.price is not None:
         listing.price = listing_update.price
+    if (listing_update.latitude is None) != (listing_update.longitude is None):
+        raise HTTPException(status_code=422, detail="Give both latitude and longitude, or neither.")
+    if listing_update.latitude is not None:
+        listing.latitude, listing.longitude = listing_update.latitude, listing_update.longitude
+    elif listing_update.location is not None and listing_update.location != listing.location:
+        # a moved listing is geocoded again, or loses coordinates that no longer fit
+        listing.latitude, listing.longitude = coordinates(listing_update.location)
     if listing_update.location is not None:
         listing.location = listing_update.location
     if listing_update.isRental is not None:
@@ -199,6 +481,9 @@ def update_listing(
 
     db.commit()
     db.refresh(listing)
+    bump_listings_version()
+    schedule_listing_refresh(listing.listing_id)
+    with_image_variants(db, [listing])
 
     return {
         "listing_id": listing.listing_id,
@@ -207,18 +492,22 @@ def update_listing(
         "description": listing.description,
         "price": listing.price,
         "location": listing.location,
+        "latitude": listing.latitude,
+        "longitude": listing.longitude,
         "isRental" : listing.isRental,
         "images": listing.images,
+        "image_variants": listing.image_variants,
         "created": listing.created.isoformat(),
         "updated": listing.updated.isoformat(),
-        "status": listing.status
+        "status": listing.status,
+        "preferences": listing.preferences,
     }
 
 @router.delete("/listings/{listing_id}")
 def delete_listing(
     listing_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: Principal = Depends(get_current_principal)
 ):
     listing = db.query(Listing).filter(Listing.listing_id == listing_id).first()
 
@@ -228,19 +517,13 @@ def delete_listing(
     if current_user.role != "admin" and current_user.user_id != listing.owner_id:
         raise HTTPException(status_code=403, detail="Not authorized to delete this listing")
 
-    # find and delete GroupMembers of groups tied to this listing
-    groups_to_delete = db.query(Group).filter(Group.listing_id == listing_id).all()
+    # the listing with its groups (members, messages) and side tables, one statement per table
+    def delete_listing_rows(db: Session):
+        run_steps(db, listing_steps(select(Listing.listing_id).where(Listing.listing_id == listing_id)))
 
-    for group in groups_to_delete:
-        db.query(GroupMember).filter(GroupMember.group_id == group.group_id).delete()
-
-    # delete groups themselves
-    for group in groups_to_delete:
-        db.delete(group)
-
-    # delete the listing
-    db.delete(listing)
-    db.commit()
+    run_write(db, delete_listing_rows)
+    bump_listings_version()
+    schedule_listing_refresh(listing_id)
 
     return {"message": f"Listing with ID {listing_id} and its related groups and members have been deleted"}
 
@@ -295,7 +578,7 @@ def create_group(group: GroupCreate, db: Session = Depends(get_db), current_user
 def delete_group(
     group_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_principal),
 ):
     group = db.query(Group).filter(Group.group_id == group_id).first()
 
@@ -306,18 +589,23 @@ def delete_group(
     if current_user.role != "admin" and current_user.user_id != group.owner_id:
         raise HTTPException(status_code=403, detail="Not authorized to delete this group")
 
-    # delete group members
-    db.query(GroupMember).filter(GroupMember.group_id == group_id).delete()
+    # members, messages and inbox rows with it
+    def delete_group_rows(db: Session):
+        run_steps(db, group_steps(select(Group.group_id).where(Group.group_id == group_id)))
 
-    db.delete(group)
-    db.commit()
+    run_write(db, delete_group_rows)
 
     return {"message": f"Group with ID {group_id} has been deleted successfully"}
 
 
-@router.get("/groups/{group_id}", response_model=GroupResponse)
+@router.get("/groups/{group_id}", response_model=GroupResponse, dependencies=[Depends(query_budget(1))])
 def get_group_details(group_id: int, db: Session = Depends(get_db)):
-    group = db.query(Group).filter(Group.group_id == group_id).first()
+    group = (
+        db.query(Group)
+        .options(joinedload(Group.members).joinedload(GroupMember.user))
+        .filter(Group.group_id == group_id)
+        .first()
+    )
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
 
@@ -345,7 +633,7 @@ def get_group_details(group_id: int, db: Session = Depends(get_db)):
 
 
 @router.post("/groups/{group_id}/join")
-def join_group(group_id: int, db: Session = Depends(get_db), current_user=Depends(get_current_user)):
+def join_group(group_id: int, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
     # valuidate if group exists
     group = db.query(Group).filter(Group.group_id == group_id).first()
     if not group:
@@ -375,7 +663,7 @@ def update_group_preferences(
     group_id: int,
     request: UpdateGroupPreferenceRequest,
     db: Session = Depends(get_db),
-    current_user=Depends(get_current_user),
+    current_user: Principal = Depends(get_current_principal),
 ):
     group = db.query(Group).filter(Group.group_id == group_id).first()
     if not group:
@@ -392,7 +680,7 @@ def update_group_preferences(
     return {"message": "Group preferences updated successfully", "lifestyle_preference": group.lifestyle_preference}
 
 
-@router.get("/listings/{listing_id}/groups", response_model=List[GroupResponse])
+@router.get("/listings/{listing_id}/groups", response_model=List[GroupResponse], dependencies=[Depends(query_budget(1))])
 def get_groups_for_listing(listing_id: int, db: Session = Depends(get_db)):
     # Query the database to get all groups for the listing
     groups = (
@@ -413,6 +701,7 @@ def get_groups_for_listing(listing_id: int, db: Session = Depends(get_db)):
                 "name": member.user.name,
                 "surname": member.user.surname,
                 "username": member.user.username,
+                "status": member.status,
             }
             for member in group.members
         ]
@@ -434,9 +723,10 @@ def get_groups_for_listing(listing_id: int, db: Session = Depends(get_db)):
 
     return serialized_groups
 
-@router.get("/groups", response_model=List[GroupResponse])
+@router.get("/groups", response_model=List[GroupResponse], dependencies=[Depends(query_budget(2))])
 def get_all_groups(db: Session = Depends(get_db)):
-    groups = db.query(Group).all()
+    # members in one extra IN query instead of a join repeating every group row per member
+    groups = db.query(Group).options(selectinload(Group.members).joinedload(GroupMember.user)).all()
 
     formatted_groups = []
     for group in groups:
@@ -464,7 +754,7 @@ def get_all_groups(db: Session = Depends(get_db)):
 
 
 @router.post("/groups/{group_id}/join-request")
-def join_request(group_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def join_request(group_id: int, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
     group = db.query(Group).filter(Group.group_id == group_id).first()
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
@@ -472,22 +762,26 @@ def join_request(group_id: int, db: Session = Depends(get_db), current_user: Use
     if group.owner_id == current_user.user_id:
         raise HTTPException(status_code=400, detail="Group owner cannot request to join their own group.")
 
-    existing = db.query(GroupMember).filter(
-        GroupMember.group_id == group_id,
-        GroupMember.user_id == current_user.user_id
-    ).first()
-
-    if existing:
-        if existing.status == "pending":
-            raise HTTPException(status_code=400, detail="You have already sent a join request.")
-        elif existing.status == "active":
-            raise HTTPException(status_code=400, detail="You are already a member of this group.")
-        else:
-            raise HTTPException(status_code=400, detail="Join request already exists.")
-
-    new_request = GroupMember(group_id=group_id, user_id=current_user.user_id, status="pending")
-    db.add(new_request)
-    db.commit()
+    # check and insert in the same write, with the sqlite write queue on two quick clicks can't both get through
+    def insert_request(db: Session):
+        existing = db.query(GroupMember).filter(
+            GroupMember.group_id == group_id,
+            GroupMember.user_id == current_user.user_id
+        ).first()
+
+        if existing:
+            if existing.status == "pending":
+                raise HTTPException(status_code=400, detail="You have already sent a join request.")
+            elif existing.status == "active":
+                raise HTTPException(status_code=400, detail="You are already a member of this group.")
+            else:
+                raise HTTPException(status_code=400, detail="Join request already exists.")
+
+        db.add(GroupMember(group_id=group_id, user_id=current_user.user_id, status="pending"))
+
+    run_write(db, insert_request)
+    notify([group.owner_id], f"{current_user.username} asked to join {group.name}")
+    publish_membership_change(db, group, "join_requested", current_user.user_id)
     return {"message": "Join request sent successfully."}
 
 
@@ -496,7 +790,7 @@ def approve_member(
     group_id: int,
     payload: MemberActionRequest,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_principal),
 ):
     user_id = payload.user_id
 
@@ -514,6 +808,8 @@ def approve_member(
 
     member.status = "active"
     db.commit()
+    notify([user_id], f"Your request to join {group.name} was approved")
+    publish_membership_change(db, group, "approved", user_id)
     return {"message": "Member approved"}
 
 
@@ -522,7 +818,7 @@ def reject_member(
     group_id: int,
     payload: MemberActionRequest,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_principal),
 ):
     user_id = payload.user_id
 
@@ -540,6 +836,8 @@ def reject_member(
 
     db.delete(member)
     db.commit()
+    notify([user_id], f"Your request to join {group.name} was declined")
+    publish_membership_change(db, group, "rejected", user_id)
     return {"message": "Request rejected"}
 
 
@@ -548,7 +846,7 @@ def remove_member(
     group_id: int,
     payload: MemberActionRequest,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_principal),
 ):
     user_id = payload.user_id
 
@@ -566,6 +864,7 @@ def remove_member(
 
     db.delete(member)
     db.commit()
+    publish_membership_change(db, group, "removed", user_id)
     return {"message": "Meber removed"}
 
 
@@ -573,7 +872,7 @@ def remove_member(
 def leave_group(
     group_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: Principal = Depends(get_current_principal)
 ):
     group = db.query(Group).filter(Group.group_id == group_id).first()
     if not group:
@@ -593,5 +892,6 @@ def leave_group(
 
     db.delete(membership)
     db.commit()
+    publish_membership_change(db, group, "left", current_user.user_id)
 
     return {"message": "You have left the group successfully"}
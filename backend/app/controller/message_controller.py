@@ -1,19 +1,76 @@
-from schemas.message_schemas import DirectMessageRequest, GroupMessageRequest
-from model.client_model import Group, GroupMember, Message, Notification, User
-from service.auth import get_current_user
+from schemas.message_schemas import DirectMessageRequest, GroupMessageRequest, MarkNotificationsReadRequest
+from model.client_model import Conversation, Group, GroupMember, Message, Notification, User
+from service.auth import Principal, get_current_principal
+from service.conversations import PEER_TYPE_NAMES, PEER_TYPES, mark_read, record_direct_message, record_group_message
+from service.notifications import mark_read as mark_notification_read, mark_read_up_to, notification_event, notifications_after, notify, unread_count
+from service.query_budget import query_budget
+from service.realtime import OVERFLOW, Event, encode, hub
+from service.write_queue import run_write
+from database import SessionLocal
 from dependencies import get_db
+from sqlalchemy import and_, select, tuple_, union_all
 from sqlalchemy.sql import text  
-from sqlalchemy.orm import Session
-from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session, aliased
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, WebSocket, WebSocketDisconnect, status
+from typing import Optional
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+import asyncio
+import os
 
 router = APIRouter()
 
+MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 200
+
+# a comment line this often on an idle event stream, keeps proxies from cutting it
+# and makes a client that went away fail the write so its stream gets closed
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+SSE_RETRY_MS = int(os.getenv("SSE_RETRY_MS", "3000"))
+SSE_REPLAY_BATCH = 200
+SSE_EVENT_TYPES = {"notification", "membership"}
+
+
+def page_keys(db: Session, statements, before: Optional[int], after: Optional[int], limit: int):
+    """Ids of one page of messages from the union of `statements` (selects of Message ids).
+
+    Newest `limit` messages by default, the ones just older than message `before`, or
+    the ones just newer than message `after`. Each statement is cut to the page on its
+    own index first, so a page costs the same however long the history is.
+    """
+    requested = [cursor for cursor in (before, after) if cursor is not None]
+    positions = dict(db.query(Message.message_id, Message.created_at).filter(Message.message_id.in_(requested))) if requested else {}
+    for cursor in requested:
+        if cursor not in positions:
+            raise HTTPException(status_code=400, detail=f"Unknown message {cursor}")
+    position = tuple_(Message.created_at, Message.message_id)
+    newest_first = after is None
+
+    parts = []
+    for statement in statements:
+        statement = statement.add_columns(Message.created_at)
+        if before is not None:
+            statement = statement.where(position < (positions[before], before))
+        if after is not None:
+            statement = statement.where(position > (positions[after], after))
+        order = (Message.created_at, Message.message_id)
+        if newest_first:
+            order = tuple(column.desc() for column in order)
+        # wrapped, sqlite doesn't take ORDER BY / LIMIT on the parts of a UNION
+        parts.append(select(statement.order_by(*order).limit(limit).subquery()))
+
+    page = (union_all(*parts) if len(parts) > 1 else parts[0]).subquery()
+    order = (page.c.created_at, page.c.message_id)
+    if newest_first:
+        order = tuple(column.desc() for column in order)
+    return select(page.c.message_id).order_by(*order).limit(limit)
+
 
 @router.post("/messages")
 def send_direct_message(
     request: DirectMessageRequest,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_principal),
 ):
     # Ensure the recipient exists
     recipient = db.query(User).filter(User.user_id == request.recipient_id).first()
@@ -21,43 +78,72 @@ def send_direct_message(
         raise HTTPException(status_code=404, detail="Recipient not found")
 
     # Create the message
-    message = Message(
-        content=request.content,
-        sender_id=current_user.user_id,
-        recipient_id=request.recipient_id,
-        recipient_type_id=2,  # 2 for direct messages
-    )
-    db.add(message)
-    db.commit()
-    db.refresh(message)
+    def insert_message(db: Session):
+        message = Message(
+            content=request.content,
+            sender_id=current_user.user_id,
+            recipient_id=request.recipient_id,
+            recipient_type_id=2,  # 2 for direct messages
+        )
+        db.add(message)
+        db.flush()
+        record_direct_message(db, message)
+        return message
+
+    message = run_write(db, insert_message)
+    hub.publish([request.recipient_id, current_user.user_id], {
+        "type": "direct_message",
+        "message": {
+            "message_id": message.message_id,
+            "content": message.content,
+            "created_at": message.created_at,
+            "sender_id": current_user.user_id,
+            "sender_username": current_user.username,
+            "recipient_id": recipient.user_id,
+            "recipient_username": recipient.username,
+        },
+    })
+    if request.recipient_id != current_user.user_id:
+        notify([request.recipient_id], f"New message from {current_user.username}")
 
     return {"message": "Message sent successfully", "message_id": message.message_id}
 
-@router.get("/messages")
-def fetch_direct_messages(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    # Fetch all messages sent or received by the current user
+@router.get("/messages", dependencies=[Depends(query_budget(3))])
+def fetch_direct_messages(
+    before: Optional[int] = Query(None, description="message_id, page of older messages"),
+    after: Optional[int] = Query(None, description="message_id, page of newer messages"),
+    limit: int = Query(MESSAGE_PAGE_SIZE, ge=1, le=MAX_MESSAGE_PAGE_SIZE),
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_principal),
+):
+    # one page of direct messages sent or received by the current user, oldest first, usernames joined in.
+    # group messages keep the group id in recipient_id, hence the type on both sides
+    me = current_user.user_id
+    sent = select(Message.message_id).where(Message.recipient_type_id == 2, Message.sender_id == me)
+    received = select(Message.message_id).where(
+        Message.recipient_type_id == 2, Message.recipient_id == me, Message.sender_id != me
+    )
+    keys = page_keys(db, [sent, received], before, after, limit)
+
+    sender, recipient = aliased(User), aliased(User)
     messages = (
-        db.query(Message)
-        .filter(
-            (Message.sender_id == current_user.user_id) |
-            (Message.recipient_id == current_user.user_id)
+        db.query(
+            Message.message_id,
+            Message.content,
+            Message.created_at,
+            Message.sender_id,
+            sender.username.label("sender_username"),
+            Message.recipient_id,
+            recipient.username.label("recipient_username"),
         )
-        .order_by(Message.created_at.asc())
+        .join(sender, sender.user_id == Message.sender_id)
+        .outerjoin(recipient, recipient.user_id == Message.recipient_id)
+        .filter(Message.message_id.in_(keys))
+        .order_by(Message.created_at.asc(), Message.message_id.asc())
         .all()
     )
 
-    return [
-        {
-            "message_id": message.message_id,
-            "content": message.content,
-            "created_at": message.created_at,
-            "sender_id": message.sender_id,
-            "sender_username": message.sender.username,
-            "recipient_id": message.recipient_id,
-            "recipient_username": message.recipient.username,
-        }
-        for message in messages
-    ]
+    return [message._asdict() for message in messages]
 
 
 @router.post("/groups/{group_id}/messages")
@@ -65,7 +151,7 @@ def send_group_message(
     group_id: int,
     request: GroupMessageRequest, 
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_principal),
 ):
     # Ensure the group exists
     group = db.query(Group).filter(Group.group_id == group_id).first()
@@ -80,78 +166,298 @@ def send_group_message(
         raise HTTPException(status_code=403, detail="Not a member of the group")
 
     # Create the message
-    message = Message(
-        content=request.content,  
-        sender_id=current_user.user_id,
-        recipient_id=group_id,
-        recipient_type_id=1,  # 1 for group messages
+    def insert_message(db: Session):
+        message = Message(
+            content=request.content,  
+            sender_id=current_user.user_id,
+            recipient_id=group_id,
+            recipient_type_id=1,  # 1 for group messages
+        )
+        db.add(message)
+        db.flush()
+        # active members only, a pending join request doesn't get to read along
+        members = [user_id for user_id, in db.query(GroupMember.user_id).filter(
+            GroupMember.group_id == group_id, GroupMember.status == "active"
+        )]
+        record_group_message(db, message, members)
+        return message, members
+
+    message, members = run_write(db, insert_message)
+    hub.publish(members, {
+        "type": "group_message",
+        "group_id": group_id,
+        "message": {
+            "message_id": message.message_id,
+            "content": message.content,
+            "created_at": message.created_at,
+            "sender_id": current_user.user_id,
+            "sender_username": current_user.username,
+        },
+    })
+    notify(
+        [user_id for user_id in members if user_id != current_user.user_id],
+        f"New message from {current_user.username} in {group.name}",
     )
-    db.add(message)
-    db.commit()
-    db.refresh(message)
 
     return {"message": "Message sent successfully", "message_id": message.message_id}
 
-@router.get("/groups/{group_id}/messages")
-def fetch_group_messages(group_id: int, db: Session = Depends(get_db)):
+@router.get("/groups/{group_id}/messages", dependencies=[Depends(query_budget(3))])
+def fetch_group_messages(
+    group_id: int,
+    before: Optional[int] = Query(None, description="message_id, page of older messages"),
+    after: Optional[int] = Query(None, description="message_id, page of newer messages"),
+    limit: int = Query(MESSAGE_PAGE_SIZE, ge=1, le=MAX_MESSAGE_PAGE_SIZE),
+    db: Session = Depends(get_db),
+):
     # Fetch the group to ensure it exists
     group = db.query(Group).filter(Group.group_id == group_id).first()
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
 
-    # Fetch all messages for the group
+    # one page of the group's messages, oldest first
+    keys = page_keys(
+        db,
+        [select(Message.message_id).where(Message.recipient_type_id == 1, Message.recipient_id == group_id)],
+        before, after, limit,
+    )
     messages = (
-        db.query(Message)
-        .filter(Message.recipient_type_id == 1, Message.recipient_id == group_id)
-        .order_by(Message.created_at.asc())
+        db.query(
+            Message.message_id,
+            Message.content,
+            Message.created_at,
+            Message.sender_id,
+            User.username.label("sender_username"),
+        )
+        .join(User, User.user_id == Message.sender_id)
+        .filter(Message.message_id.in_(keys))
+        .order_by(Message.created_at.asc(), Message.message_id.asc())
         .all()
     )
 
-    return [
-        {
-            "message_id": message.message_id,
-            "content": message.content,
-            "created_at": message.created_at,
-            "sender_id": message.sender_id,
-            "sender_username": message.sender.username,
-        }
-        for message in messages
-    ]
+    return [message._asdict() for message in messages]
 
 
-@router.get("/notifications")
-def fetch_notifications(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    notifications = db.query(Notification).filter(
-        Notification.user_id == current_user.user_id
-    ).order_by(Notification.created_at.desc()).all()
+@router.get("/conversations", dependencies=[Depends(query_budget(2))])
+def fetch_conversations(
+    limit: int = Query(MESSAGE_PAGE_SIZE, ge=1, le=MAX_MESSAGE_PAGE_SIZE),
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_principal),
+):
+    # the inbox, most recent activity first. one query on (user_id, last_activity_at), names joined in
+    conversations = (
+        db.query(Conversation, User.username, Group.name)
+        .outerjoin(User, and_(Conversation.peer_type_id == PEER_TYPES["direct"], User.user_id == Conversation.peer_id))
+        .outerjoin(Group, and_(Conversation.peer_type_id == PEER_TYPES["group"], Group.group_id == Conversation.peer_id))
+        .filter(Conversation.user_id == current_user.user_id)
+        .order_by(Conversation.last_activity_at.desc())
+        .limit(limit)
+        .all()
+    )
 
     return [
         {
-            "notification_id": notification.notification_id,
-            "content": notification.content,
-            "created_at": notification.created_at,
-            "is_read": notification.is_read,
+            "peer_type": PEER_TYPE_NAMES[conversation.peer_type_id],
+            "peer_id": conversation.peer_id,
+            "title": username if conversation.peer_type_id == PEER_TYPES["direct"] else group_name,
+            "last_message_id": conversation.last_message_id,
+            "last_sender_id": conversation.last_sender_id,
+            "last_message_preview": conversation.last_message_preview,
+            "last_activity_at": conversation.last_activity_at,
+            "unread_count": conversation.unread_count,
         }
-        for notification in notifications
+        for conversation, username, group_name in conversations
     ]
 
 
+@router.post("/conversations/{peer_type}/{peer_id}/read")
+def mark_conversation_read(
+    peer_type: str,
+    peer_id: int,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_principal),
+):
+    if peer_type not in PEER_TYPES:
+        raise HTTPException(status_code=404, detail="Unknown conversation type, expected direct or group")
+
+    def reset_unread(db: Session):
+        return mark_read(db, current_user.user_id, PEER_TYPES[peer_type], peer_id)
+
+    if not run_write(db, reset_unread):
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    return {"message": "Conversation marked as read"}
+
+
+@router.get("/notifications", dependencies=[Depends(query_budget(2))])
+def fetch_notifications(
+    before: Optional[int] = Query(None, description="notification_id, page of older notifications"),
+    limit: int = Query(MESSAGE_PAGE_SIZE, ge=1, le=MAX_MESSAGE_PAGE_SIZE),
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_principal),
+):
+    # newest first, one page at a time on (user_id, notification_id)
+    query = db.query(
+        Notification.notification_id,
+        Notification.content,
+        Notification.created_at,
+        Notification.is_read,
+    ).filter(Notification.user_id == current_user.user_id)
+    if before is not None:
+        query = query.filter(Notification.notification_id < before)
+    notifications = query.order_by(Notification.notification_id.desc()).limit(limit).all()
+
+    return [notification._asdict() for notification in notifications]
+
+
+@router.get("/notifications/unread-count", dependencies=[Depends(query_budget(2))])
+def fetch_unread_notification_count(db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    return {"unread_count": unread_count(db, current_user.user_id)}
+
+
+@router.post("/notifications/read")
+def mark_notifications_read(
+    request: MarkNotificationsReadRequest,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_principal),
+):
+    # everything up to the newest notification the client has shown, in one statement
+    def mark_up_to(db: Session):
+        return mark_read_up_to(db, current_user.user_id, request.up_to_id)
+
+    marked = run_write(db, mark_up_to)
+    return {"message": "Notifications marked as read", "marked": marked}
+
+
 @router.put("/notifications/{notification_id}")
 def mark_notification_as_read(
     notification_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_principal),
 ):
-    # Fetch the notification
-    notification = db.query(Notification).filter(
-        Notification.notification_id == notification_id,
-        Notification.user_id == current_user.user_id
-    ).first()
-    if not notification:
-        raise HTTPException(status_code=404, detail="Notification not found")
+    def mark_one(db: Session):
+        return mark_notification_read(db, current_user.user_id, notification_id)
 
-    # Mark as read
-    notification.is_read = True
-    db.commit()
+    if not run_write(db, mark_one):
+        raise HTTPException(status_code=404, detail="Notification not found")
 
     return {"message": "Notification marked as read"}
+
+
+def _replay_notifications(user_id: int, after_id: int):
+    db = SessionLocal()
+    try:
+        return [
+            encode(notification_event(notification), notification.notification_id)
+            for notification in notifications_after(db, user_id, after_id, SSE_REPLAY_BATCH)
+        ]
+    finally:
+        db.close()
+
+
+def _server_sent(event: Event) -> str:
+    lines = [f"event: {event.type}"]
+    if event.id is not None:
+        lines.append(f"id: {event.id}")
+    lines.append(f"data: {event.data}")
+    return "\n".join(lines) + "\n\n"
+
+
+def _principal_for_socket(token: str):
+    db = SessionLocal()
+    try:
+        return get_current_principal(token, db)
+    except HTTPException:
+        return None
+    finally:
+        db.close()
+
+
+@router.websocket("/ws")
+async def message_socket(websocket: WebSocket):
+    # browsers can't set headers on a websocket, so the jwt comes as ?token=, a bearer header works too
+    token = websocket.query_params.get("token") or websocket.headers.get("authorization", "").removeprefix("Bearer ")
+    principal = await run_in_threadpool(_principal_for_socket, token) if token else None
+    if principal is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+
+    subscriber = hub.subscribe(principal.user_id)
+
+    async def send_events():
+        while True:
+            payload = await subscriber.queue.get()
+            if payload is OVERFLOW:
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                return
+            await websocket.send_text(payload.data)
+
+    async def receive():
+        # nothing is sent our way but pings, this is what notices the client going away
+        while True:
+            if await websocket.receive_text() == "ping":
+                # through the queue, only send_events() writes to the socket
+                subscriber.offer(encode({"type": "pong"}))
+
+    tasks = [asyncio.create_task(send_events()), asyncio.create_task(receive())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        hub.unsubscribe(subscriber)
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, WebSocketDisconnect, RuntimeError):
+                pass
+
+
+@router.get("/notifications/stream")
+async def notification_stream(
+    request: Request,
+    token: Optional[str] = Query(None),
+    last_event_id: Optional[str] = Header(None),
+):
+    # new notifications and membership changes as server-sent events, instead of polling /notifications.
+    # EventSource can't set headers either, so the jwt comes as ?token= like on the websocket
+    token = token or request.headers.get("authorization", "").removeprefix("Bearer ")
+    principal = await run_in_threadpool(_principal_for_socket, token) if token else None
+    if principal is None:
+        raise HTTPException(status_code=401, detail="Could not validate credentials")
+    # the browser sends back the id of the last notification it got when it reconnects
+    resume_after = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+
+    async def events():
+        # subscribed before the replay reads the table, so nothing falls in between
+        subscriber = hub.subscribe(principal.user_id, SSE_EVENT_TYPES)
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            last_id = resume_after
+            while last_id is not None:
+                replayed = await run_in_threadpool(_replay_notifications, principal.user_id, last_id)
+                for event in replayed:
+                    yield _server_sent(event)
+                    last_id = event.id
+                if len(replayed) < SSE_REPLAY_BATCH:
+                    break
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if event is OVERFLOW:
+                    # fell behind, the client reconnects with Last-Event-ID and gets the rest from the table
+                    return
+                if event.id is not None and last_id is not None and event.id <= last_id:
+                    continue  # replayed already
+                yield _server_sent(event)
+        finally:
+            hub.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
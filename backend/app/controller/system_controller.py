@@ -1,15 +1,34 @@
-from dependencies import get_db
+from dependencies import get_async_db, get_db
 from sqlalchemy.sql import text  
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from fastapi import APIRouter, Depends
+from service.jobs import queue_stats
+from service.mail import mailer
+from service.notifications import notification_writer
+from service.password_hashing import hashing_pool
+from service.realtime import hub
 
 router = APIRouter()
 
 
 @router.get("/health-check")
-def health_check(db: Session = Depends(get_db)):
+async def health_check(db: AsyncSession = Depends(get_async_db)):
     try:
-        db.execute(text("SELECT 1"))
+        await db.execute(text("SELECT 1"))
         return {"status": "ok", "database": "connected"}
     except Exception as e:
-        return {"status": "error", "database": "disconnected", "details": str(e)}
\ No newline at end of file
+        return {"status": "error", "database": "disconnected", "details": str(e)}
+
+
+@router.get("/metrics")
+def metrics(db: Session = Depends(get_db)):
+    return {
+        "password_hashing": hashing_pool.metrics(),
+        "websockets": hub.metrics(),
+        "notifications": notification_writer.metrics(),
+        # from the jobs table, covers a separate worker process too
+        "jobs": queue_stats(db),
+        # this process's connection only, not a separate worker's
+        "mail": mailer.metrics(),
+    }
\ No newline at end of file
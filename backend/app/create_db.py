@@ -1,4 +1,12 @@
+from sqlalchemy import text
 from database import engine
 from model.client_model import Base
 
 Base.metadata.create_all(bind=engine)
+
+# refresh planner statistics, without them sqlite prefers the low-selectivity
+# preference flag indexes over the keyset pagination ones
+if engine.dialect.name == "sqlite":
+    with engine.connect() as conn:
+        conn.execute(text("PRAGMA analysis_limit=1000"))
+        conn.execute(text("ANALYZE"))
@@ -1,10 +1,110 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.ext.declarative import declarative_base
 import os
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app/data/test.db")
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# connection pool, recycle only matters for servers that drop idle connections (postgres)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+
+def engine_options(url, asyncio: bool = False) -> dict:
+    url = make_url(url)
+    options = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT}
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            # in-memory databases live and die with their one connection, no pool to size
+            return {"connect_args": {"check_same_thread": False}}
+        # connections hop between threadpool threads, sqlite is fine with that as long as one thread uses it at a time
+        options["connect_args"] = {"check_same_thread": False}
+        if asyncio:
+            # aiosqlite defaults to NullPool, i.e. a new connection and thread for every session
+            options["poolclass"] = AsyncAdaptedQueuePool
+        return options
+    return {**options, "pool_recycle": DB_POOL_RECYCLE, "pool_pre_ping": True}
+
+
+def async_database_url(url) -> str:
+    """The same database through an asyncio driver: aiosqlite for sqlite, asyncpg for postgres."""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend == "sqlite":
+        url = url.set(drivername="sqlite+aiosqlite")
+    elif backend in ("postgresql", "postgres"):
+        url = url.set(drivername="postgresql+asyncpg")
+    return url.render_as_string(hide_password=False)
+
+
+# heroku style postgres:// urls are not understood by sqlalchemy 2
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = "postgresql://" + DATABASE_URL[len("postgres://"):]
+
+# opt-in production profile for sqlite, see sqlite_pragmas() and service/write_queue.py
+SQLITE_PRODUCTION = os.getenv("SQLITE_PRODUCTION", "").lower() in ("1", "true", "yes")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", str(64 * 1024)))
+
+
+def sqlite_pragmas(dbapi_connection, connection_record=None):
+    """Per connection settings of the production profile.
+
+    WAL lets readers carry on while one writer commits, NORMAL only fsyncs at
+    checkpoints (still safe against corruption in WAL mode), and busy_timeout makes a
+    second writer wait for the lock instead of failing with "database is locked".
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    # negative means KiB instead of pages
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def sqlite_functions(dbapi_connection, connection_record=None):
+    """SQL functions sqlite doesn't have, registered on every connection (see service/geo.py)."""
+    # imported here, service.geo imports this module
+    from service.geo import haversine_km
+
+    dbapi_connection.create_function("haversine_km", 4, haversine_km, deterministic=True)
+
+
+def use_sqlite_production_profile(engine) -> bool:
+    return SQLITE_PRODUCTION and engine.dialect.name == "sqlite"
+
+
+def dialect_insert(db):
+    """insert() of the session's dialect, the generic one has no on_conflict_do_update."""
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
+
+# asyncio side for the hot read endpoints, a request then holds no threadpool slot while it waits on the database
+async_engine = create_async_engine(async_database_url(DATABASE_URL), **engine_options(DATABASE_URL, asyncio=True))
+# nothing gets lazily reloaded after a commit, that would need io outside of an await
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+if use_sqlite_production_profile(engine):
+    event.listen(engine, "connect", sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", sqlite_pragmas)
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", sqlite_functions)
+    event.listen(async_engine.sync_engine, "connect", sqlite_functions)
@@ -1,4 +1,4 @@
-from database import SessionLocal
+from database import AsyncSessionLocal, SessionLocal
 
 # get db session
 def get_db():
@@ -7,4 +7,8 @@ def get_db():
         yield db
     finally:
         db.close()
-        
\ No newline at end of file
+
+# async db session, for `async def` endpoints
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
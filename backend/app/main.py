@@ -1,14 +1,40 @@
-from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
 import os
-from fastapi.responses import FileResponse
 from controller.client_controller import router as client_router
 from controller.system_controller import router as system_router
 from controller.listing_controller import router as listing_router
 from controller.message_controller import router as message_router
 from fastapi.middleware.cors import CORSMiddleware
+from database import async_engine
+from service.images import derivatives
+from service.media import sweeper as media_sweeper
+from service.notifications import notification_writer
+from service.jobs import job_workers
+from service.mail import mailer
+from service.static_files import InMemoryPage, PrecompressedStaticFiles
+from service.uploads import CONTENT_ADDRESSED, UploadSizeLimitMiddleware
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # background workers that live as long as the app
+    media_sweeper.start()
+    # JOB_WORKERS=0 when `python -m service.job_worker worker` runs them instead
+    if job_workers.workers:
+        job_workers.start()
+    yield
+    media_sweeper.stop()
+    job_workers.stop()
+    mailer.stop()
+    # what is still buffered goes in before the engines are disposed
+    notification_writer.stop()
+    derivatives.shutdown()
+    await async_engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
+
+# cut off oversized multipart bodies before they are parsed
+app.add_middleware(UploadSizeLimitMiddleware)
 
 # Enable CORS
 app.add_middleware(
@@ -20,6 +46,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Routers
@@ -32,11 +59,17 @@ app.include_router(message_router, prefix="/api", tags=["message"])
 if not os.path.exists("uploads"):
     os.makedirs("uploads")
 uploads_path = os.path.join(os.path.dirname(__file__), "uploads")
-app.mount("/uploads", StaticFiles(directory=uploads_path), name="uploads")
+app.mount("/uploads", PrecompressedStaticFiles(directory=uploads_path, immutable=CONTENT_ADDRESSED, precompressed=False), name="uploads")
+
+# hashed vite bundles, precompressed by compress_static.py
+app.mount("/assets", PrecompressedStaticFiles(directory="static/assets", immutable=True), name="assets")
 
-app.mount("/assets", StaticFiles(directory="static/assets"), name="assets")
+index_page = InMemoryPage("static/index.html")
 
-# fallback
-@app.get("/{full_path:path}")
-async def frontend_fallback(full_path: str):
-    return FileResponse("static/index.html")
+# fallback, GET/HEAD only so a wrong method on an api route still gets the router's 405
+@app.api_route("/{full_path:path}", methods=["GET", "HEAD"])
+async def frontend_fallback(full_path: str, request: Request):
+    # a mistyped api call should fail loudly, not get the spa
+    if full_path == "api" or full_path.startswith("api/"):
+        raise HTTPException(status_code=404, detail="Not Found")
+    return index_page.response(request.headers)
@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Text, Enum, JSON, Float, Boolean, DateTime, create_engine
-from sqlalchemy.orm import relationship
+from sqlalchemy import DDL, Column, Integer, String, ForeignKey, Text, Enum, JSON, Float, Boolean, DateTime, Index, column, create_engine, event, table
+from sqlalchemy.orm import relationship, validates
 from database import Base
 from datetime import datetime
 import enum
@@ -29,6 +29,8 @@ class User(Base):
     pets = Column(JSON, nullable=True) 
 
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    # set when the account was deleted but its rows are still being purged in the background
+    deleted_at = Column(DateTime, nullable=True, index=True)
 
     # relationships
     listings = relationship("Listing", back_populates="owner")  
@@ -44,22 +46,166 @@ class Listing(Base):
     __tablename__ = "listings"
     
     listing_id = Column(Integer, primary_key=True, index=True)
-    owner_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    owner_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False, index=True)
     title = Column(String, nullable=False)
     description = Column(Text, nullable=False)
     price = Column(Float, nullable=False)
     isRental = Column(Boolean, nullable=False)
     location = Column(String, nullable=False)
+    # WGS84 degrees, given at creation or geocoded from `location` (service/geo.py), indexed in listings_geo
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
     images = Column(JSON, nullable=True)
     preferences = Column(JSON, nullable=True)
     created = Column(DateTime, default=datetime.utcnow, nullable=False)
     updated = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
     status = Column(Enum(ListingStatus), default=ListingStatus.active, nullable=False)
 
+    # indexed copies of the preference flags so search doesnt have to scan the JSON
+    # (kept in sync with `preferences` by _sync_preference_columns)
+    pref_smoking = Column(Boolean, nullable=True, index=True)
+    pref_pet_friendly = Column(Boolean, nullable=True, index=True)
+    pref_party_friendly = Column(Boolean, nullable=True, index=True)
+    pref_vegan = Column(Boolean, nullable=True, index=True)
+    pref_quiet_start = Column(String, nullable=True)
+    pref_quiet_end = Column(String, nullable=True)
+
+    # keyset pagination orders (newest / by price)
+    __table_args__ = (
+        Index("ix_listings_created_listing_id", "created", "listing_id"),
+        Index("ix_listings_price_listing_id", "price", "listing_id"),
+    )
+
     # Relationships
     owner = relationship("User", back_populates="listings")
     groups = relationship("Group", back_populates="listing")
     ratings = relationship("Rating", back_populates="listing")
+    languages = relationship("ListingLanguage", cascade="all, delete-orphan")
+    preferred_sexes = relationship("ListingPreferredSex", cascade="all, delete-orphan")
+
+    @validates("preferences")
+    def _sync_preference_columns(self, key, value):
+        for column, column_value in preference_columns(value).items():
+            setattr(self, column, column_value)
+        languages, sexes = preference_tags(value)
+        self.languages = [ListingLanguage(language=language) for language in languages]
+        self.preferred_sexes = [ListingPreferredSex(sex=sex) for sex in sexes]
+        return value
+
+# sqlite FTS5 index over title/description/location, an external content table
+# on top of listings that the triggers below keep in sync on every write
+LISTINGS_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts USING fts5(
+        title, description, location,
+        content='listings', content_rowid='listing_id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS listings_fts_insert AFTER INSERT ON listings BEGIN
+        INSERT INTO listings_fts(rowid, title, description, location)
+        VALUES (new.listing_id, new.title, new.description, new.location);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS listings_fts_delete AFTER DELETE ON listings BEGIN
+        INSERT INTO listings_fts(listings_fts, rowid, title, description, location)
+        VALUES ('delete', old.listing_id, old.title, old.description, old.location);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS listings_fts_update AFTER UPDATE OF title, description, location ON listings BEGIN
+        INSERT INTO listings_fts(listings_fts, rowid, title, description, location)
+        VALUES ('delete', old.listing_id, old.title, old.description, old.location);
+        INSERT INTO listings_fts(rowid, title, description, location)
+        VALUES (new.listing_id, new.title, new.description, new.location);
+    END""",
+]
+
+for statement in LISTINGS_FTS_DDL:
+    event.listen(Listing.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+# query-side handle on the virtual table (not part of the metadata, create_all must not touch it)
+listings_fts = table("listings_fts", column("rowid"), column("rank"), column("listings_fts"))
+
+# sqlite R*Tree over the listings' coordinates, every located listing is a point (a box with
+# min == max). The triggers keep it in sync, listings without coordinates aren't in it
+LISTINGS_GEO_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS listings_geo USING rtree(
+        listing_id, min_lat, max_lat, min_lon, max_lon
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS listings_geo_insert AFTER INSERT ON listings
+    WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL BEGIN
+        INSERT INTO listings_geo VALUES (new.listing_id, new.latitude, new.latitude, new.longitude, new.longitude);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS listings_geo_delete AFTER DELETE ON listings BEGIN
+        DELETE FROM listings_geo WHERE listing_id = old.listing_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS listings_geo_update AFTER UPDATE OF latitude, longitude ON listings BEGIN
+        DELETE FROM listings_geo WHERE listing_id = old.listing_id;
+        INSERT INTO listings_geo SELECT new.listing_id, new.latitude, new.latitude, new.longitude, new.longitude
+        WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL;
+    END""",
+]
+
+for statement in LISTINGS_GEO_DDL:
+    event.listen(Listing.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+listings_geo = table("listings_geo", column("listing_id"), column("min_lat"), column("max_lat"), column("min_lon"), column("max_lon"))
+
+# precomputed compatibility: the best flats for every user and the best tenants for every listing,
+# both kept to the top N by service/match_index.py
+class UserListingMatch(Base):
+    __tablename__ = "user_listing_matches"
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    listing_id = Column(Integer, ForeignKey("listings.listing_id", ondelete="CASCADE"), primary_key=True)
+    score = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index("ix_user_listing_matches_user_score", "user_id", "score"),
+        Index("ix_user_listing_matches_listing", "listing_id"),
+    )
+
+class ListingTenantMatch(Base):
+    __tablename__ = "listing_tenant_matches"
+    listing_id = Column(Integer, ForeignKey("listings.listing_id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    score = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index("ix_listing_tenant_matches_listing_score", "listing_id", "score"),
+        Index("ix_listing_tenant_matches_user", "user_id"),
+    )
+
+# one row per language spoken in a listing, searched by (language, listing_id)
+class ListingLanguage(Base):
+    __tablename__ = "listing_languages"
+    listing_id = Column(Integer, ForeignKey("listings.listing_id", ondelete="CASCADE"), primary_key=True)
+    language = Column(String, primary_key=True)
+
+    __table_args__ = (Index("ix_listing_languages_language", "language", "listing_id"),)
+
+# one row per preferred sex of the flat
+class ListingPreferredSex(Base):
+    __tablename__ = "listing_preferred_sexes"
+    listing_id = Column(Integer, ForeignKey("listings.listing_id", ondelete="CASCADE"), primary_key=True)
+    sex = Column(String, primary_key=True)
+
+    __table_args__ = (Index("ix_listing_preferred_sexes_sex", "sex", "listing_id"),)
+
+def preference_columns(preferences):
+    """Values of the indexed Listing.pref_* columns for a preferences dict."""
+    preferences = preferences or {}
+    quiet_hours = preferences.get("quiet_hours") or {}
+    return {
+        "pref_smoking": preferences.get("smoking"),
+        "pref_pet_friendly": preferences.get("pet_friendly"),
+        "pref_party_friendly": preferences.get("party_friendly"),
+        "pref_vegan": preferences.get("vegan"),
+        "pref_quiet_start": quiet_hours.get("start"),
+        "pref_quiet_end": quiet_hours.get("end"),
+    }
+
+def preference_tags(preferences):
+    """Normalized (languages, preferred sexes) for the listing side tables."""
+    preferences = preferences or {}
+    languages = {l.strip().lower() for l in preferences.get("language") or [] if l and l.strip()}
+    sexes = {s.strip().lower() for s in preferences.get("preferred_sex_of_the_flat") or [] if s and s.strip()}
+    return sorted(languages), sorted(sexes)
 
 class Group(Base):
     __tablename__ = "groups"
@@ -68,8 +214,8 @@ class Group(Base):
     description = Column(Text, nullable=False)
     lifestyle_preference = Column(JSON, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
-    listing_id = Column(Integer, ForeignKey("listings.listing_id"), nullable=False)
-    owner_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    listing_id = Column(Integer, ForeignKey("listings.listing_id", ondelete="CASCADE"), nullable=False, index=True)
+    owner_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False, index=True)
 
     # Relationships
     owner = relationship("User", back_populates="groups_owned")
@@ -80,8 +226,8 @@ class GroupMember(Base):
     __tablename__ = "group_members"
     group_member = Column(Integer, primary_key=True, index=True)
     joined_at = Column(DateTime, default=datetime.utcnow, nullable=False)
-    group_id = Column(Integer, ForeignKey("groups.group_id"), nullable=False)
-    user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    group_id = Column(Integer, ForeignKey("groups.group_id", ondelete="CASCADE"), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False, index=True)
     status = Column(String, default="pending")  # "pending" or "active"
 
     # Relationships
@@ -94,15 +240,41 @@ class Message(Base):
     message_id = Column(Integer, primary_key=True, index=True)
     content = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
-    sender_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    sender_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False)
+    # no cascade here, group messages keep the group id in this column
     recipient_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
     recipient_type_id = Column(Integer, ForeignKey("recipient_type.type_id"), nullable=False)
 
+    # one per side of a conversation, the message endpoints page through them newest first
+    __table_args__ = (
+        Index("ix_messages_sender_id_created_at", "sender_id", "created_at"),
+        Index("ix_messages_recipient_id_created_at", "recipient_id", "created_at"),
+        Index("ix_messages_recipient_type_id_recipient_id_created_at", "recipient_type_id", "recipient_id", "created_at"),
+    )
+
     # Relationships
     sender = relationship("User", foreign_keys=[sender_id], back_populates="messages_sent")
     recipient = relationship("User", foreign_keys=[recipient_id], back_populates="messages_received")
     recipient_type = relationship("RecipientType", back_populates="messages")
 
+# inbox: one row per user and peer (another user or a group), written together with every message
+class Conversation(Base):
+    __tablename__ = "conversations"
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    peer_type_id = Column(Integer, ForeignKey("recipient_type.type_id"), primary_key=True)  # same ids as messages
+    peer_id = Column(Integer, primary_key=True)  # user_id or group_id
+    # null once that message or its sender was deleted, the preview and time stay
+    last_message_id = Column(Integer, ForeignKey("messages.message_id", ondelete="SET NULL"), nullable=True)
+    last_sender_id = Column(Integer, ForeignKey("users.user_id", ondelete="SET NULL"), nullable=True, index=True)
+    last_message_preview = Column(String, nullable=False)
+    last_activity_at = Column(DateTime, nullable=False)
+    unread_count = Column(Integer, nullable=False, default=0, server_default="0")
+
+    __table_args__ = (
+        Index("ix_conversations_user_id_last_activity_at", "user_id", "last_activity_at"),
+        Index("ix_conversations_peer_type_id_peer_id", "peer_type_id", "peer_id"),
+    )
+
 class RecipientType(Base):
     __tablename__ = "recipient_type"
     type_id = Column(Integer, primary_key=True, index=True)
@@ -117,19 +289,26 @@ class Rating(Base):
     rating_value = Column(Integer, nullable=False)
     comment = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
-    user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
-    listing_id = Column(Integer, ForeignKey("listings.listing_id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False, index=True)
+    listing_id = Column(Integer, ForeignKey("listings.listing_id", ondelete="CASCADE"), nullable=False, index=True)
 
     # Relationships
     user = relationship("User", back_populates="ratings")
     listing = relationship("Listing", back_populates="ratings")
 
 class Media(Base):
+    # one row per stored blob (uploads/<ab>/<sha256>.ext), shared by every listing that uses the same image
     __tablename__ = "media"
     media_id = Column(Integer, primary_key=True, index=True)
-    url = Column(String, nullable=False)
-    user_id = Column(Integer, ForeignKey("users.user_id"), nullable=True)
-    listing_id = Column(Integer, ForeignKey("listings.listing_id"), nullable=True)
+    url = Column(String, nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="SET NULL"), nullable=True, index=True)  # first uploader
+    listing_id = Column(Integer, ForeignKey("listings.listing_id", ondelete="SET NULL"), nullable=True, index=True)
+    sha256 = Column(String(64), nullable=True, unique=True, index=True)
+    size = Column(Integer, nullable=True)
+    ref_count = Column(Integer, nullable=False, default=0, server_default="0")
+    orphaned_at = Column(DateTime, nullable=True, index=True)  # when ref_count dropped to 0
+    variants = Column(JSON(none_as_null=True), nullable=True)  # {"thumb": url, "medium": url}, see service/images.py
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=True)
     
     # Relationships
     user = relationship("User", back_populates="media")
@@ -139,10 +318,43 @@ class Notification(Base):
     __tablename__ = "notifications"
 
     notification_id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False)
     content = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     is_read = Column(Boolean, default=False, nullable=False)
 
     # Relationships
     user = relationship("User", back_populates="notifications")
+
+    # a user's notifications newest first, and the mark-read-up-to range
+    __table_args__ = (Index("ix_notifications_user_id_notification_id", "user_id", "notification_id"),)
+
+
+class NotificationCounter(Base):
+    # unread notifications per user, kept by service/notifications.py
+    __tablename__ = "notification_counters"
+
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    unread_count = Column(Integer, nullable=False, default=0, server_default="0")
+
+
+class Job(Base):
+    # background work queued by the request handlers, run by service/jobs.py
+    __tablename__ = "jobs"
+
+    job_id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)
+    payload = Column(JSON, nullable=True)
+    status = Column(String, nullable=False, default="queued")  # queued, running, done or failed
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    max_attempts = Column(Integer, nullable=False)
+    run_at = Column(DateTime, nullable=False, default=datetime.utcnow)  # not before, the backoff moves it
+    locked_by = Column(String, nullable=True)
+    locked_until = Column(DateTime, nullable=True)  # the lease, past it another worker may take the job over
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    # the claim query, oldest ready job first
+    __table_args__ = (Index("ix_jobs_status_run_at", "status", "run_at"),)
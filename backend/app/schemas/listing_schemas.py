@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Dict, Tuple, List, Optional
 
 class ListingUpdateRequest(BaseModel):
@@ -8,6 +8,9 @@ class ListingUpdateRequest(BaseModel):
     location: str
     isRental : bool
     status: Optional[str] = "active"
+    # both or neither, without them the location is geocoded again when it changes
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
 
 class ListingPreferences(BaseModel):
     language: Optional[List[str]]  # list of languages being spoken in the flat
@@ -27,6 +30,14 @@ class ListingCreate(BaseModel):
     isRental : bool
     status: Optional[str] = "active"
     preferences: Optional[ListingPreferences] 
+    # both or neither, geocoded from `location` when left out
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
+
+class ImageVariants(BaseModel):
+    original: str
+    thumb: str  # the original until the derivative has been rendered
+    medium: str
 
 class ListingResponse(BaseModel):
     listing_id: int
@@ -35,8 +46,11 @@ class ListingResponse(BaseModel):
     description: str
     price: float
     location: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
     isRental: bool
     images: Optional[List[str]]  
+    image_variants: List[ImageVariants] = []
     created: str 
     updated: Optional[str]  
     status: Optional[str] = "active"
@@ -45,6 +59,16 @@ class ListingResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class RecommendedListingResponse(ListingResponse):
+    score: float  # compatibility with the current user, 1.0 is a perfect match
+
+class TenantMatchResponse(BaseModel):
+    user_id: int
+    name: Optional[str]
+    surname: Optional[str]
+    username: str
+    score: float
+
 class GroupMemberResponse(BaseModel):
     user_id: int
     name: Optional[str]
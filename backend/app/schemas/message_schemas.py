@@ -6,3 +6,6 @@ class DirectMessageRequest(BaseModel):
 
 class GroupMessageRequest(BaseModel):
     content: str
+
+class MarkNotificationsReadRequest(BaseModel):
+    up_to_id: int  # newest notification_id to mark, older ones go with it
@@ -1,7 +1,8 @@
 import random
-from service.auth import get_password_hash
+from service.auth import pwd_context
 from dependencies import get_db
 from model.client_model import Listing, Group, User
+from service.geo import geocode
 from sqlalchemy.orm import Session
 from datetime import datetime
 
@@ -36,7 +37,7 @@ def seed_database():
         username="admin",
         email="admin@flatclub.com",
         phone_number="+000000000",
-        password=get_password_hash("admin123"), 
+        password=pwd_context.hash("admin123"), 
         role="admin"
     )
     db.add(admin)
@@ -49,7 +50,7 @@ def seed_database():
         username="anna.nowak",
         email="anna.nowak@example.com",
         phone_number="+48123123123",
-        password=get_password_hash("password"),
+        password=pwd_context.hash("password"),
         role="user",
     )
     db.add(user)
@@ -63,11 +64,17 @@ def seed_database():
         image_choices = [f"flat{n}.png" for n in random.sample(range(1, 7), k=random.randint(1, 3))]
         images = [f"uploads/{img}" for img in image_choices]
 
+        city = random.choice(cities)
+        latitude, longitude = geocode(city)
+
         listing = Listing(
             title=f"{random.choice(titles)} #{i+1}",
             description=f"A beautiful {random.choice(['sunny', 'quiet', 'central', 'modern'])} space perfect for {random.choice(['students', 'young professionals', 'internationals'])}.",
             price=random.randint(1500, 3500),
-            location=random.choice(cities),
+            location=city,
+            # somewhere in town, a few km around the centre
+            latitude=latitude + random.uniform(-0.03, 0.03),
+            longitude=longitude + random.uniform(-0.05, 0.05),
             isRental=bool(random.getrandbits(1)),
             owner_id=user.user_id,
             created=datetime.utcnow(),
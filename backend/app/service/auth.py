@@ -1,13 +1,19 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
 from fastapi import HTTPException, Depends
 from fastapi.security import OAuth2PasswordBearer
 
-from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 
 from model.client_model import User
 from sqlalchemy.orm import Session
 from dependencies import get_db
+from service import password_hashing
 
 
 # Secret key for JWT
@@ -15,19 +21,27 @@ SECRET_KEY = "your_secret_key"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 600
 
+# token -> principal cache, entries live until the token expires or PRINCIPAL_CACHE_TTL_SECONDS, whichever comes first
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+PRINCIPAL_CACHE_TTL_SECONDS = int(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "300"))
+
 # OAuth2 scheme for retrieving tokens
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/token")
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = password_hashing.pwd_context
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+# hashing runs on the bounded pool of service/password_hashing.py, these can raise HashingBusy (503)
+async def verify_password(plain_password, hashed_password):
+    return await password_hashing.verify_password(plain_password, hashed_password)
+
+async def verify_and_update_password(plain_password, hashed_password):
+    return await password_hashing.verify_and_update(plain_password, hashed_password)
 
 # def verify_password(plain_password: str, hashed_password: str) -> bool:
 #     return plain_password == hashed_password
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await password_hashing.hash_password(password)
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -35,23 +49,105 @@ def create_access_token(data: dict):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def decode_token(token: str) -> dict:
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        sub: str = payload.get("sub")
-        user = None
-        if sub.isdigit():  # new tokens with user_id
-            user_id = int(sub)
-            user = db.query(User).filter(User.user_id == user_id).first()
-        else:  # legacy tokens with email
-            email = sub
-            user = db.query(User).filter(User.email == email).first()
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
 
+def _user_for_sub(db: Session, sub: str) -> User:
+    if sub.isdigit():  # new tokens with user_id
+        user = db.query(User).filter(User.user_id == int(sub)).first()
+    else:  # legacy tokens with email
+        user = db.query(User).filter(User.email == sub).first()
+    # a deleted account still being purged is signed out already
+    if user is None or user.deleted_at is not None:
+        raise HTTPException(status_code=401, detail="User not found")
+    return user
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    return _user_for_sub(db, str(decode_token(token).get("sub") or ""))
+
+
+@dataclass(frozen=True)
+class Principal:
+    """What most endpoints need to know about the caller, without loading the User row."""
+    user_id: int
+    role: str
+    username: str
+
+
+class PrincipalCache:
+    """Thread safe LRU of token -> Principal with a deadline per entry."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # bumped by invalidate(), a lookup that started before it must not store what it read
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            principal, deadline = entry
+            if deadline <= time.time():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return principal
+
+    def generation(self, user_id: int) -> int:
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def put(self, token: str, principal: Principal, expires_at: float, generation: int):
+        with self._lock:
+            if self._generations.get(principal.user_id, 0) != generation:
+                return
+            self._entries[token] = (principal, min(expires_at, time.time() + self.ttl))
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            for token in [t for t, (principal, _) in self._entries.items() if principal.user_id == user_id]:
+                del self._entries[token]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL_SECONDS)
+
+
+def get_current_principal(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> Principal:
+    # the session is only opened on a miss, a hit costs neither a query nor a jwt decode
+    principal = principal_cache.get(token)
+    if principal is not None:
+        return principal
+    payload = decode_token(token)
+    sub = str(payload.get("sub") or "")
+    # taken before the read, an invalidate() while it runs keeps the result out of the cache
+    generation = principal_cache.generation(int(sub)) if sub.isdigit() else None
+    user = _user_for_sub(db, sub)
+    principal = Principal(user_id=user.user_id, role=user.role, username=user.username)
+    # legacy email tokens aren't cached, the user id is only known after the lookup
+    if generation is not None:
+        principal_cache.put(token, principal, payload.get("exp", 0), generation)
+    return principal
+
+
+def invalidate_principal(user_id: int):
+    """Drop cached principals of a user, call after changing or deleting them (post commit)."""
+    principal_cache.invalidate(user_id)
+
 def get_user_id(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -0,0 +1,104 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Hashable, Iterable, Optional, Tuple
+
+from fastapi import Request, Response
+
+LISTINGS_CACHE_SIZE = int(os.getenv("LISTINGS_CACHE_SIZE", "1024"))
+
+# bumped by every write to listings, cache keys embed it so a bump makes all older entries unreachable.
+# it lives in process memory, which matches the single uvicorn worker the app runs with.
+_listings_version = 0
+_users_version = 0
+_version_lock = threading.Lock()
+
+
+def listings_version() -> int:
+    return _listings_version
+
+
+def bump_listings_version():
+    global _listings_version
+    with _version_lock:
+        _listings_version += 1
+    listings_cache.clear()
+
+
+# same idea for user preferences, nothing caches rendered users but the compatibility matrices key on it
+def users_version() -> int:
+    return _users_version
+
+
+def bump_users_version():
+    global _users_version
+    with _version_lock:
+        _users_version += 1
+
+
+@dataclass
+class CachedResponse:
+    body: bytes
+    # the only validator: a row timestamp misses deletions and rendered variants
+    etag: str
+    headers: Dict[str, str] = field(default_factory=dict)
+
+
+class ResponseCache:
+    """Small thread safe LRU of rendered responses."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Hashable, entry: CachedResponse):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+listings_cache = ResponseCache(LISTINGS_CACHE_SIZE)
+
+
+def listings_etag(versions: Iterable[Tuple[int, datetime]], *extra) -> str:
+    """Strong ETag over (listing_id, updated) pairs plus anything else that shapes the body."""
+    digest = hashlib.sha1()
+    for listing_id, updated in versions:
+        digest.update(f"{listing_id}:{updated.isoformat() if updated else ''};".encode())
+    for part in extra:
+        digest.update(f"{part};".encode())
+    return f'"{digest.hexdigest()}"'
+
+
+def is_not_modified(request: Request, entry: CachedResponse) -> bool:
+    # no Last-Modified is sent, so If-Modified-Since alone never gets a 304
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or entry.etag in tags or f"W/{entry.etag}" in tags
+
+
+def cached_response(request: Request, entry: CachedResponse) -> Response:
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache", **entry.headers}
+    if is_not_modified(request, entry):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
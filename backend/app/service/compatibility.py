@@ -0,0 +1,259 @@
+"""Roommate compatibility scoring between user and listing preferences.
+
+Preferences are packed into a few flat NumPy arrays (one row per user or listing)
+so a whole catalog is scored against one person in a handful of vectorized ops:
+
+- flags      float32 (n, 4)  smoking / pet_friendly / party_friendly / vegan as +1 / -1, 0 when unknown
+- languages  uint64  (n,)    bitmask, a bit per language of LANGUAGES, the last one for any other language
+- sexes      uint8   (n,)    bitmask over male / female / non-binary / anything else
+- quiet      int16   (n,)    start of quiet hours in minutes after midnight, -1 when unknown
+
+Languages outside LANGUAGES all set the same bit, they are kept by name in
+other_languages and compared exactly for the rows that have that bit.
+"""
+import threading
+import time
+from dataclasses import dataclass
+from typing import Iterable, List, Optional
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from model.client_model import Listing, ListingLanguage, ListingPreferredSex, ListingStatus, User
+from service.cache import listings_version, users_version
+
+FLAGS = ("smoking", "pet_friendly", "party_friendly", "vegan")
+SEXES = ("male", "female", "non-binary")
+USER_SEX_KEY = "preferred_sex_to_live_with"
+LISTING_SEX_KEY = "preferred_sex_of_the_flat"
+
+# one bit each, in this order: the bits have to be the same for every matrix. new ones go at the end, at most 63
+LANGUAGES = (
+    "english", "polish", "german", "spanish", "french", "italian", "turkish", "ukrainian", "russian",
+    "portuguese", "dutch", "czech", "slovak", "hungarian", "romanian", "bulgarian", "greek", "swedish",
+    "norwegian", "danish", "finnish", "lithuanian", "latvian", "estonian", "croatian", "serbian", "slovenian",
+    "belarusian", "albanian", "macedonian", "bosnian", "georgian", "armenian", "azerbaijani", "kazakh",
+    "arabic", "hebrew", "persian", "hindi", "urdu", "bengali", "punjabi", "tamil", "chinese", "mandarin",
+    "cantonese", "japanese", "korean", "vietnamese", "thai", "indonesian", "malay", "filipino", "swahili",
+    "amharic", "catalan", "basque", "galician", "irish", "welsh", "icelandic", "maltese", "luxembourgish",
+)
+LANGUAGE_BITS = {language: 1 << index for index, language in enumerate(LANGUAGES)}
+OTHER_LANGUAGE = np.uint64(1 << 63)
+KNOWN_LANGUAGES = np.uint64((1 << len(LANGUAGES)) - 1)
+
+# how much each kind of agreement is worth, a perfect match scores 1.0
+FLAG_WEIGHT = 0.5
+LANGUAGE_WEIGHT = 0.2
+SEX_WEIGHT = 0.2
+QUIET_WEIGHT = 0.1
+
+# an outdated matrix is served for at most this long while listings or users keep changing
+MATRIX_MAX_STALENESS_SECONDS = 5.0
+
+
+@dataclass
+class PreferenceMatrix:
+    ids: np.ndarray
+    flags: np.ndarray
+    languages: np.ndarray
+    sexes: np.ndarray
+    quiet: np.ndarray
+    # frozenset of the languages outside LANGUAGES per row, None when no row has any
+    other_languages: Optional[np.ndarray] = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, index: int) -> "PreferenceMatrix":
+        other = None if self.other_languages is None else self.other_languages[index:index + 1]
+        return PreferenceMatrix(*(a[index:index + 1] for a in (self.ids, self.flags, self.languages, self.sexes, self.quiet)), other)
+
+
+def language_bit(language: str) -> int:
+    return LANGUAGE_BITS.get(language.strip().lower(), int(OTHER_LANGUAGE))
+
+
+def sex_bit(sex: str) -> int:
+    sex = sex.strip().lower()
+    return 1 << (SEXES.index(sex) if sex in SEXES else len(SEXES))
+
+
+def quiet_minutes(value: Optional[str]) -> int:
+    try:
+        hours, minutes = value.split(":")
+        return (int(hours) * 60 + int(minutes)) % 1440
+    except (AttributeError, ValueError):
+        return -1
+
+
+def encode_preferences(ids: Iterable[int], preferences: Iterable[Optional[dict]], sex_key: str) -> PreferenceMatrix:
+    """Encode raw preference dicts (UserPreferences / ListingPreferences shaped)."""
+    ids, preferences = list(ids), [p or {} for p in preferences]
+    flags = np.array(
+        [[_sign(p.get(flag)) for flag in FLAGS] for p in preferences], dtype=np.float32
+    ).reshape(len(preferences), len(FLAGS))
+    languages = np.array(
+        [_mask(language_bit, p.get("language")) for p in preferences], dtype=np.uint64
+    )
+    sexes = np.array([_mask(sex_bit, p.get(sex_key)) for p in preferences], dtype=np.uint8)
+    quiet = np.array([quiet_minutes((p.get("quiet_hours") or {}).get("start")) for p in preferences], dtype=np.int16)
+    other = _other_languages(len(preferences), (
+        (index, language) for index, p in enumerate(preferences) for language in p.get("language") or [] if language
+    ))
+    return PreferenceMatrix(np.array(ids, dtype=np.int64), flags, languages, sexes, quiet, other)
+
+
+def score(candidates: PreferenceMatrix, person: PreferenceMatrix) -> np.ndarray:
+    """Compatibility of every row in `candidates` with the single row in `person`, in [-0.5, 1]."""
+    flag_agreement = candidates.flags @ person.flags[0] / len(FLAGS)
+
+    shared_language = (candidates.languages & person.languages[0] & KNOWN_LANGUAGES) != 0
+    if person.languages[0] & OTHER_LANGUAGE:
+        # languages outside LANGUAGES share a bit, the few rows with it are compared by name
+        mine = person.other_languages[0]
+        for index in np.flatnonzero((candidates.languages & OTHER_LANGUAGE) != 0):
+            shared_language[index] |= bool(mine & candidates.other_languages[index])
+    shared_sex = (candidates.sexes & person.sexes[0]) != 0
+
+    quiet_similarity = np.zeros(len(candidates), dtype=np.float32)
+    if person.quiet[0] >= 0:
+        known = candidates.quiet >= 0
+        distance = np.abs(candidates.quiet.astype(np.int32) - int(person.quiet[0]))
+        distance = np.minimum(distance, 1440 - distance)
+        quiet_similarity = np.where(known, 1.0 - distance / 720.0, 0.0).astype(np.float32)
+
+    return (
+        FLAG_WEIGHT * flag_agreement
+        + LANGUAGE_WEIGHT * shared_language
+        + SEX_WEIGHT * shared_sex
+        + QUIET_WEIGHT * quiet_similarity
+    ).astype(np.float32)
+
+
+def top_k(scores: np.ndarray, k: int, exclude: Optional[np.ndarray] = None) -> np.ndarray:
+    """Indices of the k best scores, best first, without sorting the whole array."""
+    if exclude is not None and exclude.any():
+        scores = np.where(exclude, -np.inf, scores)
+    k = min(k, int(np.isfinite(scores).sum()))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best], kind="stable")]
+
+
+def load_listing_matrix(db: Session) -> "tuple[PreferenceMatrix, np.ndarray]":
+    """Build the matrix of all active listings from the indexed pref_* columns and side tables.
+
+    Returns the matrix and the owner id of every row.
+    """
+    rows = (
+        db.query(
+            Listing.listing_id, Listing.owner_id, Listing.pref_smoking, Listing.pref_pet_friendly,
+            Listing.pref_party_friendly, Listing.pref_vegan, Listing.pref_quiet_start,
+        )
+        .filter(Listing.status == ListingStatus.active)
+        .order_by(Listing.listing_id)
+        .all()
+    )
+    count = len(rows)
+    ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=count)
+    owners = np.fromiter((r[1] for r in rows), dtype=np.int64, count=count)
+    flags = np.array([[_sign(v) for v in r[2:6]] for r in rows], dtype=np.float32).reshape(count, len(FLAGS))
+    quiet = np.fromiter((quiet_minutes(r[6]) for r in rows), dtype=np.int16, count=count)
+
+    languages = np.zeros(count, dtype=np.uint64)
+    tag_rows = db.query(ListingLanguage.listing_id, ListingLanguage.language).all()
+    _or_into(languages, ids, tag_rows, language_bit)
+    other = None
+    unknown = [(listing_id, language) for listing_id, language in tag_rows if language not in LANGUAGE_BITS]
+    if unknown:
+        positions = np.searchsorted(ids, [listing_id for listing_id, _ in unknown]).tolist()
+        other = _other_languages(count, (
+            (position, language)
+            for position, (listing_id, language) in zip(positions, unknown)
+            # tags of archived / deleted listings, not in ids
+            if position < count and ids[position] == listing_id
+        ))
+    sexes = np.zeros(count, dtype=np.uint8)
+    tag_rows = db.query(ListingPreferredSex.listing_id, ListingPreferredSex.sex).all()
+    _or_into(sexes, ids, tag_rows, sex_bit)
+
+    return PreferenceMatrix(ids, flags, languages, sexes, quiet, other), owners
+
+
+def load_user_matrix(db: Session) -> PreferenceMatrix:
+    """Build the matrix of every user that filled in preferences."""
+    rows = [
+        (user_id, preference)
+        for user_id, preference in db.query(User.user_id, User.preference).order_by(User.user_id)
+        if preference
+    ]
+    return encode_preferences((r[0] for r in rows), (r[1] for r in rows), USER_SEX_KEY)
+
+
+class MatrixCache:
+    """Keeps an encoded matrix in memory between requests.
+
+    Rebuilt when `version()` moves on, but not more often than every
+    MATRIX_MAX_STALENESS_SECONDS so a busy write load doesn't rebuild it per request.
+    """
+
+    def __init__(self, load, version):
+        self._load = load
+        self._current_version = version
+        self._lock = threading.Lock()
+        self._version = None
+        self._built_at = 0.0
+        self._value = None
+
+    def get(self, db: Session):
+        version = self._current_version()
+        with self._lock:
+            fresh = self._version == version or time.monotonic() - self._built_at < MATRIX_MAX_STALENESS_SECONDS
+            if self._value is None or not fresh:
+                self._value = self._load(db)
+                self._version, self._built_at = version, time.monotonic()
+            return self._value
+
+
+listing_matrix_cache = MatrixCache(load_listing_matrix, listings_version)
+user_matrix_cache = MatrixCache(load_user_matrix, users_version)
+
+
+def _sign(value) -> float:
+    return 0.0 if value is None else (1.0 if value else -1.0)
+
+
+def _mask(bit_of, values: Optional[List[str]]) -> int:
+    mask = 0
+    for value in values or []:
+        if value and value.strip():
+            mask |= bit_of(value)
+    return mask
+
+
+def _other_languages(count: int, languages) -> Optional[np.ndarray]:
+    """Object array with the frozenset of languages outside LANGUAGES of every row, from (row, language) pairs."""
+    by_row = {}
+    for index, language in languages:
+        language = language.strip().lower()
+        if language and language not in LANGUAGE_BITS:
+            by_row.setdefault(index, set()).add(language)
+    if not by_row:
+        return None
+    other = np.full(count, frozenset(), dtype=object)
+    for index, names in by_row.items():
+        other[index] = frozenset(names)
+    return other
+
+
+def _or_into(target: np.ndarray, ids: np.ndarray, tag_rows, bit_of):
+    if not tag_rows:
+        return
+    tag_ids = np.fromiter((r[0] for r in tag_rows), dtype=np.int64, count=len(tag_rows))
+    tag_bits = np.fromiter((bit_of(r[1]) for r in tag_rows), dtype=target.dtype, count=len(tag_rows))
+    # ids is sorted, rows of archived / deleted listings fall outside it and are dropped
+    positions = np.searchsorted(ids, tag_ids)
+    valid = positions < len(ids)
+    valid[valid] = ids[positions[valid]] == tag_ids[valid]
+    np.bitwise_or.at(target, positions[valid], tag_bits[valid])
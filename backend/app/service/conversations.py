@@ -0,0 +1,76 @@
+"""Inbox rows kept up to date by the message endpoints.
+
+A Conversation row per user and peer holds the last message, its time and how many
+messages the user hasn't read, so the inbox is one indexed read of the user's own
+rows instead of grouping their whole history. Rows are upserted in the same
+transaction as the message itself, never by a background job.
+"""
+from datetime import datetime
+from typing import Iterable
+
+from sqlalchemy.orm import Session
+
+from database import dialect_insert
+from model.client_model import Conversation, Message
+
+# recipient_type ids, shared with messages.recipient_type_id
+GROUP = 1
+DIRECT = 2
+PEER_TYPES = {"group": GROUP, "direct": DIRECT}
+PEER_TYPE_NAMES = {type_id: name for name, type_id in PEER_TYPES.items()}
+
+CONVERSATION_PREVIEW_LENGTH = 120
+
+
+def record_direct_message(db: Session, message: Message):
+    """Upsert both sides of a direct message, after it was flushed. Does not commit."""
+    rows = [_row(message.sender_id, DIRECT, message.recipient_id, message, unread=0)]
+    if message.recipient_id != message.sender_id:
+        rows.append(_row(message.recipient_id, DIRECT, message.sender_id, message, unread=1))
+    _upsert(db, rows)
+
+
+def record_group_message(db: Session, message: Message, member_ids: Iterable[int]):
+    """Upsert the group's row of every member, unread for all but the sender. Does not commit."""
+    _upsert(db, [
+        _row(user_id, GROUP, message.recipient_id, message, unread=0 if user_id == message.sender_id else 1)
+        for user_id in set(member_ids) | {message.sender_id}
+    ])
+
+
+def mark_read(db: Session, user_id: int, peer_type_id: int, peer_id: int) -> bool:
+    """Reset the unread count, False when there is no such conversation. Does not commit."""
+    updated = db.query(Conversation).filter(
+        Conversation.user_id == user_id,
+        Conversation.peer_type_id == peer_type_id,
+        Conversation.peer_id == peer_id,
+    ).update({Conversation.unread_count: 0}, synchronize_session=False)
+    return updated > 0
+
+
+def _row(user_id: int, peer_type_id: int, peer_id: int, message: Message, unread: int) -> dict:
+    return {
+        "user_id": user_id,
+        "peer_type_id": peer_type_id,
+        "peer_id": peer_id,
+        "last_message_id": message.message_id,
+        "last_sender_id": message.sender_id,
+        "last_message_preview": message.content[:CONVERSATION_PREVIEW_LENGTH],
+        "last_activity_at": message.created_at or datetime.utcnow(),
+        "unread_count": unread,
+    }
+
+
+def _upsert(db: Session, rows):
+    insert = dialect_insert(db)
+    statement = insert(Conversation).values(rows)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[Conversation.user_id, Conversation.peer_type_id, Conversation.peer_id],
+        set_={
+            "last_message_id": statement.excluded.last_message_id,
+            "last_sender_id": statement.excluded.last_sender_id,
+            "last_message_preview": statement.excluded.last_message_preview,
+            "last_activity_at": statement.excluded.last_activity_at,
+            "unread_count": Conversation.unread_count + statement.excluded.unread_count,
+        },
+    ))
@@ -0,0 +1,195 @@
+"""Listing coordinates: offline geocoding and radius search.
+
+Listings carry latitude/longitude, given at creation or looked up here from
+the free-text location in gazetteer.csv (cities, with their usual spellings
+and the names without diacritics). Nothing goes over the network, a location
+the gazetteer doesn't know simply stays without coordinates and out of radius
+searches.
+
+A radius search is two steps. The listings_geo R*Tree (sqlite) returns the
+points inside the bounding box of the circle, an index lookup whatever the
+size of the table, then haversine_km() (a python function registered on every
+sqlite connection by database.py) drops the corners of the box. Points in
+the square inscribed in the circle are kept without calling it.
+
+Existing listings get their coordinates with
+
+    PYTHONPATH=app python -m service.geo backfill
+
+(a running app keeps serving its cached listing pages without them until the
+next listing change).
+"""
+import argparse
+import csv
+import logging
+import math
+import os
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from model.client_model import Listing, listings_geo
+from service.write_queue import run_write
+
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", os.path.join(os.path.dirname(__file__), "gazetteer.csv"))
+MAX_RADIUS_KM = float(os.getenv("MAX_RADIUS_KM", "500"))
+
+EARTH_RADIUS_KM = 6371.0088
+
+# letters NFKD doesn't take apart
+_FOLD = str.maketrans({"ł": "l", "Ł": "L", "ø": "o", "Ø": "O", "đ": "d", "Đ": "D", "æ": "ae", "ß": "ss", "ı": "i"})
+_SEPARATORS = re.compile(r"[^\w]+", re.UNICODE)
+
+Point = Tuple[float, float]
+
+
+def normalize(name: str) -> str:
+    """Lowercase, without diacritics and punctuation: "Bielsko-Biała" -> "bielsko biala"."""
+    decomposed = unicodedata.normalize("NFKD", name.translate(_FOLD))
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return _SEPARATORS.sub(" ", stripped.lower()).strip()
+
+
+@lru_cache(maxsize=1)
+def gazetteer() -> Dict[str, Point]:
+    """Normalized place name (and alias) -> (latitude, longitude), read once."""
+    places = {}
+    with open(GAZETTEER_PATH, encoding="utf-8", newline="") as file:
+        for row in csv.DictReader(file):
+            point = (float(row["latitude"]), float(row["longitude"]))
+            for name in [row["name"], *filter(None, (row["aliases"] or "").split("|"))]:
+                places.setdefault(normalize(name), point)
+    return places
+
+
+@lru_cache(maxsize=4096)
+def geocode(location: Optional[str]) -> Optional[Point]:
+    """Coordinates of a free-text location, None when no place in it is known.
+
+    Every comma separated part is tried in order, each with its trailing words
+    dropped one by one, so "Kraków, Poland" and "Krakow Kazimierz" both find Kraków.
+    """
+    places = gazetteer()
+    for part in (location or "").split(","):
+        words = normalize(part).split()
+        for end in range(len(words), 0, -1):
+            point = places.get(" ".join(words[:end]))
+            if point is not None:
+                return point
+    return None
+
+
+def coordinates(location: str, latitude: Optional[float] = None, longitude: Optional[float] = None) -> Point:
+    """The coordinates a listing is stored with, the given ones or else the geocoded location."""
+    if latitude is not None and longitude is not None:
+        return latitude, longitude
+    return geocode(location) or (None, None)
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in km, None (NULL) when a coordinate is missing."""
+    if lat1 is None or lon1 is None or lat2 is None or lon2 is None:
+        return None
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(latitude: float, longitude: float, radius_km: float) -> Tuple[float, float, float, float]:
+    """(min_lat, max_lat, min_lon, max_lon) of the circle, the whole longitude range when it wraps."""
+    angle = radius_km / EARTH_RADIUS_KM
+    min_lat = latitude - math.degrees(angle)
+    max_lat = latitude + math.degrees(angle)
+    if min_lat <= -90 or max_lat >= 90:
+        # a pole is inside the circle, every longitude is
+        return max(min_lat, -90.0), min(max_lat, 90.0), -180.0, 180.0
+    # widest point of the circle, where a meridian touches it (wider than at its own latitude)
+    spread = math.sin(angle) / math.cos(math.radians(latitude))
+    if spread >= 1:
+        return min_lat, max_lat, -180.0, 180.0
+    delta = math.degrees(math.asin(spread))
+    min_lon, max_lon = longitude - delta, longitude + delta
+    if min_lon < -180 or max_lon > 180:
+        # crosses the antimeridian, one box over every longitude instead of two
+        return min_lat, max_lat, -180.0, 180.0
+    return min_lat, max_lat, min_lon, max_lon
+
+
+def inner_box(latitude: float, longitude: float, radius_km: float) -> Tuple[float, float, float, float]:
+    """(min_lat, max_lat, min_lon, max_lon) of a box entirely inside the circle, no distance to check in it.
+
+    From the haversine formula, hav(d) = hav(dlat) + cos(lat1) cos(lat2) hav(dlon):
+    with each term at most hav(radius) / 2 the point is within the radius.
+    """
+    half = math.sin(radius_km / EARTH_RADIUS_KM / 2) ** 2 / 2
+    dlat = 2 * math.asin(math.sqrt(half))
+    lat = math.radians(latitude)
+    # the largest cos(lat2) in the box, at the latitude closest to the equator
+    nearest = 0.0 if abs(lat) <= dlat else abs(lat) - dlat
+    widest = math.cos(lat) * math.cos(nearest)
+    if widest <= 0:
+        return latitude, latitude, longitude, longitude
+    dlon = 2 * math.asin(min(1.0, math.sqrt(half / widest)))
+    dlat, dlon = math.degrees(dlat), math.degrees(dlon)
+    return latitude - dlat, latitude + dlat, longitude - dlon, longitude + dlon
+
+
+def within_radius(latitude: float, longitude: float, radius_km: float) -> List:
+    """Filters for the listings at most `radius_km` from the point: the R*Tree box, then the exact distance."""
+    min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_km)
+    # overlap rather than containment, the tree stores 32 bit floats rounded outwards
+    in_box = select(listings_geo.c.listing_id).where(
+        listings_geo.c.max_lat >= min_lat,
+        listings_geo.c.min_lat <= max_lat,
+        listings_geo.c.max_lon >= min_lon,
+        listings_geo.c.min_lon <= max_lon,
+    )
+    inner_min_lat, inner_max_lat, inner_min_lon, inner_max_lon = inner_box(latitude, longitude, radius_km)
+    return [
+        Listing.listing_id.in_(in_box),
+        # most of the circle is the inner box, a comparison instead of a python call per row
+        or_(
+            and_(Listing.latitude.between(inner_min_lat, inner_max_lat),
+                 Listing.longitude.between(inner_min_lon, inner_max_lon)),
+            func.haversine_km(Listing.latitude, Listing.longitude, latitude, longitude) <= radius_km,
+        ),
+    ]
+
+
+def backfill(db: Session) -> int:
+    """Geocode every listing without coordinates, one update per distinct location. Returns the listings located."""
+    locations = db.scalars(
+        select(Listing.location).where(Listing.latitude.is_(None)).distinct()
+    ).all()
+    located = 0
+    for location in locations:
+        point = geocode(location)
+        if point is None:
+            continue
+
+        def job(db: Session):
+            return db.query(Listing).filter(Listing.location == location, Listing.latitude.is_(None)).update(
+                {Listing.latitude: point[0], Listing.longitude: point[1]}, synchronize_session=False
+            )
+
+        located += run_write(db, job)
+    return located
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["backfill"])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    session = SessionLocal()
+    try:
+        located = backfill(session)
+    finally:
+        session.close()
+    print(f"located {located} listings")
@@ -0,0 +1,206 @@
+"""Thumbnail and medium WebP derivatives of uploaded listing images.
+
+Derivatives are rendered in a process pool by an image_variants job that
+create_listing queues with the listing (service/jobs.py), so no request waits on
+image encoding and a restart doesn't lose them. They sit next to their original,
+uploads/<ab>/<sha256>.thumb.webp and .medium.webp, and are recorded in
+Media.variants. Until then (and for images from before content addressing) the
+original url is served in their place. Blobs that have no derivatives yet:
+
+    PYTHONPATH=app python -m service.images backfill
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List
+
+from PIL import Image, ImageOps
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from model.client_model import Media
+from service.cache import bump_listings_version
+from service.jobs import enqueue, handler
+from service.uploads import TMP_DIR, blob_path, sha256_of
+
+logger = logging.getLogger(__name__)
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+# variant name -> (longest side in px, webp quality)
+VARIANTS = {
+    "thumb": (320, 75),
+    "medium": (1024, 80),
+}
+
+
+def render_variants(url: str) -> Dict[str, str]:
+    """Write every variant of the blob at `url`, returns {variant: url}. Runs in a pool worker."""
+    stem = url.rsplit(".", 1)[0] if "." in url.rsplit("/", 1)[-1] else url
+    with Image.open(blob_path(url)) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ("RGB", "RGBA"):
+            original = original.convert("RGBA" if "transparency" in original.info else "RGB")
+        variants = {}
+        for name, (size, quality) in VARIANTS.items():
+            image = original.copy()
+            image.thumbnail((size, size), Image.LANCZOS)
+            variant_url = f"{stem}.{name}.webp"
+            partial = os.path.join(TMP_DIR, f"{uuid.uuid4().hex}.part")
+            image.save(partial, "WEBP", quality=quality, method=4)
+            os.replace(partial, blob_path(variant_url))
+            variants[name] = variant_url
+    return variants
+
+
+class DerivativePool:
+    """Lazily started process pool that renders variants and stores the result in Media."""
+
+    def __init__(self, workers: int = IMAGE_WORKERS):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    def submit(self, sha256: str, url: str):
+        with self._lock:
+            if sha256 in self._pending:
+                return
+            self._pending.add(sha256)
+            future = self._pool().submit(render_variants, url)
+        future.add_done_callback(lambda f: self._store(sha256, f))
+
+    def render(self, sha256: str, url: str):
+        """Render and store the variants, blocking. Raises BrokenProcessPool when a worker died."""
+        with self._lock:
+            future = self._pool().submit(render_variants, url)
+        self._store(sha256, future, reraise=True)
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn, forking a server that already runs threads is asking for deadlocks
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def _store(self, sha256: str, future, reraise: bool = False):
+        with self._lock:
+            self._pending.discard(sha256)
+        if future.cancelled():
+            return
+        try:
+            variants = future.result()
+        except BrokenProcessPool:
+            # a worker died (oom, killed), start a fresh pool next time and leave the blob for a retry
+            logger.exception("Image pool broke while rendering %s", sha256)
+            with self._lock:
+                executor, self._executor = self._executor, None
+            if executor is not None:
+                executor.shutdown(wait=False)
+            if reraise:
+                raise
+            return
+        except Exception as exc:
+            # not an image pillow can read, remember that so it isn't retried on every upload
+            logger.warning("No variants for %s: %s", sha256, exc)
+            variants = {}
+        db = SessionLocal()
+        try:
+            db.query(Media).filter(Media.sha256 == sha256).update({Media.variants: variants}, synchronize_session=False)
+            db.commit()
+        except Exception:
+            logger.exception("Storing variants of %s failed", sha256)
+            db.rollback()
+            if reraise:
+                raise
+        finally:
+            db.close()
+        # cached listing responses still point at the original
+        bump_listings_version()
+
+    def shutdown(self, wait: bool = False):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+derivatives = DerivativePool()
+
+
+def schedule_variants(db: Session, shas: List[str]):
+    """Render the given blobs that don't have variants yet on the pool, for the backfill."""
+    for sha256, url in db.query(Media.sha256, Media.url).filter(Media.sha256.in_(set(shas)), Media.variants.is_(None)):
+        derivatives.submit(sha256, url)
+
+
+def enqueue_variants(db: Session, shas: List[str]):
+    """Queue an image_variants job per blob without variants, in the caller's transaction. Does not commit."""
+    for sha256, in db.query(Media.sha256).filter(Media.sha256.in_(set(shas)), Media.variants.is_(None)):
+        enqueue(db, "image_variants", {"sha256": sha256})
+
+
+@handler("image_variants")
+def render_variants_job(payload: dict):
+    db = SessionLocal()
+    try:
+        media = db.query(Media.url, Media.variants).filter(Media.sha256 == payload["sha256"]).first()
+    finally:
+        db.close()
+    # gone, or rendered by an earlier attempt or the backfill
+    if media is None or media.variants is not None:
+        return
+    derivatives.render(payload["sha256"], media.url)
+
+
+def with_image_variants(db: Session, listings):
+    """Set `image_variants` on every listing: one {original, thumb, medium} per image."""
+    shas = _image_shas(listings)
+    variants = dict(db.execute(_variants_statement(shas)).all()) if shas else {}
+    return _attach_variants(listings, variants)
+
+
+async def with_image_variants_async(db: AsyncSession, listings):
+    shas = _image_shas(listings)
+    variants = dict((await db.execute(_variants_statement(shas))).all()) if shas else {}
+    return _attach_variants(listings, variants)
+
+
+def _image_shas(listings):
+    # keyed by content hash, a listing's url may carry another extension than the Media row's
+    return {sha for listing in listings for sha in map(sha256_of, listing.images or []) if sha}
+
+
+def _variants_statement(shas):
+    return select(Media.sha256, Media.variants).where(Media.sha256.in_(shas))
+
+
+def _attach_variants(listings, variants):
+    for listing in listings:
+        listing.image_variants = [
+            {"original": url, **{name: (variants.get(sha256_of(url)) or {}).get(name, url) for name in VARIANTS}}
+            for url in listing.images or []
+        ]
+    return listings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["backfill"])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    session = SessionLocal()
+    try:
+        missing = session.query(Media.sha256).filter(Media.variants.is_(None), Media.ref_count > 0).all()
+        schedule_variants(session, [sha for (sha,) in missing])
+    finally:
+        session.close()
+    derivatives.shutdown(wait=True)
+    print(f"rendered variants of {len(missing)} images")
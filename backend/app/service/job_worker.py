@@ -0,0 +1,37 @@
+"""Job workers as a process of their own, and the queue stats.
+
+    PYTHONPATH=app python -m service.job_worker worker --workers 4
+    PYTHONPATH=app python -m service.job_worker stats
+
+Not in service/jobs.py itself: run with -m that module would be __main__, and the
+handlers would register on the real service.jobs registry the workers don't read.
+"""
+import argparse
+import logging
+import time
+
+from database import SessionLocal
+from service.jobs import JOB_WORKERS, JobWorkers, queue_stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["worker", "stats"])
+    parser.add_argument("--workers", type=int, default=max(JOB_WORKERS, 1), help="worker threads")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "stats":
+        session = SessionLocal()
+        try:
+            print(queue_stats(session))
+        finally:
+            session.close()
+    else:
+        pool = JobWorkers(args.workers)
+        pool.start()
+        print(f"{args.workers} job workers running, ctrl-c to stop")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pool.stop(wait=True)
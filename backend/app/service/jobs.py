@@ -0,0 +1,274 @@
+"""Durable background jobs, queued in the jobs table of the app database.
+
+Request handlers enqueue() a row inside their own write transaction, so the job
+exists exactly when the change that asked for it was committed, and return
+right away. Workers claim ready jobs with a lease (status running, locked_until).
+A job whose worker died is claimed again once its lease ran out. A job that
+raises is retried after an exponential backoff until its max_attempts, then
+stays failed with its last error.
+
+Workers run as JOB_WORKERS threads of the app process, or separately:
+
+    PYTHONPATH=app python -m service.job_worker worker --workers 4
+
+(with JOB_WORKERS=0 for the app then). A separate worker can't bump the app's
+in-process caches, cached listing responses then show the original images
+until the next listing change. Handlers are plain functions taking the
+payload, registered with @handler("kind") in the module that owns the work. They
+must be idempotent, a job can run more than once (lease ran out, crash right
+before the job was marked done).
+"""
+import importlib
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import and_, delete, event, func, or_, select, update
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from model.client_model import Job
+from service.write_queue import run_write
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "1"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "600"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_BACKOFF_SECONDS = float(os.getenv("JOB_BACKOFF_SECONDS", "5"))
+JOB_BACKOFF_MAX_SECONDS = float(os.getenv("JOB_BACKOFF_MAX_SECONDS", "3600"))
+# finished jobs are kept this long for the stats, failed ones until someone looks at them
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(24 * 3600)))
+JOB_STATS_WINDOW_SECONDS = int(os.getenv("JOB_STATS_WINDOW_SECONDS", "900"))
+
+# modules whose @handler registrations a worker needs
+JOB_MODULES = ("service.images", "service.mail", "service.purge")
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+@dataclass(frozen=True)
+class Handler:
+    run: Callable[[dict], None]
+    max_attempts: int
+
+
+handlers: Dict[str, Handler] = {}
+
+
+def handler(kind: str, max_attempts: int = JOB_MAX_ATTEMPTS):
+    """Register the decorated function as the handler of `kind` jobs."""
+    def register(fn):
+        handlers[kind] = Handler(fn, max_attempts)
+        return fn
+    return register
+
+
+def load_handlers():
+    for module in JOB_MODULES:
+        importlib.import_module(module)
+
+
+def enqueue(db: Session, kind: str, payload: Optional[dict] = None, delay: float = 0):
+    """Queue a job in the caller's transaction. Does not commit."""
+    spec = handlers.get(kind)
+    now = datetime.utcnow()
+    db.add(Job(
+        kind=kind,
+        payload=payload,
+        status=QUEUED,
+        attempts=0,
+        max_attempts=spec.max_attempts if spec else JOB_MAX_ATTEMPTS,
+        run_at=now + timedelta(seconds=delay),
+        created_at=now,
+    ))
+    # in-process workers pick it up right after the commit instead of at their next poll
+    if not delay:
+        event.listen(db, "after_commit", lambda session: job_workers.wake(), once=True)
+
+
+def _claimable(now: datetime):
+    return or_(
+        and_(Job.status == QUEUED, Job.run_at <= now),
+        # the worker holding it is gone
+        and_(Job.status == RUNNING, Job.locked_until < now, Job.attempts < Job.max_attempts),
+    )
+
+
+def claim(worker_id: str, lease_seconds: int = JOB_LEASE_SECONDS) -> Optional[Job]:
+    """Take the oldest ready job, None when there is nothing to do."""
+    now = datetime.utcnow()
+    db = SessionLocal()
+    try:
+        # a read first, so idle workers don't take the write lock every poll
+        if db.scalar(select(Job.job_id).where(_claimable(now)).limit(1)) is None:
+            return None
+
+        def take(db: Session):
+            # skip locked: concurrent postgres workers take different rows instead of queueing on one
+            candidate = (
+                select(Job.job_id).where(_claimable(now)).order_by(Job.run_at, Job.job_id)
+                .limit(1).with_for_update(skip_locked=True).scalar_subquery()
+            )
+            # the condition again, on sqlite another worker may have taken it since the read
+            return db.execute(
+                update(Job).where(Job.job_id == candidate, _claimable(now)).values(
+                    status=RUNNING,
+                    attempts=Job.attempts + 1,
+                    locked_by=worker_id,
+                    locked_until=now + timedelta(seconds=lease_seconds),
+                    started_at=now,
+                ).returning(Job.job_id, Job.kind, Job.payload, Job.attempts, Job.max_attempts)
+            ).first()
+
+        return run_write(db, take)
+    finally:
+        db.close()
+
+
+def finish(job_id: int, worker_id: str, error: Optional[str] = None, attempts: int = 0, max_attempts: int = 0):
+    """Mark the job done, or queue it again after the backoff (failed once out of attempts)."""
+    now = datetime.utcnow()
+    if error is None:
+        values = {"status": DONE, "finished_at": now, "locked_by": None, "locked_until": None, "last_error": None}
+    elif attempts < max_attempts:
+        backoff = min(JOB_BACKOFF_SECONDS * 2 ** (attempts - 1), JOB_BACKOFF_MAX_SECONDS)
+        # jittered, so jobs that failed together don't all come back together
+        backoff *= random.uniform(0.5, 1)
+        values = {"status": QUEUED, "run_at": now + timedelta(seconds=backoff), "locked_by": None,
+                  "locked_until": None, "last_error": error}
+    else:
+        values = {"status": FAILED, "finished_at": now, "locked_by": None, "locked_until": None, "last_error": error}
+
+    def store(db: Session):
+        # only while the lease is ours, a job taken over by another worker is theirs to finish
+        db.execute(update(Job).where(Job.job_id == job_id, Job.locked_by == worker_id, Job.status == RUNNING).values(values))
+
+    db = SessionLocal()
+    try:
+        run_write(db, store)
+    finally:
+        db.close()
+
+
+def cleanup(retention_seconds: int = JOB_RETENTION_SECONDS):
+    """Drop old finished jobs and fail the ones whose worker died on their last attempt."""
+    now = datetime.utcnow()
+
+    def job(db: Session):
+        db.execute(delete(Job).where(Job.status == DONE, Job.finished_at < now - timedelta(seconds=retention_seconds)))
+        db.execute(update(Job).where(
+            Job.status == RUNNING, Job.locked_until < now, Job.attempts >= Job.max_attempts
+        ).values(status=FAILED, finished_at=now, locked_by=None, locked_until=None, last_error="lease expired"))
+
+    db = SessionLocal()
+    try:
+        run_write(db, job)
+    finally:
+        db.close()
+
+
+def run_job(claimed, worker_id: str):
+    job_id, kind, payload, attempts, max_attempts = claimed
+    spec = handlers.get(kind)
+    try:
+        if spec is None:
+            raise LookupError(f"No handler for {kind} jobs")
+        spec.run(payload or {})
+    except Exception as exc:
+        logger.exception("Job %s (%s) failed, attempt %s of %s", job_id, kind, attempts, max_attempts)
+        finish(job_id, worker_id, f"{type(exc).__name__}: {exc}", attempts, max_attempts)
+    else:
+        finish(job_id, worker_id)
+
+
+class JobWorkers:
+    """A pool of threads claiming and running jobs, woken by enqueue() or every poll interval."""
+
+    def __init__(self, workers: int = JOB_WORKERS, poll_interval: float = JOB_POLL_INTERVAL_SECONDS):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._wake = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self):
+        load_handlers()
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            if self._threads:
+                return
+            self._stop.clear()
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._run, args=(f"{self.worker_id}:{number}",),
+                                          name=f"job-worker-{number}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, wait: bool = False):
+        self._stop.set()
+        self.wake()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def wake(self):
+        with self._wake:
+            self._wake.notify()
+
+    def _run(self, worker_id: str):
+        last_cleanup = 0.0
+        while not self._stop.is_set():
+            try:
+                claimed = claim(worker_id)
+                if claimed is not None:
+                    run_job(claimed, worker_id)
+                    continue
+                if time.monotonic() - last_cleanup > 60:
+                    last_cleanup = time.monotonic()
+                    cleanup()
+            except Exception:
+                logger.exception("Job worker %s failed", worker_id)
+            with self._wake:
+                self._wake.wait(self.poll_interval)
+
+
+job_workers = JobWorkers()
+
+
+def queue_stats(db: Session) -> dict:
+    """Depth per status, the age of the oldest ready job, and latencies of recently finished jobs."""
+    now = datetime.utcnow()
+    depth = dict(db.query(Job.status, func.count()).group_by(Job.status).all())
+    oldest = db.scalar(select(func.min(Job.run_at)).where(Job.status == QUEUED, Job.run_at <= now))
+    recent = db.query(Job.run_at, Job.started_at, Job.finished_at).filter(
+        Job.status == DONE, Job.finished_at >= now - timedelta(seconds=JOB_STATS_WINDOW_SECONDS)
+    ).order_by(Job.finished_at.desc()).limit(1000).all()
+    return {
+        "depth": {status: depth.get(status, 0) for status in (QUEUED, RUNNING, FAILED, DONE)},
+        "oldest_ready_seconds": round((now - oldest).total_seconds(), 3) if oldest else 0,
+        # from becoming ready to the start of the attempt that succeeded, and that attempt's run time
+        "wait_ms": _summary([(started - run_at).total_seconds() for run_at, started, _ in recent]),
+        "run_ms": _summary([(finished - started).total_seconds() for _, started, finished in recent]),
+    }
+
+
+def _summary(samples) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(max(0.0, sample) for sample in samples)
+
+    def ms(quantile):
+        return round(ordered[min(len(ordered) - 1, int(quantile * len(ordered)))] * 1000, 2)
+
+    return {"count": len(ordered), "p50": ms(0.5), "p95": ms(0.95), "max": ms(1)}
+
@@ -0,0 +1,237 @@
+"""Bulk listing import from a streamed CSV or NDJSON body.
+
+The body is read chunk by chunk and rows are validated one at a time against
+ListingCreate, valid ones are inserted IMPORT_BATCH_SIZE at a time with one
+executemany per table and one commit per batch. Memory stays flat whatever the
+size of the file, only the current batch, the first IMPORT_MAX_REPORTED_ERRORS
+row errors and up to IMPORT_REBUILD_THRESHOLD new ids (for the match index) are kept.
+
+CSV needs a header row with title, description, price, location, isRental and
+optionally status, preferences (a JSON object) and latitude/longitude (geocoded
+from the location when left out). NDJSON has one such object per line.
+"""
+import codecs
+import csv
+import json
+import os
+import re
+from datetime import datetime
+from typing import Iterator, List
+
+import anyio.from_thread
+from pydantic import ValidationError
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from starlette.requests import Request
+
+from model.client_model import Listing, ListingLanguage, ListingPreferredSex, ListingStatus, preference_columns, preference_tags
+from schemas.listing_schemas import ListingCreate, ListingPreferences
+from service.geo import coordinates
+from service.match_index import schedule_listing_refresh, schedule_rebuild
+from service.write_queue import run_write
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "2000"))
+IMPORT_MAX_REPORTED_ERRORS = int(os.getenv("IMPORT_MAX_REPORTED_ERRORS", "1000"))
+# above this many new listings the match index is rebuilt instead of refreshed listing by listing
+IMPORT_REBUILD_THRESHOLD = int(os.getenv("IMPORT_REBUILD_THRESHOLD", "200"))
+
+# what the surrogateescape decoding in body_lines turns invalid utf-8 bytes into
+UNDECODABLE = re.compile("[\udc80-\udcff]")
+
+FORMATS = {
+    "text/csv": "csv",
+    "application/csv": "csv",
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+}
+
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        # new ids for per listing match index refreshes, dropped for one rebuild once there are too many
+        self.listing_ids = []
+        self.rebuild = False
+
+    def error(self, row: int, message):
+        self.failed += 1
+        if len(self.errors) < IMPORT_MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row, "error": message})
+
+    def added(self, listing_ids: List[int]):
+        self.imported += len(listing_ids)
+        if self.rebuild:
+            return
+        self.listing_ids += listing_ids
+        if len(self.listing_ids) > IMPORT_REBUILD_THRESHOLD:
+            self.rebuild = True
+            self.listing_ids = []
+
+    def as_dict(self):
+        return {
+            "imported": self.imported,
+            "failed": self.failed,
+            "errors": self.errors,
+            "errors_truncated": self.failed > len(self.errors),
+        }
+
+
+def body_lines(request: Request) -> Iterator[str]:
+    """The request body as text lines, pulled chunk by chunk from the event loop.
+
+    Only usable from a worker thread (plain `def` endpoints run in one).
+    """
+    chunks = request.stream()
+    # bytes that aren't utf-8 become lone surrogates, parse_rows reports their row instead of the stream dying
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="surrogateescape")
+    pending = ""
+    while True:
+        try:
+            chunk = anyio.from_thread.run(chunks.__anext__)
+        except StopAsyncIteration:
+            break
+        # keep line endings, csv needs them to read quoted fields spanning lines
+        lines = re.split(r"(?<=\n)", pending + decoder.decode(chunk))
+        pending = lines.pop()
+        yield from lines
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+def parse_rows(lines: Iterator[str], fmt: str) -> Iterator[tuple]:
+    """(row number, raw dict or parse error message) for every data row."""
+    if fmt == "csv":
+        reader = csv.DictReader(lines)
+        while True:
+            try:
+                raw = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as exc:
+                # the reader carries on with the next line, the failing one isn't counted in line_num
+                yield reader.line_num + 1, f"Invalid CSV: {exc}"
+                continue
+            # line_num of the last physical line, good enough to find the row in a spreadsheet
+            number = reader.line_num
+            raw = {k: v for k, v in raw.items() if k is not None}
+            if any(isinstance(v, str) and UNDECODABLE.search(v) for v in raw.values()):
+                yield number, "Not valid UTF-8"
+            else:
+                yield number, raw
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        if UNDECODABLE.search(line):
+            yield number, "Not valid UTF-8"
+            continue
+        try:
+            raw = json.loads(line)
+        except ValueError as exc:
+            yield number, f"Invalid JSON: {exc}"
+            continue
+        yield number, raw if isinstance(raw, dict) else "Expected a JSON object"
+
+
+def validate_row(raw: dict, owner_id: int, now: datetime) -> dict:
+    """Column values of a Listing insert, or raises ValueError / ValidationError."""
+    raw = {k: (None if v == "" else v) for k, v in raw.items()}
+    preferences = raw.get("preferences")
+    if isinstance(preferences, str):
+        preferences = json.loads(preferences)
+    if preferences is not None and not isinstance(preferences, dict):
+        raise ValueError("preferences must be a JSON object")
+    if preferences is not None:
+        # every preference is optional in an import, missing ones are simply unknown
+        preferences = ListingPreferences.model_validate({
+            **dict.fromkeys(ListingPreferences.model_fields), **preferences
+        }).model_dump()
+    listing = ListingCreate.model_validate({**raw, "status": raw.get("status") or "active", "preferences": preferences})
+    if listing.price < 0:
+        raise ValueError("Price must be a positive number.")
+    if (listing.latitude is None) != (listing.longitude is None):
+        raise ValueError("Give both latitude and longitude, or neither.")
+    latitude, longitude = coordinates(listing.location, listing.latitude, listing.longitude)
+    return {
+        "owner_id": owner_id,
+        "title": listing.title,
+        "description": listing.description,
+        "price": listing.price,
+        "location": listing.location,
+        "latitude": latitude,
+        "longitude": longitude,
+        "isRental": listing.isRental,
+        "status": ListingStatus(listing.status),
+        "images": [],
+        "preferences": preferences,
+        "created": now,
+        "updated": now,
+        **preference_columns(preferences),
+    }
+
+
+def import_listings(db: Session, lines: Iterator[str], fmt: str, owner_id: int) -> ImportReport:
+    report = ImportReport()
+    batch: List[tuple] = []
+    for number, raw in parse_rows(lines, fmt):
+        if isinstance(raw, str):
+            report.error(number, raw)
+            continue
+        try:
+            batch.append((number, validate_row(raw, owner_id, datetime.utcnow())))
+        except ValidationError as exc:
+            report.error(number, exc.errors(include_url=False, include_context=False, include_input=False))
+        except ValueError as exc:
+            report.error(number, str(exc))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            _flush(db, batch, report)
+            batch = []
+    if batch:
+        _flush(db, batch, report)
+    return report
+
+
+def _flush(db: Session, batch: List[tuple], report: ImportReport):
+    rows = [row for _, row in batch]
+
+    def insert_batch(db: Session):
+        # core inserts on the tables, the orm bulk path only adds per row bookkeeping here
+        listings = Listing.__table__
+        if db.get_bind().dialect.name == "sqlite":
+            # sqlite gives every new row max(rowid) + 1, so the ids sorted are in row order.
+            # ordered RETURNING would fall back to one statement per row there, and fts5
+            # flushes its index after every statement (10x slower)
+            listing_ids = sorted(db.scalars(insert(listings).returning(listings.c.listing_id), rows).all())
+        else:
+            listing_ids = db.scalars(
+                insert(listings).returning(listings.c.listing_id, sort_by_parameter_order=True), rows
+            ).all()
+        languages, sexes = [], []
+        for listing_id, row in zip(listing_ids, rows):
+            listing_languages, listing_sexes = preference_tags(row["preferences"])
+            languages += [{"listing_id": listing_id, "language": language} for language in listing_languages]
+            sexes += [{"listing_id": listing_id, "sex": sex} for sex in listing_sexes]
+        if languages:
+            db.execute(insert(ListingLanguage.__table__), languages)
+        if sexes:
+            db.execute(insert(ListingPreferredSex.__table__), sexes)
+        return listing_ids
+
+    try:
+        listing_ids = run_write(db, insert_batch)
+    except Exception as exc:
+        for number, _ in batch:
+            report.error(number, f"Batch insert failed: {exc.__class__.__name__}")
+        return
+    report.added(listing_ids)
+
+
+def refresh_match_index(report: ImportReport):
+    if report.rebuild:
+        schedule_rebuild()
+        return
+    for listing_id in report.listing_ids:
+        schedule_listing_refresh(listing_id)
@@ -0,0 +1,295 @@
+"""Outgoing mail, sent by jobs so no request waits on SMTP.
+
+Endpoints only enqueue a job (password_reset_email, notification_email). The
+job renders the mail and hands it to the mailer: one thread running an asyncio
+loop that keeps a single aiosmtplib connection open, so a batch of mails costs
+one connect/TLS/AUTH instead of one per mail (fastapi-mail's send_message opens
+a new connection every call, that's why it isn't used for the sending). Mails
+from concurrent jobs go through one queue, at most MAIL_RATE_PER_SECOND, the
+connection is closed after MAIL_IDLE_SECONDS without mail and opened again when
+the server dropped it.
+
+Templates are compiled once per process, a notification sent to a whole group
+is rendered once for all of its recipients.
+
+Without MAIL_SERVER the mails are only logged. To see them for real locally:
+
+    pip install aiosmtpd && python -m aiosmtpd -n -l localhost:8025
+    MAIL_SERVER=localhost MAIL_PORT=8025 MAIL_STARTTLS=0 uvicorn main:app
+"""
+import asyncio
+import logging
+import os
+import threading
+from email.message import EmailMessage
+from email.utils import make_msgid
+from typing import List, Optional
+
+import aiosmtplib
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from model.client_model import User
+from service.auth import create_access_token
+from service.jobs import JOB_BACKOFF_SECONDS, JOB_MAX_ATTEMPTS, enqueue, handler
+from service.write_queue import run_write
+
+logger = logging.getLogger(__name__)
+
+# the variable names fastapi-mail's ConnectionConfig reads
+MAIL_SERVER = os.getenv("MAIL_SERVER")
+MAIL_PORT = int(os.getenv("MAIL_PORT", "587"))
+MAIL_USERNAME = os.getenv("MAIL_USERNAME")
+MAIL_PASSWORD = os.getenv("MAIL_PASSWORD")
+MAIL_FROM = os.getenv("MAIL_FROM", "Flat Club <no-reply@flatclub.app>")
+MAIL_STARTTLS = os.getenv("MAIL_STARTTLS", "1") == "1"
+MAIL_SSL_TLS = os.getenv("MAIL_SSL_TLS", "0") == "1"
+MAIL_TIMEOUT_SECONDS = float(os.getenv("MAIL_TIMEOUT_SECONDS", "30"))
+MAIL_RATE_PER_SECOND = float(os.getenv("MAIL_RATE_PER_SECOND", "10"))
+MAIL_BATCH_SIZE = int(os.getenv("MAIL_BATCH_SIZE", "100"))
+MAIL_IDLE_SECONDS = float(os.getenv("MAIL_IDLE_SECONDS", "30"))
+APP_URL = os.getenv("APP_URL", "https://flatclub-production.up.railway.app")
+
+SUBJECTS = {
+    "password_reset": "Reset your Flat Club password",
+    "notification": "New on Flat Club",
+}
+
+templates = Environment(
+    loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.dirname(__file__)), "templates", "mail")),
+    autoescape=select_autoescape(["html"]),
+    # the files don't change while the app runs, no stat per render
+    auto_reload=False,
+)
+
+
+def render(name: str, **context) -> dict:
+    """Subject, text and html body of the `name` mail."""
+    return {
+        "subject": SUBJECTS[name],
+        "text": templates.get_template(f"{name}.txt").render(**context),
+        "html": templates.get_template(f"{name}.html").render(**context),
+    }
+
+
+def build_message(to: str, rendered: dict) -> EmailMessage:
+    message = EmailMessage()
+    message["From"] = MAIL_FROM
+    message["To"] = to
+    message["Subject"] = rendered["subject"]
+    message["Message-ID"] = make_msgid(domain=MAIL_FROM.rsplit("@", 1)[-1].rstrip(">"))
+    message.set_content(rendered["text"])
+    message.add_alternative(rendered["html"], subtype="html")
+    return message
+
+
+def is_permanent(exc: Exception) -> bool:
+    """Whether sending again can't help (the address is refused, a 5xx reply)."""
+    if isinstance(exc, aiosmtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(exc, aiosmtplib.SMTPResponseException) and 500 <= exc.code < 600
+
+
+class Mailer:
+    """Sends mails over one pooled SMTP connection, from an event loop in a thread of its own."""
+
+    def __init__(self, rate: float = MAIL_RATE_PER_SECOND, batch_size: int = MAIL_BATCH_SIZE,
+                 idle_seconds: float = MAIL_IDLE_SECONDS):
+        self.rate = rate
+        self.batch_size = batch_size
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._smtp: Optional[aiosmtplib.SMTP] = None
+        self._next_send = 0.0
+        self._sent = 0
+        self._failed = 0
+        self._connections = 0
+        self._batches = 0
+
+    def send(self, messages: List[EmailMessage]) -> List[Optional[Exception]]:
+        """Send `messages`, blocks until every one is through. Returns the error of each, None when sent."""
+        if not messages:
+            return []
+        if not MAIL_SERVER:
+            for message in messages:
+                logger.info("Mail to %s (MAIL_SERVER not set, not sent): %s\n%s",
+                            message["To"], message["Subject"], message.get_body(("plain",)).get_content())
+            return [None] * len(messages)
+        loop = self._start()
+        return asyncio.run_coroutine_threadsafe(self._submit(messages), loop).result()
+
+    def stop(self):
+        """Close the connection and stop the loop thread."""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._disconnect(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+    def _start(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def run():
+                    asyncio.set_event_loop(loop)
+                    self._queue = asyncio.Queue()
+                    loop.create_task(self._sender())
+                    loop.call_soon(ready.set)
+                    loop.run_forever()
+                    loop.close()
+
+                self._thread = threading.Thread(target=run, name="mailer", daemon=True)
+                self._thread.start()
+                ready.wait()
+                self._loop = loop
+            return self._loop
+
+    async def _submit(self, messages: List[EmailMessage]):
+        futures = []
+        for message in messages:
+            future = asyncio.get_running_loop().create_future()
+            self._queue.put_nowait((message, future))
+            futures.append(future)
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    async def _sender(self):
+        while True:
+            try:
+                first = await asyncio.wait_for(self._queue.get(), self.idle_seconds)
+            except asyncio.TimeoutError:
+                await self._disconnect()
+                continue
+            # whatever else is waiting goes over the same connection right after
+            batch = [first]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self._batches += 1
+            for message, future in batch:
+                await self._throttle()
+                try:
+                    await self._deliver(message)
+                except Exception as exc:
+                    self._failed += 1
+                    future.set_exception(exc)
+                else:
+                    self._sent += 1
+                    future.set_result(None)
+
+    async def _throttle(self):
+        loop = asyncio.get_running_loop()
+        wait = self._next_send - loop.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._next_send = max(loop.time(), self._next_send) + 1 / self.rate
+
+    async def _deliver(self, message: EmailMessage):
+        # a pooled connection may have been closed by the server since the last mail, one reconnect
+        for attempt in (1, 2):
+            smtp = await self._connection()
+            try:
+                await smtp.send_message(message)
+                return
+            except (aiosmtplib.SMTPServerDisconnected, ConnectionError):
+                await self._disconnect()
+                if attempt == 2:
+                    raise
+
+    async def _connection(self) -> aiosmtplib.SMTP:
+        if self._smtp is None or not self._smtp.is_connected:
+            smtp = aiosmtplib.SMTP(
+                hostname=MAIL_SERVER, port=MAIL_PORT, timeout=MAIL_TIMEOUT_SECONDS,
+                use_tls=MAIL_SSL_TLS, start_tls=MAIL_STARTTLS and not MAIL_SSL_TLS,
+                username=MAIL_USERNAME, password=MAIL_PASSWORD,
+            )
+            await smtp.connect()
+            self._smtp = smtp
+            self._connections += 1
+        return self._smtp
+
+    async def _disconnect(self):
+        smtp, self._smtp = self._smtp, None
+        if smtp is not None and smtp.is_connected:
+            try:
+                await smtp.quit()
+            except aiosmtplib.SMTPException:
+                smtp.close()
+
+    def metrics(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "sent_total": self._sent,
+            "failed_total": self._failed,
+            "connections_total": self._connections,
+            "batches_total": self._batches,
+        }
+
+
+mailer = Mailer()
+
+
+@handler("password_reset_email")
+def send_password_reset(payload: dict):
+    # the token is made here, it never sits in the jobs table
+    reset_token = create_access_token({"sub": payload["email"]})
+    rendered = render("password_reset", reset_url=f"{APP_URL}/password-reset?token={reset_token}")
+    error, = mailer.send([build_message(payload["email"], rendered)])
+    if error is not None and not is_permanent(error):
+        # raised, the job is retried after its backoff
+        raise error
+    if error is not None:
+        logger.warning("Password reset mail to %s refused: %s", payload["email"], error)
+
+
+@handler("notification_email")
+def send_notification_emails(payload: dict):
+    """One notification to a batch of users. Mails that failed for now go out again in a new job."""
+    user_ids = payload["user_ids"]
+    db = SessionLocal()
+    try:
+        recipients = db.query(User.user_id, User.email).filter(
+            User.user_id.in_(user_ids), User.email.isnot(None), User.deleted_at.is_(None)
+        ).all()
+    finally:
+        db.close()
+
+    rendered = render("notification", content=payload["content"], app_url=APP_URL)
+    errors = mailer.send([build_message(email, rendered) for _, email in recipients])
+
+    retry = []
+    for (user_id, email), error in zip(recipients, errors):
+        if error is None:
+            continue
+        if is_permanent(error):
+            logger.warning("Notification mail to %s refused: %s", email, error)
+        else:
+            retry.append(user_id)
+    if not retry:
+        return
+    if len(retry) == len(recipients):
+        # nothing went out, the job's own retry is enough
+        raise errors[0]
+
+    # the others were sent, retrying this job would mail them twice
+    rounds = payload.get("round", 1)
+    if rounds >= JOB_MAX_ATTEMPTS:
+        logger.warning("Giving up on notification mails to %s users", len(retry))
+        return
+
+    def requeue(db: Session):
+        enqueue(db, "notification_email", dict(payload, user_ids=retry, round=rounds + 1),
+                delay=JOB_BACKOFF_SECONDS * 2 ** (rounds - 1))
+
+    db = SessionLocal()
+    try:
+        run_write(db, requeue)
+    finally:
+        db.close()
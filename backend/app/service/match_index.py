@@ -0,0 +1,390 @@
+"""Persistent top-N compatibility index between users and listings.
+
+user_listing_matches holds the TOP_N best flats of every user and
+listing_tenant_matches the TOP_N best tenants of every listing. Preference
+changes only rescore the changed user's row or listing's column (one
+vectorized pass from service/compatibility.py) and then patch the lists on
+the other side that the change can enter or leave.
+
+Updates run on a background thread so requests never wait on them. The index
+is eventually consistent: the in-memory matrices can be a few seconds old.
+A full rebuild reconciles everything:
+
+    PYTHONPATH=app python -m service.match_index rebuild --workers 4
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from model.client_model import Listing, ListingStatus, ListingTenantMatch, User, UserListingMatch
+from service.compatibility import (
+    LISTING_SEX_KEY, USER_SEX_KEY, PreferenceMatrix, encode_preferences, listing_matrix_cache,
+    load_listing_matrix, load_user_matrix, score, top_k, user_matrix_cache,
+)
+
+logger = logging.getLogger(__name__)
+
+TOP_N = int(os.getenv("MATCH_INDEX_TOP_N", "50"))
+INSERT_BATCH_SIZE = 5000
+QUERY_CHUNK_SIZE = 500
+
+
+@dataclass(frozen=True)
+class MatchSide:
+    model: type
+    subject: str  # who owns the ranked list
+    candidate: str  # what is ranked in it
+
+    @property
+    def subject_column(self):
+        return getattr(self.model, self.subject)
+
+    @property
+    def candidate_column(self):
+        return getattr(self.model, self.candidate)
+
+
+FLATS_FOR_USER = MatchSide(UserListingMatch, "user_id", "listing_id")
+TENANTS_FOR_LISTING = MatchSide(ListingTenantMatch, "listing_id", "user_id")
+
+
+class Thresholds:
+    """Length and lowest score of every list on one side, to tell who can enter a full list."""
+
+    def __init__(self, side: MatchSide):
+        self.side = side
+        self.ids = None
+        self.counts = None
+        self.lowest = None
+
+    def reset(self):
+        self.ids = None
+
+    def load(self, db: Session):
+        side = self.side
+        rows = (
+            db.query(side.subject_column, func.count(), func.min(side.model.score))
+            .group_by(side.subject_column)
+            .order_by(side.subject_column)
+            .all()
+        )
+        self.ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        self.counts = np.fromiter((r[1] for r in rows), dtype=np.int64, count=len(rows))
+        self.lowest = np.fromiter((r[2] for r in rows), dtype=np.float64, count=len(rows))
+
+    def lookup(self, db: Session, ids: np.ndarray):
+        if self.ids is None:
+            self.load(db)
+        if len(self.ids) == 0:
+            return np.zeros(len(ids), dtype=np.int64), np.full(len(ids), -np.inf)
+        positions, found = self._positions(ids)
+        counts = np.where(found, self.counts[positions], 0)
+        lowest = np.where(found, self.lowest[positions], -np.inf)
+        return counts, lowest
+
+    def refresh(self, db: Session, ids):
+        """Re-read the stats of lists we just changed."""
+        if self.ids is None or len(ids) == 0:
+            return
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        stats = {}
+        side = self.side
+        for start in range(0, len(ids), QUERY_CHUNK_SIZE):
+            chunk = ids[start:start + QUERY_CHUNK_SIZE].tolist()
+            stats.update({
+                r[0]: (r[1], r[2])
+                for r in db.query(side.subject_column, func.count(), func.min(side.model.score))
+                .filter(side.subject_column.in_(chunk))
+                .group_by(side.subject_column)
+            })
+        positions, found = self._positions(ids)
+        if any(i in stats for i in ids[~found].tolist()):
+            # a list we have never seen, cheaper to reload everything on the next lookup
+            self.reset()
+            return
+        for position, list_id in zip(positions[found].tolist(), ids[found].tolist()):
+            self.counts[position], self.lowest[position] = stats.get(list_id, (0, -np.inf))
+
+    def _positions(self, ids: np.ndarray):
+        positions = np.searchsorted(self.ids, ids)
+        found = positions < len(self.ids)
+        found[found] = self.ids[positions[found]] == ids[found]
+        return np.where(found, positions, 0), found
+
+
+thresholds = {FLATS_FOR_USER: Thresholds(FLATS_FOR_USER), TENANTS_FOR_LISTING: Thresholds(TENANTS_FOR_LISTING)}
+
+
+def refresh_user(db: Session, user_id: int):
+    """Rescore one user's row after register / profile update, or drop them when gone."""
+    user = db.get(User, user_id)
+    if user is None or not user.preference:
+        _remove(db, FLATS_FOR_USER, TENANTS_FOR_LISTING, user_id, _listing_rescorer(db, exclude_user=user_id))
+        return
+
+    listings, owners = listing_matrix_cache.get(db)
+    scores = _user_scores(user_id, user.preference, listings, owners)
+    _replace_list(db, FLATS_FOR_USER, user_id, listings.ids, scores)
+    _update_lists_containing(db, TENANTS_FOR_LISTING, user_id, listings.ids, scores, _listing_rescorer(db))
+
+
+def refresh_listing(db: Session, listing_id: int):
+    """Rescore one listing's column after create / update, or drop it when archived or deleted."""
+    listing = db.get(Listing, listing_id)
+    if listing is None or _status(listing) != ListingStatus.active.value:
+        _remove(db, TENANTS_FOR_LISTING, FLATS_FOR_USER, listing_id, _user_rescorer(db, exclude_listing=listing_id))
+        return
+
+    users = user_matrix_cache.get(db)
+    scores = _listing_scores(listing.owner_id, listing_id, listing.preferences, users)
+    _replace_list(db, TENANTS_FOR_LISTING, listing_id, users.ids, scores)
+    _update_lists_containing(db, FLATS_FOR_USER, listing_id, users.ids, scores, _user_rescorer(db))
+
+
+def _user_scores(user_id, preference, listings: PreferenceMatrix, owners: np.ndarray) -> np.ndarray:
+    me = encode_preferences([user_id], [preference], USER_SEX_KEY)
+    # own listings never count as a match
+    return np.where(owners == user_id, -np.inf, _stored_scores(listings, me))
+
+
+def _listing_scores(owner_id, listing_id, preferences, users: PreferenceMatrix) -> np.ndarray:
+    flat = encode_preferences([listing_id], [preferences], LISTING_SEX_KEY)
+    return np.where(users.ids == owner_id, -np.inf, _stored_scores(users, flat))
+
+
+def _stored_scores(candidates: PreferenceMatrix, person: PreferenceMatrix) -> np.ndarray:
+    # rounded like they end up in the database, so threshold comparisons against stored scores are exact
+    return np.round(score(candidates, person).astype(np.float64), 6)
+
+
+def _user_rescorer(db: Session, exclude_listing=None):
+    def rescore(user_ids):
+        listings, owners = listing_matrix_cache.get(db)
+        for user_id, preference in db.query(User.user_id, User.preference).filter(User.user_id.in_(user_ids)):
+            scores = _user_scores(user_id, preference, listings, owners) if preference else np.full(len(listings), -np.inf)
+            if exclude_listing is not None:
+                scores = np.where(listings.ids == exclude_listing, -np.inf, scores)
+            _replace_list(db, FLATS_FOR_USER, user_id, listings.ids, scores)
+    return rescore
+
+
+def _listing_rescorer(db: Session, exclude_user=None):
+    def rescore(listing_ids):
+        users = user_matrix_cache.get(db)
+        for listing in db.query(Listing).filter(Listing.listing_id.in_(listing_ids)):
+            scores = _listing_scores(listing.owner_id, listing.listing_id, listing.preferences, users)
+            if exclude_user is not None:
+                scores = np.where(users.ids == exclude_user, -np.inf, scores)
+            _replace_list(db, TENANTS_FOR_LISTING, listing.listing_id, users.ids, scores)
+    return rescore
+
+
+def _replace_list(db: Session, side: MatchSide, subject_id: int, candidate_ids: np.ndarray, scores: np.ndarray):
+    best = top_k(scores, TOP_N)
+    db.execute(delete(side.model).where(side.subject_column == subject_id))
+    _insert(db, side, [
+        {side.subject: subject_id, side.candidate: candidate, "score": value}
+        for candidate, value in zip(candidate_ids[best].tolist(), scores[best].tolist())
+    ])
+    thresholds[side].refresh(db, [subject_id])
+
+
+def _update_lists_containing(db: Session, side: MatchSide, candidate_id: int, subject_ids: np.ndarray,
+                             scores: np.ndarray, rescore):
+    """Patch every `side` list (keyed by subject_ids) with candidate_id's new scores."""
+    listed = np.array(
+        db.scalars(select(side.subject_column).where(side.candidate_column == candidate_id)).all(), dtype=np.int64
+    )
+    db.execute(delete(side.model).where(side.candidate_column == candidate_id))
+    thresholds[side].refresh(db, listed)
+    counts, lowest = thresholds[side].lookup(db, subject_ids)
+
+    valid = np.isfinite(scores)
+    was_listed = np.isin(subject_ids, listed)
+    # a full list we took the candidate out of may have a better outsider than the new score,
+    # only a rescore of that list can tell
+    needs_rescore = was_listed & (counts == TOP_N - 1) & ~(valid & (scores >= lowest))
+    enters = valid & ~needs_rescore & ((counts < TOP_N) | (scores > lowest))
+    overflowing = enters & (counts >= TOP_N)
+
+    _insert(db, side, [
+        {side.subject: subject, side.candidate: candidate_id, "score": value}
+        for subject, value in zip(subject_ids[enters].tolist(), scores[enters].tolist())
+    ])
+    for subject in subject_ids[overflowing].tolist():
+        lowest_row = (
+            select(side.candidate_column)
+            .where(side.subject_column == subject)
+            .order_by(side.model.score, side.candidate_column)
+            .limit(1)
+            .scalar_subquery()
+        )
+        db.execute(delete(side.model).where(side.subject_column == subject, side.candidate_column == lowest_row))
+
+    stale = subject_ids[needs_rescore]
+    if len(stale):
+        rescore(stale.tolist())
+    thresholds[side].refresh(db, subject_ids[enters | needs_rescore])
+
+
+def _remove(db: Session, own_side: MatchSide, other_side: MatchSide, subject_id: int, rescore):
+    db.execute(delete(own_side.model).where(own_side.subject_column == subject_id))
+    thresholds[own_side].refresh(db, [subject_id])
+    listed = db.scalars(select(other_side.subject_column).where(other_side.candidate_column == subject_id)).all()
+    db.execute(delete(other_side.model).where(other_side.candidate_column == subject_id))
+    # those lists lost an entry, refill them
+    if listed:
+        rescore(listed)
+    thresholds[other_side].refresh(db, listed)
+
+
+def _insert(db: Session, side: MatchSide, rows):
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        db.execute(insert(side.model), rows[start:start + INSERT_BATCH_SIZE])
+
+
+def _status(listing):
+    return listing.status.value if isinstance(listing.status, ListingStatus) else listing.status
+
+
+class MatchIndexUpdater:
+    """Single background thread applying refreshes in order, deduplicating pending work."""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def schedule(self, kind: str, object_id: int):
+        with self._lock:
+            if (kind, object_id) in self._pending:
+                return
+            self._pending.add((kind, object_id))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="match-index", daemon=True)
+                self._thread.start()
+        self._queue.put((kind, object_id))
+
+    def _run(self):
+        while True:
+            kind, object_id = self._queue.get()
+            with self._lock:
+                self._pending.discard((kind, object_id))
+            if kind == "rebuild":
+                try:
+                    rebuild()
+                except Exception:
+                    logger.exception("Match index rebuild failed")
+                finally:
+                    self._queue.task_done()
+                continue
+            db = SessionLocal()
+            try:
+                (refresh_user if kind == "user" else refresh_listing)(db, object_id)
+                db.commit()
+            except Exception:
+                logger.exception("Match index refresh of %s %s failed", kind, object_id)
+                db.rollback()
+                # the in-memory thresholds may no longer match what is in the database
+                for entry in thresholds.values():
+                    entry.reset()
+            finally:
+                db.close()
+                self._queue.task_done()
+
+    def join(self):
+        self._queue.join()
+
+
+updater = MatchIndexUpdater()
+
+
+def schedule_user_refresh(user_id: int):
+    updater.schedule("user", user_id)
+
+
+def schedule_listing_refresh(listing_id: int):
+    updater.schedule("listing", listing_id)
+
+
+def schedule_rebuild():
+    # cheaper than one refresh per listing after a bulk import
+    updater.schedule("rebuild", 0)
+
+
+# full rebuild, one process per core
+
+_worker_listings = _worker_owners = _worker_users = None
+
+
+def _init_worker(listings, owners, users):
+    global _worker_listings, _worker_owners, _worker_users
+    _worker_listings, _worker_owners, _worker_users = listings, owners, users
+
+
+def _best_listings_for_users(rows):
+    result = []
+    for index in rows:
+        me = _worker_users.row(index)
+        user_id = int(me.ids[0])
+        scores = np.where(_worker_owners == user_id, -np.inf, _stored_scores(_worker_listings, me))
+        best = top_k(scores, TOP_N)
+        result += [(user_id, listing_id, value) for listing_id, value in zip(_worker_listings.ids[best].tolist(), scores[best].tolist())]
+    return result
+
+
+def _best_users_for_listings(rows):
+    result = []
+    for index in rows:
+        flat = _worker_listings.row(index)
+        listing_id = int(flat.ids[0])
+        scores = np.where(_worker_users.ids == _worker_owners[index], -np.inf, _stored_scores(_worker_users, flat))
+        best = top_k(scores, TOP_N)
+        result += [(listing_id, user_id, value) for user_id, value in zip(_worker_users.ids[best].tolist(), scores[best].tolist())]
+    return result
+
+
+def rebuild(workers: int = None, chunk_size: int = 500):
+    """Recompute both match tables from scratch in a process pool."""
+    db = SessionLocal()
+    try:
+        listings, owners = load_listing_matrix(db)
+        users = load_user_matrix(db)
+
+        db.execute(delete(UserListingMatch))
+        db.execute(delete(ListingTenantMatch))
+        # spawn, it also runs on the updater thread of the server and forking a threaded process can deadlock
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker, initargs=(listings, owners, users)) as pool:
+            user_chunks = [range(i, min(i + chunk_size, len(users))) for i in range(0, len(users), chunk_size)]
+            for rows in pool.map(_best_listings_for_users, user_chunks):
+                _insert(db, FLATS_FOR_USER, [{"user_id": u, "listing_id": l, "score": s} for u, l, s in rows])
+            listing_chunks = [range(i, min(i + chunk_size, len(listings))) for i in range(0, len(listings), chunk_size)]
+            for rows in pool.map(_best_users_for_listings, listing_chunks):
+                _insert(db, TENANTS_FOR_LISTING, [{"listing_id": l, "user_id": u, "score": s} for l, u, s in rows])
+        db.commit()
+    finally:
+        db.close()
+    for entry in thresholds.values():
+        entry.reset()
+    logger.info("Match index rebuilt for %d users and %d listings", len(users), len(listings))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Maintain the user/listing compatibility index.")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--workers", type=int, default=None, help="processes to use, defaults to the cpu count")
+    args = parser.parse_args()
+    rebuild(args.workers)
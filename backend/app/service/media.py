@@ -0,0 +1,187 @@
+"""Reference counted, content addressed image storage.
+
+Every stored blob has one Media row whose ref_count is the number of listing image
+slots pointing at it. Creating a listing adds references, deleting listings or users
+releases them. A blob whose count reached 0 is left alone for MEDIA_GRACE_SECONDS
+(so a re-upload can revive it) and then removed by the sweeper in batches:
+
+    PYTHONPATH=app python -m service.media sweep
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import case
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, dialect_insert
+from model.client_model import Media
+from service.uploads import TMP_DIR, UPLOADS_DIR, StoredUpload, blob_lock, blob_path, sha256_of
+
+logger = logging.getLogger(__name__)
+
+MEDIA_GRACE_SECONDS = int(os.getenv("MEDIA_GRACE_SECONDS", str(24 * 3600)))
+MEDIA_SWEEP_INTERVAL_SECONDS = int(os.getenv("MEDIA_SWEEP_INTERVAL_SECONDS", "3600"))
+MEDIA_SWEEP_BATCH_SIZE = int(os.getenv("MEDIA_SWEEP_BATCH_SIZE", "500"))
+
+
+def add_references(db: Session, uploads: List[StoredUpload], user_id: Optional[int] = None) -> Dict[str, str]:
+    """Count one reference per upload, creating the Media row on first sight. Does not commit.
+
+    Returns sha256 -> url of the Media row, the url to store: the first upload of some
+    content names it, a later one may have written it under another extension.
+    """
+    counts = Counter(upload.sha256 for upload in uploads)
+    first = {}
+    for upload in uploads:
+        first.setdefault(upload.sha256, upload)
+
+    for sha256, count in counts.items():
+        upload = first[sha256]
+        insert = dialect_insert(db)
+        statement = insert(Media).values(
+            sha256=sha256, url=upload.url, size=upload.size, user_id=user_id,
+            ref_count=count, created_at=datetime.utcnow(),
+        )
+        # a concurrent upload of the same bytes may have created the row since, so upsert
+        db.execute(statement.on_conflict_do_update(
+            index_elements=[Media.sha256],
+            set_={"ref_count": Media.ref_count + count, "orphaned_at": None},
+        ))
+    if not counts:
+        return {}
+    return dict(db.query(Media.sha256, Media.url).filter(Media.sha256.in_(list(counts))))
+
+
+def release(db: Session, urls: Iterable[str]):
+    """Drop one reference per url, by the content hash in it. Urls without one (pre content addressing) are ignored."""
+    now = datetime.utcnow()
+    for sha256, count in Counter(sha for sha in map(sha256_of, urls) if sha).items():
+        # SET expressions all see the old ref_count
+        db.query(Media).filter(Media.sha256 == sha256).update(
+            {
+                Media.ref_count: Media.ref_count - count,
+                Media.orphaned_at: case((Media.ref_count - count <= 0, now), else_=Media.orphaned_at),
+            },
+            synchronize_session=False,
+        )
+
+
+def sweep(db: Session, grace_seconds: int = MEDIA_GRACE_SECONDS, batch_size: int = MEDIA_SWEEP_BATCH_SIZE) -> int:
+    """Delete Media rows orphaned for longer than the grace period and their files, batch by batch."""
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+    removed = 0
+    while True:
+        rows = (
+            db.query(Media.media_id, Media.url, Media.variants)
+            .filter(Media.ref_count <= 0, Media.orphaned_at < cutoff)
+            .order_by(Media.media_id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            return removed
+        # the ref_count condition again, an upload may have revived a row since we read it
+        db.query(Media).filter(
+            Media.media_id.in_([r.media_id for r in rows]), Media.ref_count <= 0
+        ).delete(synchronize_session=False)
+        db.commit()
+        for row in rows:
+            removed += _unlink_if_older(blob_path(row.url), cutoff)
+            for variant_url in (row.variants or {}).values():
+                _unlink_if_older(blob_path(variant_url), cutoff)
+
+
+def sweep_strays(db: Session, grace_seconds: int = MEDIA_GRACE_SECONDS, batch_size: int = MEDIA_SWEEP_BATCH_SIZE) -> int:
+    """Remove blobs that never got a Media row (their request failed) and leftover .part files."""
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+    removed = 0
+    if os.path.isdir(TMP_DIR):
+        for name in os.listdir(TMP_DIR):
+            removed += _unlink_if_older(os.path.join(TMP_DIR, name), cutoff)
+
+    for prefix in sorted(os.listdir(UPLOADS_DIR)) if os.path.isdir(UPLOADS_DIR) else []:
+        directory = os.path.join(UPLOADS_DIR, prefix)
+        # only the <ab>/ shards, the older uploads/<filename> images are not ours to touch
+        if len(prefix) != 2 or not os.path.isdir(directory):
+            continue
+        names = os.listdir(directory)
+        for start in range(0, len(names), batch_size):
+            # <sha256>.png and its <sha256>.thumb.webp / .medium.webp all belong to the same row
+            batch = names[start:start + batch_size]
+            shas = {name.split(".", 1)[0] for name in batch}
+            # the files a row points at, a second copy of its content under another extension is a stray too
+            known = set()
+            for url, variants in db.query(Media.url, Media.variants).filter(Media.sha256.in_(shas)):
+                known.update(os.path.basename(u) for u in [url, *(variants or {}).values()])
+            for name in batch:
+                if name not in known:
+                    removed += _unlink_if_older(os.path.join(directory, name), cutoff)
+    return removed
+
+
+def _unlink_if_older(path: str, cutoff: datetime) -> int:
+    # uploads refresh the mtime of the blob they store, so a recent mtime means a reference is on its way
+    with blob_lock:
+        try:
+            if datetime.utcfromtimestamp(os.path.getmtime(path)) >= cutoff:
+                return 0
+            os.remove(path)
+            return 1
+        except FileNotFoundError:
+            return 0
+
+
+class MediaSweeper:
+    """Background thread running sweep() and sweep_strays() every MEDIA_SWEEP_INTERVAL_SECONDS."""
+
+    def __init__(self, interval: float = MEDIA_SWEEP_INTERVAL_SECONDS):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="media-sweeper", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            db = SessionLocal()
+            try:
+                removed = sweep(db) + sweep_strays(db)
+                if removed:
+                    logger.info("Media sweeper removed %s blobs", removed)
+            except Exception:
+                logger.exception("Media sweep failed")
+                db.rollback()
+            finally:
+                db.close()
+
+
+sweeper = MediaSweeper()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["sweep"])
+    parser.add_argument("--grace", type=int, default=MEDIA_GRACE_SECONDS, help="seconds an orphan is kept")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    started = time.perf_counter()
+    session = SessionLocal()
+    try:
+        count = sweep(session, args.grace) + sweep_strays(session, args.grace)
+    finally:
+        session.close()
+    print(f"removed {count} blobs in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,266 @@
+"""Notifications for domain events, written in batches.
+
+Endpoints call notify() after their own commit. It only appends the rows to a
+buffer in memory, a background thread inserts whatever piled up every
+NOTIFICATION_FLUSH_INTERVAL_SECONDS (sooner once NOTIFICATION_BATCH_SIZE rows
+are waiting) with one multi row INSERT, so a message to a big group doesn't cost
+the sender one insert per member. Rows still in the buffer when the process dies
+are lost, notifications are best effort. The app's shutdown flushes them.
+
+notification_counters keeps every user's unread count. It is changed in the same
+transaction as the rows it counts (inserted here, marked read by mark_read_*), so
+the badge is one primary key lookup instead of a COUNT over the user's history.
+
+With NOTIFICATION_EMAILS=1 every batch also queues notification_email jobs
+(service/mail.py) in the same transaction, the mail goes out from a job worker.
+"""
+import logging
+import os
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Iterable, List
+
+from sqlalchemy import case, insert, select
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, dialect_insert
+from model.client_model import Notification, NotificationCounter, User
+from service.jobs import enqueue
+from service.realtime import hub
+from service.write_queue import run_write
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATION_FLUSH_INTERVAL_SECONDS = float(os.getenv("NOTIFICATION_FLUSH_INTERVAL_SECONDS", "0.5"))
+NOTIFICATION_BATCH_SIZE = int(os.getenv("NOTIFICATION_BATCH_SIZE", "500"))
+# past this many waiting rows new ones are dropped, the database fell behind
+NOTIFICATION_BUFFER_LIMIT = int(os.getenv("NOTIFICATION_BUFFER_LIMIT", "50000"))
+NOTIFICATION_EMAILS = os.getenv("NOTIFICATION_EMAILS", "0") == "1"
+# recipients per notification_email job
+NOTIFICATION_EMAIL_BATCH_SIZE = int(os.getenv("NOTIFICATION_EMAIL_BATCH_SIZE", "100"))
+
+
+def insert_notifications(db: Session, rows: List[dict]) -> List[dict]:
+    """Insert `rows` and count them as unread, returns the rows with their ids. Does not commit."""
+    # the user may have been deleted while the row waited in the buffer
+    user_ids = {row["user_id"] for row in rows}
+    existing = set(db.scalars(select(User.user_id).where(User.user_id.in_(user_ids))))
+    rows = [row for row in rows if row["user_id"] in existing]
+    if not rows:
+        return []
+
+    created = db.execute(
+        insert(Notification.__table__).returning(Notification.notification_id, Notification.user_id),
+        rows,
+    ).all()
+    unread = Counter(row["user_id"] for row in rows)
+    _add_unread(db, unread.items())
+
+    # returned rows are not in parameter order on every dialect, match them back per user
+    ids = {}
+    for notification_id, user_id in created:
+        ids.setdefault(user_id, []).append(notification_id)
+    for row in rows:
+        ids[row["user_id"]].sort(reverse=True)
+    return [dict(row, notification_id=ids[row["user_id"]].pop()) for row in rows]
+
+
+def enqueue_notification_emails(db: Session, rows: List[dict]):
+    """Queue the mails of inserted notification rows, one job per content and batch of users. Does not commit."""
+    by_content = {}
+    for row in rows:
+        by_content.setdefault(row["content"], []).append(row["user_id"])
+    for content, user_ids in by_content.items():
+        for start in range(0, len(user_ids), NOTIFICATION_EMAIL_BATCH_SIZE):
+            enqueue(db, "notification_email", {
+                "user_ids": user_ids[start:start + NOTIFICATION_EMAIL_BATCH_SIZE], "content": content,
+            })
+
+
+def notifications_after(db: Session, user_id: int, notification_id: int, limit: int):
+    """The user's notifications newer than `notification_id`, oldest first."""
+    return (
+        db.query(Notification.notification_id, Notification.content, Notification.created_at, Notification.is_read)
+        .filter(Notification.user_id == user_id, Notification.notification_id > notification_id)
+        .order_by(Notification.notification_id.asc())
+        .limit(limit)
+        .all()
+    )
+
+
+def notification_event(notification) -> dict:
+    """The realtime event of a notification row (or its dict)."""
+    row = notification if isinstance(notification, dict) else notification._asdict()
+    return {"type": "notification", "notification": {
+        "notification_id": row["notification_id"],
+        "content": row["content"],
+        "created_at": row["created_at"],
+        "is_read": row["is_read"],
+    }}
+
+
+def mark_read(db: Session, user_id: int, notification_id: int) -> bool:
+    """Mark one notification read, False when the user has no such notification. Does not commit."""
+    notification = db.query(Notification.is_read).filter(
+        Notification.notification_id == notification_id,
+        Notification.user_id == user_id,
+    ).first()
+    if notification is None:
+        return False
+    _mark_read(db, user_id, Notification.notification_id == notification_id)
+    return True
+
+
+def mark_read_up_to(db: Session, user_id: int, notification_id: int) -> int:
+    """Mark every notification of the user up to and including `notification_id` read. Does not commit."""
+    return _mark_read(db, user_id, Notification.notification_id <= notification_id)
+
+
+def unread_count(db: Session, user_id: int) -> int:
+    count = db.scalar(select(NotificationCounter.unread_count).where(NotificationCounter.user_id == user_id))
+    return count or 0
+
+
+def _mark_read(db: Session, user_id: int, condition) -> int:
+    # only the rows this statement flips are taken off the counter, so a concurrent
+    # mark-read of the same rows can't count them twice
+    updated = db.query(Notification).filter(
+        Notification.user_id == user_id,
+        Notification.is_read.is_(False),
+        condition,
+    ).update({Notification.is_read: True}, synchronize_session=False)
+    if updated:
+        db.query(NotificationCounter).filter(NotificationCounter.user_id == user_id).update(
+            {
+                NotificationCounter.unread_count: case(
+                    (NotificationCounter.unread_count > updated, NotificationCounter.unread_count - updated),
+                    else_=0,
+                )
+            },
+            synchronize_session=False,
+        )
+    return updated
+
+
+def _add_unread(db: Session, counts):
+    insert_ = dialect_insert(db)
+    statement = insert_(NotificationCounter).values(
+        [{"user_id": user_id, "unread_count": count} for user_id, count in counts]
+    )
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[NotificationCounter.user_id],
+        set_={"unread_count": NotificationCounter.unread_count + statement.excluded.unread_count},
+    ))
+
+
+class NotificationWriter:
+    """Buffers notification rows and inserts them from a thread of its own, batch by batch."""
+
+    def __init__(
+        self,
+        interval: float = NOTIFICATION_FLUSH_INTERVAL_SECONDS,
+        batch_size: int = NOTIFICATION_BATCH_SIZE,
+        max_pending: int = NOTIFICATION_BUFFER_LIMIT,
+    ):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._pending: List[dict] = []
+        self._lock = threading.Lock()
+        # one flush at a time, stop() may flush while the thread is still at it
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._written = 0
+        self._dropped = 0
+        self._batches = 0
+
+    def notify(self, user_ids: Iterable[int], content: str):
+        """Queue one notification per user, returns right away."""
+        created_at = datetime.utcnow()
+        rows = [
+            {"user_id": user_id, "content": content, "created_at": created_at, "is_read": False}
+            for user_id in sorted(set(user_ids))
+        ]
+        if not rows:
+            return
+        with self._lock:
+            room = max(0, self.max_pending - len(self._pending))
+            if len(rows) > room:
+                self._dropped += len(rows) - room
+                rows = rows[:room]
+            self._pending.extend(rows)
+            full = len(self._pending) >= self.batch_size
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="notification-writer", daemon=True)
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+    def stop(self):
+        """Stop the thread and write what is still buffered."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """Write everything buffered so far, returns the number of rows written."""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            written = 0
+            for start in range(0, len(rows), self.batch_size):
+                written += self._write(rows[start:start + self.batch_size])
+            return written
+
+    def _write(self, batch: List[dict]) -> int:
+        def job(db: Session):
+            created = insert_notifications(db, batch)
+            if NOTIFICATION_EMAILS and created:
+                enqueue_notification_emails(db, created)
+            return created
+
+        db = SessionLocal()
+        try:
+            created = run_write(db, job)
+        except Exception:
+            logger.exception("Writing %s notifications failed", len(batch))
+            with self._lock:
+                self._dropped += len(batch)
+            return 0
+        finally:
+            db.close()
+
+        with self._lock:
+            self._written += len(created)
+            self._batches += 1
+        for row in created:
+            hub.publish([row["user_id"]], notification_event(row), event_id=row["notification_id"])
+        return len(created)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "written_total": self._written,
+                "dropped_total": self._dropped,
+                "batches_total": self._batches,
+            }
+
+
+notification_writer = NotificationWriter()
+
+
+def notify(user_ids: Iterable[int], content: str):
+    notification_writer.notify(user_ids, content)
@@ -0,0 +1,89 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from fastapi import HTTPException
+from sqlalchemy import tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from model.client_model import Listing, listings_fts
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# sort name -> (key columns, descending?, how to read the key back out of a row)
+LISTING_SORTS = {
+    "newest": ((Listing.created, Listing.listing_id), True, lambda l: (l.created.isoformat(), l.listing_id)),
+    "price_asc": ((Listing.price, Listing.listing_id), False, lambda l: (l.price, l.listing_id)),
+    "price_desc": ((Listing.price, Listing.listing_id), True, lambda l: (l.price, l.listing_id)),
+    # bm25 rank of a full-text match (lower is better), needs the query joined to listings_fts
+    "relevance": ((listings_fts.c.rank, Listing.listing_id), False, lambda row: (row.rank, row.Listing.listing_id)),
+}
+
+
+def encode_cursor(sort: str, key: tuple) -> str:
+    raw = json.dumps({"s": sort, "k": list(key)}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str) -> list:
+    """The [sort key, listing_id] position of a cursor, parsed and type checked. 400 for anything else."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        key = data["k"]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # a cursor only makes sense for the ordering it was issued for
+    if data.get("s") != sort or not isinstance(key, list) or len(key) != 2:
+        raise HTTPException(status_code=400, detail="Cursor does not match the requested sort")
+
+    first, last_id = key
+    # it comes from the client, a tampered key must not reach the query (bool is an int too)
+    if not _is_number(last_id) or isinstance(last_id, float):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if sort == "newest":
+        if not isinstance(first, str):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        try:
+            first = datetime.fromisoformat(first)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    elif not _is_number(first):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return [first, last_id]
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+async def paginate_listings(db: AsyncSession, statement, sort: str, cursor: str = None, limit: int = DEFAULT_PAGE_SIZE):
+    """Apply keyset pagination to a select(Listing) statement and run it.
+
+    Returns (listings, next_cursor). Seeks straight to the cursor position through the
+    (created, listing_id) / (price, listing_id) indexes, so every page costs the same.
+    For "relevance" the statement has to be joined to listings_fts with a MATCH already.
+    """
+    if sort not in LISTING_SORTS:
+        raise HTTPException(status_code=400, detail=f"Unknown sort '{sort}', expected one of {', '.join(LISTING_SORTS)}")
+    columns, descending, key_of = LISTING_SORTS[sort]
+
+    if cursor:
+        first, last_id = decode_cursor(cursor, sort)
+        position = tuple_(*columns)
+        statement = statement.where(position < (first, last_id) if descending else position > (first, last_id))
+
+    if sort == "relevance":
+        # the rank only exists inside this query, so it is carried along with each listing
+        statement = statement.add_columns(listings_fts.c.rank)
+
+    statement = statement.order_by(*[c.desc() if descending else c.asc() for c in columns])
+    # one extra row tells us whether there is a next page without a COUNT(*)
+    result = await db.execute(statement.limit(limit + 1))
+    rows = result.all() if sort == "relevance" else result.scalars().all()
+
+    next_cursor = encode_cursor(sort, key_of(rows[limit - 1])) if len(rows) > limit else None
+    listings = [row.Listing for row in rows[:limit]] if sort == "relevance" else rows[:limit]
+    return listings, next_cursor
@@ -0,0 +1,143 @@
+"""Password hashing on a small pool of its own.
+
+bcrypt is slow on purpose (~250ms per hash at the default cost). Run inline in
+endpoints, a burst of logins took every thread of the shared threadpool and
+everything else queued behind it. Hashes now run on HASH_WORKERS dedicated
+threads (bcrypt releases the GIL while it works) and the endpoints are async,
+awaiting the result: a request waiting for its hash holds no thread at all. At
+most HASH_QUEUE_SIZE more wait for a free worker, past that callers get a 503
+with Retry-After straight away instead of piling up.
+
+Cost is BCRYPT_ROUNDS. Hashes with any other cost are flagged by
+verify_and_update() and rehashed on the user's next login.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional, Tuple, TypeVar
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_QUEUE_SIZE = int(os.getenv("HASH_QUEUE_SIZE", "16"))
+HASH_RETRY_AFTER_SECONDS = int(os.getenv("HASH_RETRY_AFTER_SECONDS", "2"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+# min = max = default, so hashes made with an older cost (either way) need an update
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+T = TypeVar("T")
+
+LATENCY_WINDOW = 1024
+
+
+class HashingBusy(HTTPException):
+    def __init__(self):
+        super().__init__(
+            status_code=503,
+            detail="Too many sign-ins right now, try again shortly",
+            headers={"Retry-After": str(HASH_RETRY_AFTER_SECONDS)},
+        )
+
+
+class HashingPool:
+    def __init__(self, workers: int = HASH_WORKERS, queue_size: int = HASH_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        # running + waiting, the bound of the queue
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+        # seconds, the last LATENCY_WINDOW calls
+        self._wait_times = deque(maxlen=LATENCY_WINDOW)
+        self._hash_times = deque(maxlen=LATENCY_WINDOW)
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        """Run `fn(*args)` on the pool and await it, HashingBusy when the queue is full."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise HashingBusy()
+        with self._lock:
+            self._in_flight += 1
+        try:
+            future = self._executor.submit(self._timed, time.perf_counter(), fn, *args)
+        except BaseException:
+            self._release(None)
+            raise
+        # the slot is given back when the hash is done, not when the caller stops waiting (a disconnect)
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def _release(self, future: Optional[Future]):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _timed(self, submitted: float, fn, *args):
+        started = time.perf_counter()
+        with self._lock:
+            self._running += 1
+        try:
+            return fn(*args)
+        finally:
+            finished = time.perf_counter()
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+                self._wait_times.append(started - submitted)
+                self._hash_times.append(finished - started)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_capacity": self.queue_size,
+                "running": self._running,
+                "queue_depth": self._in_flight - self._running,
+                "completed_total": self._completed,
+                "rejected_total": self._rejected,
+                "wait_ms": _summary(self._wait_times),
+                "hash_ms": _summary(self._hash_times),
+            }
+
+
+def _summary(samples) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def ms(quantile):
+        return round(ordered[min(len(ordered) - 1, int(quantile * len(ordered)))] * 1000, 2)
+
+    return {"count": len(ordered), "p50": ms(0.5), "p95": ms(0.95), "max": ms(1)}
+
+
+hashing_pool = HashingPool()
+
+
+async def hash_password(password: str) -> str:
+    return await hashing_pool.run(pwd_context.hash, password)
+
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await hashing_pool.run(pwd_context.verify, password, hashed)
+
+
+async def verify_and_update(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    """(matches, new hash to store or None), the new hash when the stored one used another cost."""
+    return await hashing_pool.run(pwd_context.verify_and_update, password, hashed)
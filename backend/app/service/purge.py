@@ -0,0 +1,199 @@
+"""Deleting users, listings and groups with everything that hangs off them.
+
+Every dependent table is cleared with one set-based statement per table
+(children before parents), instead of loading rows and deleting them one ORM
+object at a time. The foreign keys say ON DELETE CASCADE as well, but that
+only fires where they are enforced (postgres). Sqlite runs without
+PRAGMA foreign_keys, messages.recipient_id holds group ids too, so the
+statements here are what actually does the work on both.
+
+Small accounts are deleted inside the request. An account with more than
+PURGE_INLINE_LIMIT messages or notifications would hold the write lock for
+seconds, so it is only marked (users.deleted_at, which signs it out
+everywhere) and a purge_user job (service/jobs.py) deletes it PURGE_BATCH_SIZE
+rows per transaction, each one its own run_write so other writers get in
+between. The user row goes last. Every batch is a plain delete of what is
+left, so a job that is retried or taken over just carries on.
+"""
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Callable, List
+
+from sqlalchemy import delete, func, or_, select, tuple_, update
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from model.client_model import (
+    Conversation, Group, GroupMember, Listing, ListingLanguage, ListingPreferredSex, ListingTenantMatch, Media,
+    Message, Notification, NotificationCounter, Rating, User, UserListingMatch,
+)
+from service.cache import bump_listings_version, bump_users_version
+from service.conversations import DIRECT, GROUP
+from service.jobs import enqueue, handler
+from service.match_index import schedule_listing_refresh, schedule_user_refresh
+from service.media import release
+from service.write_queue import run_write
+
+logger = logging.getLogger(__name__)
+
+PURGE_INLINE_LIMIT = int(os.getenv("PURGE_INLINE_LIMIT", "5000"))
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "1000"))
+PURGE_PAUSE_SECONDS = float(os.getenv("PURGE_PAUSE_SECONDS", "0.05"))
+
+# (db, limit or None for everything) -> rows affected, plus the deleted listing ids for the listing step
+Step = Callable[[Session, "int | None", List[int]], int]
+
+
+def _batch(table, condition, limit):
+    # no DELETE/UPDATE ... LIMIT on postgres (nor on a default sqlite build), a batch of keys instead
+    if limit is None:
+        return condition
+    key = list(table.primary_key.columns)
+    keys = select(*key).where(condition).limit(limit)
+    return (tuple_(*key) if len(key) > 1 else key[0]).in_(keys)
+
+
+def _delete(model, condition) -> Step:
+    def step(db: Session, limit, deleted_listings):
+        return db.execute(delete(model.__table__).where(_batch(model.__table__, condition, limit))).rowcount
+
+    return step
+
+
+def _update(model, condition, values) -> Step:
+    def step(db: Session, limit, deleted_listings):
+        return db.execute(update(model.__table__).where(_batch(model.__table__, condition, limit)).values(values)).rowcount
+
+    return step
+
+
+def _delete_listings(listing_ids) -> Step:
+    def step(db: Session, limit, deleted_listings):
+        query = select(Listing.listing_id, Listing.images).where(Listing.listing_id.in_(listing_ids))
+        rows = db.execute(query.limit(limit) if limit is not None else query).all()
+        if not rows:
+            return 0
+        ids = [listing_id for listing_id, _ in rows]
+        for _, images in rows:
+            release(db, images or [])
+        db.execute(delete(Listing.__table__).where(Listing.listing_id.in_(ids)))
+        deleted_listings.extend(ids)
+        return len(ids)
+
+    return step
+
+
+def group_steps(group_ids) -> List[Step]:
+    """Steps deleting the groups in `group_ids` (a select) with their members, messages and inbox rows."""
+    return [
+        _delete(Conversation, (Conversation.peer_type_id == GROUP) & Conversation.peer_id.in_(group_ids)),
+        _delete(Message, (Message.recipient_type_id == GROUP) & Message.recipient_id.in_(group_ids)),
+        _delete(GroupMember, GroupMember.group_id.in_(group_ids)),
+        _delete(Group, Group.group_id.in_(group_ids)),
+    ]
+
+
+def listing_steps(listing_ids) -> List[Step]:
+    """Steps deleting the listings in `listing_ids` (a select), their groups and side tables."""
+    return group_steps(select(Group.group_id).where(Group.listing_id.in_(listing_ids))) + [
+        _delete(Rating, Rating.listing_id.in_(listing_ids)),
+        _delete(UserListingMatch, UserListingMatch.listing_id.in_(listing_ids)),
+        _delete(ListingTenantMatch, ListingTenantMatch.listing_id.in_(listing_ids)),
+        _delete(ListingLanguage, ListingLanguage.listing_id.in_(listing_ids)),
+        _delete(ListingPreferredSex, ListingPreferredSex.listing_id.in_(listing_ids)),
+        _update(Media, Media.listing_id.in_(listing_ids), {"listing_id": None}),
+        _delete_listings(listing_ids),
+    ]
+
+
+def user_steps(user_id: int) -> List[Step]:
+    """Steps deleting the user, everything they own and everything addressed to them. The user row is last."""
+    return (
+        listing_steps(select(Listing.listing_id).where(Listing.owner_id == user_id))
+        + group_steps(select(Group.group_id).where(Group.owner_id == user_id))
+        + [
+            _delete(Conversation, or_(
+                Conversation.user_id == user_id,
+                (Conversation.peer_type_id == DIRECT) & (Conversation.peer_id == user_id),
+            )),
+            # other members' group inbox rows keep their preview, without the message behind it
+            _update(Conversation, Conversation.last_sender_id == user_id, {"last_message_id": None, "last_sender_id": None}),
+            _delete(Message, or_(
+                Message.sender_id == user_id,
+                (Message.recipient_type_id == DIRECT) & (Message.recipient_id == user_id),
+            )),
+            _delete(GroupMember, GroupMember.user_id == user_id),
+            _delete(Rating, Rating.user_id == user_id),
+            _delete(UserListingMatch, UserListingMatch.user_id == user_id),
+            _delete(ListingTenantMatch, ListingTenantMatch.user_id == user_id),
+            _delete(Notification, Notification.user_id == user_id),
+            _delete(NotificationCounter, NotificationCounter.user_id == user_id),
+            _update(Media, Media.user_id == user_id, {"user_id": None}),
+            _delete(User, User.user_id == user_id),
+        ]
+    )
+
+
+def run_steps(db: Session, steps: List[Step]) -> List[int]:
+    """Run every step in full on `db`, returns the deleted listing ids. Does not commit."""
+    deleted_listings = []
+    for step in steps:
+        step(db, None, deleted_listings)
+    return deleted_listings
+
+
+def needs_background_purge(db: Session, user_id: int) -> bool:
+    """Whether the account has more rows than a request should delete in one transaction."""
+    # counted with a LIMIT, a huge history costs no more than a small one to check
+    bounded = [
+        select(Message.message_id).where(Message.sender_id == user_id),
+        select(Message.message_id).where(Message.recipient_type_id == DIRECT, Message.recipient_id == user_id),
+        select(Notification.notification_id).where(Notification.user_id == user_id),
+    ]
+    total = 0
+    for statement in bounded:
+        total += db.scalar(select(func.count()).select_from(statement.limit(PURGE_INLINE_LIMIT + 1).subquery()))
+        if total > PURGE_INLINE_LIMIT:
+            return True
+    return False
+
+
+def mark_deleted(db: Session, user_id: int):
+    """Sign the account out for good and queue the purge of the rest. Does not commit."""
+    db.query(User).filter(User.user_id == user_id).update({User.deleted_at: datetime.utcnow()}, synchronize_session=False)
+    enqueue(db, "purge_user", {"user_id": user_id})
+
+
+def after_user_purge(user_id: int, deleted_listings: List[int]):
+    bump_listings_version()
+    bump_users_version()
+    schedule_user_refresh(user_id)
+    for listing_id in deleted_listings:
+        schedule_listing_refresh(listing_id)
+
+
+@handler("purge_user")
+def purge_user_job(payload: dict):
+    """Delete a marked account batch by batch, each batch committed on its own."""
+    user_id = payload["user_id"]
+    deleted_listings = []
+    removed = 0
+    for step in user_steps(user_id):
+        while True:
+            def job(db: Session):
+                return step(db, PURGE_BATCH_SIZE, deleted_listings)
+
+            db = SessionLocal()
+            try:
+                count = run_write(db, job)
+            finally:
+                db.close()
+            removed += count
+            if count < PURGE_BATCH_SIZE:
+                break
+            # let the other writers have the lock for a moment
+            time.sleep(PURGE_PAUSE_SECONDS)
+    after_user_purge(user_id, deleted_listings)
+    logger.info("Purged user %s, %s rows", user_id, removed)
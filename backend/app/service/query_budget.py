@@ -0,0 +1,93 @@
+"""Counting SQL statements per request, to keep N+1 queries from creeping back.
+
+Endpoints declare how many statements they may run:
+
+    @router.get("/groups", dependencies=[Depends(query_budget(2))])
+
+Every statement executed while the request is handled (its own session, the async
+one, the auth lookup) is counted. Going over the budget in production only logs a
+warning, the request is never failed for it.
+
+What keeps a regression out are the tests, tests/test_query_budget.py calls every
+budgeted endpoint over groups full of members and messages. count_queries() counts
+everything any thread runs while the block is open (TestClient handles the request
+on a thread of its own):
+
+    with count_queries() as counter:
+        client.get("/api/groups")
+    assert counter.count <= 2, counter.statements
+
+A new budgeted endpoint gets its line there.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter:
+    def __init__(self):
+        self.statements: List[str] = []
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+
+# a mutable counter in the context var: sync endpoints run on a copy of the
+# request's context in the threadpool, they still append to the same list
+_counter: ContextVar[Optional[QueryCounter]] = ContextVar("query_counter", default=None)
+_open_counters: List[QueryCounter] = []
+_lock = threading.Lock()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count(conn, cursor, statement, parameters, context, executemany):
+    counter = _counter.get()
+    if counter is not None:
+        counter.statements.append(statement)
+    if _open_counters:
+        with _lock:
+            for counter in _open_counters:
+                counter.statements.append(statement)
+
+
+@contextmanager
+def count_queries():
+    counter = QueryCounter()
+    with _lock:
+        _open_counters.append(counter)
+    try:
+        yield counter
+    finally:
+        with _lock:
+            _open_counters.remove(counter)
+
+
+@contextmanager
+def _count_request():
+    counter = QueryCounter()
+    token = _counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _counter.reset(token)
+
+
+def query_budget(limit: int):
+    """FastAPI dependency allowing at most `limit` SQL statements for the request."""
+
+    # async on purpose, a sync generator dependency would set the context var in a threadpool copy
+    async def check_budget():
+        with _count_request() as counter:
+            yield
+        if counter.count > limit:
+            logger.warning("Query budget exceeded: %s SQL statements, the budget is %s", counter.count, limit)
+
+    return check_budget
@@ -0,0 +1,107 @@
+"""In-process pub/sub hub behind the /api/ws websocket.
+
+Every open socket registers under its user id. Message endpoints publish after
+their commit and the hub pushes the event to every socket of every recipient,
+so clients don't have to poll the whole history any more. It lives in process
+memory like the caches, which matches the single uvicorn worker. The same hub
+feeds /api/notifications/stream (server-sent events), whose subscribers only
+take the event types they asked for.
+
+publish() can be called from any thread (the sync endpoints run in the
+threadpool), events are handed to the event loop with call_soon_threadsafe.
+Each socket has a bounded queue. A client that can't keep up gets its socket
+closed (1013, try again later) instead of the server buffering for it; it
+reconnects and refetches.
+"""
+import asyncio
+import json
+import os
+import threading
+from typing import Dict, Iterable, NamedTuple, Optional, Set
+
+from fastapi.encoders import jsonable_encoder
+
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+
+# put in place of the queued events when a client falls behind
+OVERFLOW = object()
+
+
+class Event(NamedTuple):
+    type: str
+    id: Optional[int]  # the sse id, only for events that can be replayed from a table
+    data: str  # the json payload, serialized once for every recipient
+
+
+def encode(event: dict, event_id: Optional[int] = None) -> Event:
+    # datetimes as iso strings like the http responses
+    return Event(event["type"], event_id, json.dumps(jsonable_encoder(event)))
+
+
+class Subscriber:
+    def __init__(self, user_id: int, types: Optional[Set[str]] = None, max_queued: int = WS_SEND_QUEUE_SIZE):
+        self.user_id = user_id
+        self.types = types  # None for every event type
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(max_queued)
+
+    def offer(self, payload: Event):
+        # runs on the event loop
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(OVERFLOW)
+
+
+class Hub:
+    def __init__(self):
+        self._subscribers: Dict[int, Set[Subscriber]] = {}
+        self._lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+
+    def subscribe(self, user_id: int, types: Optional[Set[str]] = None) -> Subscriber:
+        subscriber = Subscriber(user_id, types)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.user_id]
+
+    def publish(self, user_ids: Iterable[int], event: dict, event_id: Optional[int] = None):
+        """Send `event` to every open socket of `user_ids`, returns right away."""
+        # serialized once for all recipients
+        payload = encode(event, event_id)
+        with self._lock:
+            targets = [
+                s for user_id in set(user_ids) for s in self._subscribers.get(user_id, ())
+                if s.types is None or payload.type in s.types
+            ]
+            self.published += 1
+            self.delivered += len(targets)
+        for subscriber in targets:
+            try:
+                subscriber.loop.call_soon_threadsafe(subscriber.offer, payload)
+            except RuntimeError:
+                # loop closed, the socket is gone with it
+                self.unsubscribe(subscriber)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._subscribers),
+                "connections": sum(len(s) for s in self._subscribers.values()),
+                "published_total": self.published,
+                "delivered_total": self.delivered,
+            }
+
+
+hub = Hub()
@@ -0,0 +1,20 @@
+import re
+from typing import Optional
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def fts_query(text: str, column: Optional[str] = None) -> Optional[str]:
+    """Turn free user input into a safe FTS5 MATCH expression.
+
+    Every word becomes a quoted prefix term and all of them have to match, so
+    "krak stud" finds "Student Room in Kraków". Returns None when there is
+    nothing searchable in the input.
+    """
+    tokens = TOKEN_PATTERN.findall(text or "")
+    if not tokens:
+        return None
+    expression = " ".join(f'"{token}"*' for token in tokens)
+    if column:
+        expression = f"{column} : ({expression})"
+    return expression
@@ -0,0 +1,125 @@
+"""Static file serving for the built frontend and the uploads.
+
+Vite puts a content hash in every file name under static/assets, so those are cached
+by browsers for a year. compress_static.py writes .br / .gz siblings at build time,
+which are sent as they are to clients that accept them, nothing is compressed per request.
+index.html is read once and kept in memory.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from typing import Dict, Optional, Pattern, Tuple, Union
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# best first, suffix of the precompressed sibling
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def accepted_encodings(accept_encoding: Optional[str]) -> set:
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = params.strip().lower()
+        if name and not re.fullmatch(r"q=0(\.0*)?", quality):
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles that prefers a precompressed sibling and can mark files immutable.
+
+    `immutable` is True for every file or a pattern the path (relative to the
+    directory) has to match, for directories mixing hashed and plain names.
+    """
+
+    def __init__(self, *args, immutable: Union[bool, Pattern] = False, precompressed: bool = True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.immutable = immutable
+        self.precompressed = precompressed
+        # (full path, mtime) -> {encoding: (sibling path, stat)}, files under static only change with a deploy
+        self._siblings: Dict[Tuple[str, float], Dict[str, Tuple[str, os.stat_result]]] = {}
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> Response:
+        full_path = os.fspath(full_path)
+        request_headers = Headers(scope=scope)
+        headers = {}
+        if self._is_immutable(full_path):
+            headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+
+        path, stat, media_type = full_path, stat_result, None
+        siblings = self._find_siblings(full_path, stat_result) if self.precompressed else {}
+        if siblings:
+            headers["Vary"] = "Accept-Encoding"
+            accepted = accepted_encodings(request_headers.get("accept-encoding"))
+            for encoding, _ in ENCODINGS:
+                if encoding in accepted and encoding in siblings:
+                    path, stat = siblings[encoding]
+                    media_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+                    headers["Content-Encoding"] = encoding
+                    break
+
+        response = FileResponse(path, status_code=status_code, stat_result=stat, media_type=media_type, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+    def _is_immutable(self, full_path: str) -> bool:
+        if isinstance(self.immutable, bool):
+            return self.immutable
+        relative = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+        return bool(self.immutable.fullmatch(relative))
+
+    def _find_siblings(self, full_path: str, stat_result: os.stat_result):
+        key = (full_path, stat_result.st_mtime)
+        siblings = self._siblings.get(key)
+        if siblings is None:
+            siblings = {}
+            for encoding, suffix in ENCODINGS:
+                try:
+                    sibling_stat = os.stat(full_path + suffix)
+                except FileNotFoundError:
+                    continue
+                # an outdated sibling from an earlier build must not be served
+                if sibling_stat.st_mtime >= stat_result.st_mtime:
+                    siblings[encoding] = (full_path + suffix, sibling_stat)
+            self._siblings[key] = siblings
+        return siblings
+
+
+class InMemoryPage:
+    """A small file (index.html) held in memory with its gzip version and a strong ETag.
+
+    Re-read when its mtime changes, which costs one stat per request.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mtime = None
+        self._body = self._gzipped = b""
+        self._etag = ""
+
+    def response(self, request_headers: Headers) -> Response:
+        self._load()
+        headers = {"ETag": self._etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match and self._etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+        if "gzip" in accepted_encodings(request_headers.get("accept-encoding")):
+            return Response(self._gzipped, media_type="text/html", headers={**headers, "Content-Encoding": "gzip"})
+        return Response(self._body, media_type="text/html", headers=headers)
+
+    def _load(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime != self._mtime:
+            with open(self.path, "rb") as f:
+                body = f.read()
+            self._body, self._gzipped = body, gzip.compress(body, 9, mtime=0)
+            self._etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            self._mtime = mtime
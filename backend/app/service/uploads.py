@@ -0,0 +1,262 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import uuid
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from fastapi import HTTPException, Request, UploadFile
+from fastapi.routing import APIRoute
+from starlette.formparsers import MultiPartException, MultiPartParser
+
+UPLOADS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "uploads")
+TMP_DIR = os.path.join(UPLOADS_DIR, "tmp")
+
+CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_FILE_BYTES = int(os.getenv("MAX_UPLOAD_FILE_BYTES", str(10 * 1024 * 1024)))
+MAX_UPLOAD_REQUEST_BYTES = int(os.getenv("MAX_UPLOAD_REQUEST_BYTES", str(50 * 1024 * 1024)))
+
+# uploads/<ab>/<sha256>.ext and its variants, the bytes behind such a name never change
+CONTENT_ADDRESSED = re.compile(r"[0-9a-f]{2}/[0-9a-f]{64}(\.[A-Za-z0-9]+)*")
+
+# extension by leading bytes, so the same content gets the same name whatever it was uploaded as
+SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+]
+
+# held while a blob is put in place and while the media sweeper checks and unlinks one
+blob_lock = threading.Lock()
+
+
+class RequestTooLarge(HTTPException):
+    # an HTTPException so fastapi passes it through while parsing the form instead of turning it into a 400
+    def __init__(self, max_bytes: int):
+        super().__init__(status_code=413, detail=f"Request body is larger than {max_bytes} bytes")
+
+
+class UploadSizeLimitMiddleware:
+    """Refuses multipart bodies over MAX_UPLOAD_REQUEST_BYTES before they are parsed.
+
+    Checks Content-Length up front and counts the bytes as they arrive for chunked
+    bodies, so an oversized request is cut off instead of being spooled to disk first.
+    """
+
+    def __init__(self, app, max_bytes: int = MAX_UPLOAD_REQUEST_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _is_multipart(scope):
+            return await self.app(scope, receive, send)
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            return await _too_large(send, self.max_bytes)
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise RequestTooLarge(self.max_bytes)
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except RequestTooLarge:
+            if response_started:
+                raise
+            await _too_large(send, self.max_bytes)
+
+
+@dataclass
+class StoredUpload:
+    sha256: str
+    url: str
+    size: int
+
+
+class BlobWriter:
+    """An uploaded file on its way in: written to TMP_DIR/<uuid>.part and hashed as the bytes arrive.
+
+    Refuses to grow over MAX_UPLOAD_FILE_BYTES, store() moves it to its content addressed
+    name, closing it before that removes the partial file.
+    """
+
+    # tells UploadFile the writes hit the disk, so it makes them from the threadpool
+    _rolled = True
+
+    def __init__(self, filename: Optional[str]):
+        self.filename = filename
+        self.path = os.path.join(TMP_DIR, f"{uuid.uuid4().hex}.part")
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+        os.makedirs(TMP_DIR, exist_ok=True)
+        self._file = open(self.path, "w+b")
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.size > MAX_UPLOAD_FILE_BYTES:
+            raise HTTPException(status_code=413, detail=f"{self.filename} is larger than {MAX_UPLOAD_FILE_BYTES} bytes")
+        if len(self.head) < 16:
+            self.head += data[:16 - len(self.head)]
+        self.digest.update(data)
+        return self._file.write(data)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def store(self) -> StoredUpload:
+        sha256 = self.digest.hexdigest()
+        url = f"uploads/{sha256[:2]}/{sha256}{_extension(self.head, self.filename)}"
+        self._file.close()
+        os.makedirs(os.path.dirname(blob_path(url)), exist_ok=True)
+        # same name means same bytes, so replacing an existing blob is harmless. it also gives the
+        # file a fresh mtime, which keeps the sweeper's hands off it until our references are committed
+        with blob_lock:
+            os.replace(self.path, blob_path(url))
+        return StoredUpload(sha256=sha256, url=url, size=self.size)
+
+    def close(self):
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class UploadMultiPartParser(MultiPartParser):
+    """Starlette's parser, with every file part written into a BlobWriter instead of a spooled temp file."""
+
+    def on_headers_finished(self) -> None:
+        super().on_headers_finished()
+        upload = self._current_part.file
+        if upload is not None:
+            spooled = self._files_to_close_on_error.pop()
+            spooled.close()
+            upload.file = BlobWriter(upload.filename)
+            self._files_to_close_on_error.append(upload.file)
+
+    async def parse(self):
+        try:
+            return await super().parse()
+        except BaseException:
+            # a file over the limit or a broken body, nothing of it stays in TMP_DIR
+            for file in self._files_to_close_on_error:
+                file.close()
+            raise
+
+
+class UploadRequest(Request):
+    async def _get_form(self, *, max_files: int | float = 1000, max_fields: int | float = 1000):
+        if self._form is None and _is_multipart(self.scope):
+            try:
+                parser = UploadMultiPartParser(self.headers, self.stream(), max_files=max_files, max_fields=max_fields)
+                self._form = await parser.parse()
+            except MultiPartException as exc:
+                raise HTTPException(status_code=400, detail=exc.message)
+        return await super()._get_form(max_files=max_files, max_fields=max_fields)
+
+
+class UploadRoute(APIRoute):
+    """Route class for routers taking uploads: files go to disk once, hashed, while the body streams in."""
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request):
+            return await handler(UploadRequest(request.scope, request.receive))
+
+        return route_handler
+
+
+def save_uploads(files: Optional[List[UploadFile]]) -> List[StoredUpload]:
+    """Store uploaded files content-addressed under UPLOADS_DIR/<ab>/<sha256><ext>.
+
+    Blocking, call it from a threadpool (plain `def` endpoints already are). Files parsed
+    through an UploadRoute are already on disk and hashed, they are only moved in place.
+    Others are copied in CHUNK_SIZE pieces and hashed on the way, never held in memory
+    whole. Identical content ends up in one file, the caller records the references in
+    Media (service.media.add_references).
+    """
+    stored, total = [], 0
+    for upload in files or []:
+        blob = upload.file if isinstance(upload.file, BlobWriter) else _copy(upload)
+        total += blob.size
+        if total > MAX_UPLOAD_REQUEST_BYTES:
+            raise HTTPException(status_code=413, detail=f"Uploads are larger than {MAX_UPLOAD_REQUEST_BYTES} bytes in total")
+        stored.append(blob.store())
+    return stored
+
+
+def blob_path(url: str) -> str:
+    return os.path.join(UPLOADS_DIR, *url.split("/")[1:])
+
+
+def sha256_of(url: Optional[str]) -> Optional[str]:
+    """The content hash in a content addressed url, None for the older uploads/<filename> ones."""
+    path = (url or "").split("/", 1)[-1]
+    if not CONTENT_ADDRESSED.fullmatch(path):
+        return None
+    return path.split("/")[1].split(".", 1)[0]
+
+
+def _copy(upload: UploadFile) -> BlobWriter:
+    blob = BlobWriter(upload.filename)
+    try:
+        upload.file.seek(0)
+        while chunk := upload.file.read(CHUNK_SIZE):
+            blob.write(chunk)
+    except BaseException:
+        blob.close()
+        raise
+    return blob
+
+
+def _extension(head: bytes, filename: Optional[str]) -> str:
+    # only kept so the static files get a sensible content type
+    for signature, ext in SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    # not an image we know, the uploader's name is all there is (add_references keeps the first one)
+    ext = os.path.splitext(os.path.basename((filename or "").replace("\\", "/")))[1].lower()
+    return ext if 1 < len(ext) <= 6 and ext[1:].isalnum() else ""
+
+
+def _is_multipart(scope) -> bool:
+    content_type = dict(scope["headers"]).get(b"content-type", b"")
+    return content_type.startswith(b"multipart/form-data")
+
+
+async def _too_large(send, max_bytes: int):
+    body = json.dumps({"detail": f"Request body is larger than {max_bytes} bytes"}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": 413,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,129 @@
+"""Single writer with group commit for the sqlite production profile.
+
+SQLite allows one writer at a time. With many threadpool threads writing at once
+they queue up on the file lock, and a transaction that read first and then tries
+to write can't wait for it at all ("database is locked"). With SQLITE_PRODUCTION
+on, writes go through one thread instead. It takes whatever jobs are waiting
+(up to WRITE_QUEUE_MAX_BATCH), runs each one in its own SAVEPOINT and commits
+them all with a single COMMIT, so a burst of small writes costs one fsync.
+A job that fails only rolls back its own savepoint.
+
+Anywhere else (postgres, or the profile off) run_write() just runs the job on the
+request's session and commits it, so callers don't care which mode is on.
+"""
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, TypeVar
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from database import DATABASE_URL, engine, engine_options, sqlite_pragmas, use_sqlite_production_profile
+
+logger = logging.getLogger(__name__)
+
+WRITE_QUEUE_MAX_BATCH = int(os.getenv("WRITE_QUEUE_MAX_BATCH", "64"))
+
+T = TypeVar("T")
+
+
+def _writer_engine():
+    # one connection, owned by the writer thread. pysqlite's own transaction handling
+    # gets in the way of savepoints, so it is switched off and we BEGIN ourselves,
+    # IMMEDIATE so the write lock is taken up front instead of halfway through
+    writer = create_engine(DATABASE_URL, poolclass=StaticPool, connect_args=engine_options(DATABASE_URL)["connect_args"])
+
+    @event.listens_for(writer, "connect")
+    def _connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        sqlite_pragmas(dbapi_connection)
+
+    @event.listens_for(writer, "begin")
+    def _begin(connection):
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return writer
+
+
+class WriteQueue:
+    def __init__(self, max_batch: int = WRITE_QUEUE_MAX_BATCH):
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._sessions = None
+
+    def submit(self, job: Callable[[Session], T]) -> "Future[T]":
+        future = Future()
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                if self._sessions is None:
+                    # detached objects handed back to the request keep their loaded attributes
+                    self._sessions = sessionmaker(bind=_writer_engine(), autoflush=False, expire_on_commit=False)
+                self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+                self._thread.start()
+        self._queue.put((job, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch):
+        db = self._sessions()
+        done = []
+        try:
+            for job, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    with db.begin_nested():
+                        result = job(db)
+                    done.append((future, result))
+                except BaseException as exc:
+                    future.set_exception(exc)
+            db.commit()
+        except Exception as exc:
+            logger.exception("Group commit of %s writes failed", len(done))
+            db.rollback()
+            for future, _ in done:
+                future.set_exception(exc)
+            return
+        finally:
+            db.close()
+        for future, result in done:
+            future.set_result(result)
+
+
+write_queue = WriteQueue()
+
+
+def run_write(db: Session, job: Callable[[Session], T]) -> T:
+    """Run `job` in its own transaction and return its result once committed.
+
+    With the write queue on, `job` gets the writer's session and `db` is left alone.
+    Otherwise it simply runs on `db`, the request's own session, and commits it
+    (never a second session, a request holding two pooled connections can starve the pool).
+    Blocking, call it from plain `def` endpoints. The job must not commit itself, and
+    anything that should only happen after the commit (cache bumps, background
+    refreshes) belongs to the caller.
+    """
+    if use_sqlite_production_profile(engine):
+        return write_queue.submit(job).result()
+    try:
+        result = job(db)
+        db.commit()
+        return result
+    except BaseException:
+        db.rollback()
+        raise
@@ -0,0 +1,46 @@
+"""A throwaway sqlite database and working directory, set up before the app is imported.
+
+    pip install pytest httpx && python -m pytest backend/app/tests
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix="flatclub-tests-")
+
+sys.path.insert(0, APP_DIR)
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(WORK_DIR, 'test.db')}"
+# no background job workers picking up work (and running queries) while a test counts them
+os.environ["JOB_WORKERS"] = "0"
+# the cheapest cost passlib allows, the tests aren't about bcrypt
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+# main.py serves the built frontend from the working directory
+os.makedirs(os.path.join(WORK_DIR, "static", "assets"))
+with open(os.path.join(WORK_DIR, "static", "index.html"), "w") as file:
+    file.write("<!doctype html>")
+os.chdir(WORK_DIR)
+
+
+@pytest.fixture(scope="session")
+def client():
+    import create_db  # noqa: F401
+    from fastapi.testclient import TestClient
+    from main import app
+
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture(scope="session")
+def auth(client):
+    """Register and log in a user, the Authorization headers."""
+    response = client.post("/api/register", json={"username": "tester", "email": "tester@example.com", "password": "secret"})
+    assert response.status_code == 200, response.text
+    response = client.post("/api/login", json={"email": "tester@example.com", "password": "secret"})
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
@@ -0,0 +1,24 @@
+"""Language matching in the compatibility score: a shared language counts, and nothing else does."""
+from service.compatibility import LANGUAGE_WEIGHT, LANGUAGES, USER_SEX_KEY, encode_preferences, score
+
+
+def shares_language(candidates, languages):
+    person = encode_preferences([0], [{"language": languages}], USER_SEX_KEY)
+    return (score(candidates, person) >= LANGUAGE_WEIGHT - 1e-6).tolist()
+
+
+def test_every_known_language_has_a_bit_of_its_own():
+    assert len(LANGUAGES) <= 63
+    candidates = encode_preferences(range(len(LANGUAGES)), [{"language": [l]} for l in LANGUAGES], USER_SEX_KEY)
+    for index, language in enumerate(LANGUAGES):
+        assert shares_language(candidates, [language.title()]) == [i == index for i in range(len(LANGUAGES))]
+
+
+def test_other_languages_are_compared_by_name():
+    candidates = encode_preferences(range(4), [
+        {"language": ["Klingon"]}, {"language": ["Esperanto", "Polish"]}, {"language": ["English"]}, {},
+    ], USER_SEX_KEY)
+    assert shares_language(candidates, [" klingon "]) == [True, False, False, False]
+    assert shares_language(candidates, ["Sindarin"]) == [False, False, False, False]
+    assert shares_language(candidates, ["Sindarin", "english"]) == [False, False, True, False]
+    assert shares_language(candidates, ["esperanto"]) == [False, True, False, False]
@@ -0,0 +1,155 @@
+"""Incremental match index updates end up where a full rebuild does."""
+import random
+
+import pytest
+
+import service.compatibility as compatibility
+import service.match_index as match_index
+from database import SessionLocal
+from model.client_model import Listing, ListingStatus, ListingTenantMatch, User, UserListingMatch
+from service.cache import bump_listings_version, bump_users_version
+from service.match_index import rebuild, refresh_listing, refresh_user, updater
+
+# small lists, so they fill up and entries get pushed out
+TOP_N = 3
+STEPS = 120
+
+
+@pytest.fixture
+def small_index(client, monkeypatch):
+    updater.join()
+    monkeypatch.setattr(match_index, "TOP_N", TOP_N)
+    # the rebuild workers are spawned, they read it from the environment
+    monkeypatch.setenv("MATCH_INDEX_TOP_N", str(TOP_N))
+    # every refresh sees the rows the step before it wrote
+    monkeypatch.setattr(compatibility, "MATRIX_MAX_STALENESS_SECONDS", 0)
+    yield
+    rebuild(workers=1)
+
+
+def preferences(rng, sex_key):
+    def maybe(value):
+        return value if rng.random() < 0.7 else None
+
+    return {
+        "smoking": maybe(rng.random() < 0.5),
+        "pet_friendly": maybe(rng.random() < 0.5),
+        "party_friendly": maybe(rng.random() < 0.5),
+        "vegan": maybe(rng.random() < 0.5),
+        "language": rng.sample(["English", "Polish", "German", "Klingon", "Sindarin"], rng.randint(0, 2)),
+        sex_key: rng.sample(["male", "female", "non-binary"], rng.randint(0, 2)),
+        "quiet_hours": maybe({"start": rng.choice(["21:00", "22:30", "23:00", "01:00"]), "end": "07:00"}),
+    }
+
+
+def add_user(db, rng, number):
+    user = User(username=f"match{number}", email=f"match{number}@example.com", password="x", role="tenant",
+                preference=preferences(rng, "preferred_sex_to_live_with"))
+    db.add(user)
+    db.flush()
+    return "user", user.user_id
+
+
+def add_listing(db, rng, owner_id):
+    listing = Listing(owner_id=owner_id, title="Room", description="sunny", price=1000, isRental=True,
+                      location="Kraków", preferences=preferences(rng, "preferred_sex_of_the_flat"))
+    db.add(listing)
+    db.flush()
+    return "listing", listing.listing_id
+
+
+def random_step(db, rng, users, listings, number):
+    """Apply one random change, which object it touched."""
+    owners = {listing.owner_id for listing in db.query(Listing).filter(Listing.listing_id.in_(listings))}
+    choice = rng.choice(["user"] * 3 + ["listing"] * 3 + ["clear", "archive", "delete listing", "delete user"])
+    if len(users) < 2:
+        choice = "user"
+    elif len(listings) < 2 and choice not in ("user", "clear"):
+        choice = "listing"
+    if choice == "user":
+        if len(users) < 8 or rng.random() < 0.3:
+            kind, user_id = add_user(db, rng, number)
+            users.append(user_id)
+            return kind, user_id
+        user_id = rng.choice(users)
+        db.get(User, user_id).preference = preferences(rng, "preferred_sex_to_live_with")
+        return "user", user_id
+    if choice == "listing":
+        if len(listings) < 8 or rng.random() < 0.3:
+            kind, listing_id = add_listing(db, rng, rng.choice(users))
+            listings.append(listing_id)
+            return kind, listing_id
+        listing_id = rng.choice(listings)
+        db.get(Listing, listing_id).preferences = preferences(rng, "preferred_sex_of_the_flat")
+        return "listing", listing_id
+    if choice == "clear":
+        user_id = rng.choice(users)
+        db.get(User, user_id).preference = None
+        return "user", user_id
+    if choice == "archive":
+        listing = db.get(Listing, rng.choice(listings))
+        active = listing.status == ListingStatus.active
+        listing.status = ListingStatus.archived if active else ListingStatus.active
+        return "listing", listing.listing_id
+    if choice == "delete listing":
+        listing_id = listings.pop(rng.randrange(len(listings)))
+        db.delete(db.get(Listing, listing_id))
+        return "listing", listing_id
+    candidates = [user_id for user_id in users if user_id not in owners]
+    if not candidates:
+        return "user", rng.choice(users)
+    user_id = rng.choice(candidates)
+    users.remove(user_id)
+    db.delete(db.get(User, user_id))
+    return "user", user_id
+
+
+def match_lists(model, subject, candidate):
+    """subject id -> {candidate id: score} of one match table."""
+    db = SessionLocal()
+    try:
+        lists = {}
+        for row in db.query(model):
+            lists.setdefault(getattr(row, subject), {})[getattr(row, candidate)] = round(row.score, 6)
+        return lists
+    finally:
+        db.close()
+
+
+def assert_same_lists(incremental, rebuilt):
+    assert incremental.keys() == rebuilt.keys()
+    for subject, entries in rebuilt.items():
+        mine = incremental[subject]
+        # candidates tied on the lowest score may differ, the scores may not
+        assert sorted(mine.values()) == sorted(entries.values()), subject
+        lowest = min(entries.values())
+        above = {c: s for c, s in entries.items() if s > lowest}
+        assert {c: s for c, s in mine.items() if s > lowest} == above, subject
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_refreshes_match_a_rebuild(small_index, seed):
+    rng = random.Random(seed)
+    rebuild(workers=1)
+    users, listings = [], []
+    for number in range(STEPS):
+        db = SessionLocal()
+        try:
+            kind, object_id = random_step(db, rng, users, listings, f"{seed}-{number}")
+            db.commit()
+        finally:
+            db.close()
+        bump_users_version() if kind == "user" else bump_listings_version()
+
+        db = SessionLocal()
+        try:
+            (refresh_user if kind == "user" else refresh_listing)(db, object_id)
+            db.commit()
+        finally:
+            db.close()
+
+    tables = [(UserListingMatch, "user_id", "listing_id"), (ListingTenantMatch, "listing_id", "user_id")]
+    incremental = [match_lists(*table) for table in tables]
+    rebuild(workers=1)
+    for before, table in zip(incremental, tables):
+        assert_same_lists(before, match_lists(*table))
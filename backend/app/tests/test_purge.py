@@ -0,0 +1,232 @@
+"""Deleting an account leaves nothing behind that points at it, inline or purged in the background.
+
+Sqlite runs without foreign key enforcement, nothing cascades on its own.
+"""
+import hashlib
+import json
+from itertools import count
+
+import pytest
+from sqlalchemy import or_, select
+
+import service.purge as purge
+from database import SessionLocal
+from model.client_model import (
+    Conversation, Group, GroupMember, Listing, ListingLanguage, ListingPreferredSex, ListingTenantMatch, Media,
+    Message, Notification, NotificationCounter, Rating, User, UserListingMatch, listings_geo,
+)
+from service.cache import bump_users_version
+from service.conversations import DIRECT, GROUP
+from service.match_index import schedule_user_refresh, updater
+from service.notifications import notification_writer
+from service.purge import purge_user_job
+
+PREFERENCES = {"smoking": False, "pet_friendly": True, "language": ["English", "Klingon"]}
+accounts = count()
+
+
+def settle():
+    notification_writer.flush()
+    updater.join()
+
+
+def register(client, name):
+    client.post("/api/register", json={"username": name, "email": f"{name}@example.com", "password": "secret"})
+    token = client.post("/api/login", json={"email": f"{name}@example.com", "password": "secret"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.email == f"{name}@example.com").one()
+        user.preference = PREFERENCES
+        db.commit()
+        user_id = user.user_id
+    finally:
+        db.close()
+    bump_users_version()
+    schedule_user_refresh(user_id)
+    return headers, user_id
+
+
+def create_listing(client, headers):
+    response = client.post("/api/listings", headers=headers, data={
+        "title": "Room", "description": "sunny", "price": "1200", "location": "Kraków", "isRental": "true",
+        "latitude": "50.06", "longitude": "19.94",
+        "preferences": json.dumps({**PREFERENCES, "preferred_sex_of_the_flat": ["female"]}),
+    })
+    assert response.status_code == 201, response.text
+    return response.json()["data"]["listing_id"]
+
+
+def create_group(client, headers, listing_id):
+    response = client.post("/api/groups", headers=headers, json={"name": "Flat", "description": "mates", "listing_id": listing_id})
+    assert response.status_code == 200, response.text
+    return response.json()["group_id"]
+
+
+def image_url(name):
+    sha256 = hashlib.sha256(name.encode()).hexdigest()
+    return f"uploads/{sha256[:2]}/{sha256}.png"
+
+
+def set_images(listing_id, urls, uploader_id):
+    """Point the listing at the blobs behind urls, counting the references like an upload does."""
+    db = SessionLocal()
+    try:
+        db.get(Listing, listing_id).images = urls
+        for url in urls:
+            sha256 = url.rsplit("/", 1)[1].split(".")[0]
+            media = db.query(Media).filter(Media.sha256 == sha256).first()
+            if media is None:
+                db.add(Media(sha256=sha256, url=url, user_id=uploader_id, ref_count=1))
+            else:
+                media.ref_count += 1
+        db.commit()
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def accounts_to_delete(client):
+    """A user with listings, groups, memberships, messages, ratings, notifications and images, and a bystander."""
+    number = next(accounts)
+    victim, victim_id = register(client, f"victim{number}")
+    bystander, bystander_id = register(client, f"bystander{number}")
+
+    own_listing = create_listing(client, victim)
+    other_listing = create_listing(client, bystander)
+    own_image, shared_image = image_url(f"own{number}"), image_url(f"shared{number}")
+    set_images(own_listing, [own_image, shared_image], victim_id)
+    set_images(other_listing, [shared_image], bystander_id)
+
+    # a group on the victim's listing, one of theirs on someone else's, one they only joined
+    groups = [
+        create_group(client, bystander, own_listing),
+        create_group(client, victim, other_listing),
+        create_group(client, bystander, other_listing),
+    ]
+    for group_id in groups:
+        for headers in (victim, bystander):
+            client.post(f"/api/groups/{group_id}/join", headers=headers)
+            response = client.post(f"/api/groups/{group_id}/messages", headers=headers, json={"content": "hi all"})
+            assert response.status_code == 200, response.text
+    for sender, recipient_id in ((victim, bystander_id), (bystander, victim_id)):
+        response = client.post("/api/messages", headers=sender, json={"recipient_id": recipient_id, "content": "hello"})
+        assert response.status_code == 200, response.text
+    client.post(f"/api/groups/{groups[2]}/join-request", headers=victim)
+
+    db = SessionLocal()
+    try:
+        db.add_all([
+            Rating(rating_value=5, user_id=victim_id, listing_id=other_listing),
+            Rating(rating_value=4, user_id=bystander_id, listing_id=own_listing),
+        ])
+        db.commit()
+    finally:
+        db.close()
+    settle()
+
+    ids = {
+        "victim": victim, "victim_id": victim_id, "bystander_id": bystander_id, "own_listing": own_listing,
+        "other_listing": other_listing, "groups": groups, "own_image": own_image, "shared_image": shared_image,
+    }
+    # the fixture is only worth something if every table had rows to lose
+    assert all(leftovers(ids).values()), leftovers(ids)
+    return ids
+
+
+def leftovers(ids):
+    """Rows per table still tied to the deleted user, their listing or their groups."""
+    user_id, listing_id = ids["victim_id"], ids["own_listing"]
+    gone_groups = [ids["groups"][0], ids["groups"][1]]
+    queries = {
+        "users": select(User.user_id).where(User.user_id == user_id),
+        "listings": select(Listing.listing_id).where(Listing.owner_id == user_id),
+        "listings_geo": select(listings_geo.c.listing_id).where(listings_geo.c.listing_id == listing_id),
+        "listing_languages": select(ListingLanguage.listing_id).where(ListingLanguage.listing_id == listing_id),
+        "listing_preferred_sexes": select(ListingPreferredSex.listing_id).where(ListingPreferredSex.listing_id == listing_id),
+        "groups": select(Group.group_id).where(or_(Group.owner_id == user_id, Group.group_id.in_(gone_groups))),
+        "group_members": select(GroupMember.group_member).where(or_(
+            GroupMember.user_id == user_id, GroupMember.group_id.in_(gone_groups),
+        )),
+        "messages": select(Message.message_id).where(or_(
+            Message.sender_id == user_id,
+            (Message.recipient_type_id == DIRECT) & (Message.recipient_id == user_id),
+            (Message.recipient_type_id == GROUP) & Message.recipient_id.in_(gone_groups),
+        )),
+        "conversations": select(Conversation.user_id).where(or_(
+            Conversation.user_id == user_id,
+            Conversation.last_sender_id == user_id,
+            (Conversation.peer_type_id == DIRECT) & (Conversation.peer_id == user_id),
+            (Conversation.peer_type_id == GROUP) & Conversation.peer_id.in_(gone_groups),
+        )),
+        "ratings": select(Rating.rating_id).where(or_(Rating.user_id == user_id, Rating.listing_id == listing_id)),
+        "notifications": select(Notification.notification_id).where(Notification.user_id == user_id),
+        "notification_counters": select(NotificationCounter.user_id).where(NotificationCounter.user_id == user_id),
+        "user_listing_matches": select(UserListingMatch.user_id).where(or_(
+            UserListingMatch.user_id == user_id, UserListingMatch.listing_id == listing_id,
+        )),
+        "listing_tenant_matches": select(ListingTenantMatch.user_id).where(or_(
+            ListingTenantMatch.user_id == user_id, ListingTenantMatch.listing_id == listing_id,
+        )),
+        "media": select(Media.media_id).where(or_(Media.user_id == user_id, Media.listing_id == listing_id)),
+    }
+    db = SessionLocal()
+    try:
+        return {table: len(db.execute(query).all()) for table, query in queries.items()}
+    finally:
+        db.close()
+
+
+def assert_purged(ids):
+    settle()
+    assert not any(leftovers(ids).values()), leftovers(ids)
+    db = SessionLocal()
+    try:
+        references = dict(db.query(Media.url, Media.ref_count).filter(Media.url.in_([ids["own_image"], ids["shared_image"]])))
+        # the bystander's listing and group, with their own message in it, are still there
+        assert db.get(Listing, ids["other_listing"]) is not None
+        assert db.get(Group, ids["groups"][2]) is not None
+        assert db.query(Message).filter(Message.sender_id == ids["bystander_id"], Message.recipient_type_id == GROUP,
+                                        Message.recipient_id == ids["groups"][2]).count() == 1
+    finally:
+        db.close()
+    assert references == {ids["own_image"]: 0, ids["shared_image"]: 1}
+
+
+def test_inline_delete(client, accounts_to_delete):
+    ids = accounts_to_delete
+    response = client.delete(f"/api/users/{ids['victim_id']}", headers=ids["victim"])
+    assert response.status_code == 200, response.text
+    assert "being removed" not in response.json()["message"]
+    assert_purged(ids)
+
+
+def test_background_purge_resumes_after_a_failure(client, accounts_to_delete, monkeypatch):
+    ids = accounts_to_delete
+    monkeypatch.setattr(purge, "PURGE_INLINE_LIMIT", 0)
+    monkeypatch.setattr(purge, "PURGE_BATCH_SIZE", 1)
+    monkeypatch.setattr(purge, "PURGE_PAUSE_SECONDS", 0)
+    response = client.delete(f"/api/users/{ids['victim_id']}", headers=ids["victim"])
+    assert response.status_code == 200, response.text
+    assert "being removed" in response.json()["message"]
+    # signed out at once
+    assert client.get("/api/notifications", headers=ids["victim"]).status_code == 401
+
+    # the first attempt dies part way through
+    batches = count()
+    run_write = purge.run_write
+
+    def failing_run_write(db, job):
+        if next(batches) == 8:
+            raise RuntimeError("worker died")
+        return run_write(db, job)
+
+    monkeypatch.setattr(purge, "run_write", failing_run_write)
+    with pytest.raises(RuntimeError):
+        purge_user_job({"user_id": ids["victim_id"]})
+    left = leftovers(ids)
+    assert left["users"] == 1 and any(count for table, count in left.items() if table != "users"), left
+
+    monkeypatch.setattr(purge, "run_write", run_write)
+    purge_user_job({"user_id": ids["victim_id"]})
+    assert_purged(ids)
@@ -0,0 +1,99 @@
+"""The statement counts of the endpoints with a query_budget, over enough rows that an N+1 would show."""
+import pytest
+
+from database import SessionLocal
+from model.client_model import User
+from service.match_index import updater
+from service.notifications import notification_writer
+from service.query_budget import count_queries
+
+GROUPS = 3
+MEMBERS = 4
+MESSAGES = 5
+
+
+def settle():
+    """Wait for what requests left to background threads, so it doesn't run inside a count."""
+    notification_writer.flush()
+    updater.join()
+
+
+def register(client, name):
+    client.post("/api/register", json={"username": name, "email": f"{name}@example.com", "password": "secret"})
+    token = client.post("/api/login", json={"email": f"{name}@example.com", "password": "secret"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture(scope="module")
+def community(client, auth):
+    """Listings with several groups, each with members and messages, and direct messages to the tester."""
+    listing = client.post("/api/listings", headers=auth, data={
+        "title": "Room near campus", "description": "sunny", "price": "1500", "location": "Kraków", "isRental": "true",
+    })
+    assert listing.status_code == 201, listing.text
+    listing_id = listing.json()["data"]["listing_id"]
+
+    members = [register(client, f"member{i}") for i in range(MEMBERS)]
+    group_ids = []
+    for i in range(GROUPS):
+        group = client.post("/api/groups", headers=auth, json={"name": f"Group {i}", "description": "flatmates", "listing_id": listing_id})
+        assert group.status_code == 200, group.text
+        group_id = group.json()["group_id"]
+        group_ids.append(group_id)
+        for headers in members:
+            assert client.post(f"/api/groups/{group_id}/join", headers=headers).status_code == 200
+        for n in range(MESSAGES):
+            assert client.post(f"/api/groups/{group_id}/messages", headers=auth, json={"content": f"hello {n}"}).status_code == 200
+
+    db = SessionLocal()
+    try:
+        tester_id = db.query(User.user_id).filter(User.email == "tester@example.com").scalar()
+    finally:
+        db.close()
+    for headers in members:
+        for n in range(MESSAGES):
+            response = client.post("/api/messages", headers=headers, json={"recipient_id": tester_id, "content": f"hi {n}"})
+            assert response.status_code == 200, response.text
+    settle()
+    return {"listing_id": listing_id, "group_id": group_ids[0], "tester_id": tester_id}
+
+
+@pytest.mark.parametrize("path, budget", [
+    ("/api/groups", 2),
+    ("/api/groups/{group_id}", 1),
+    ("/api/listings/{listing_id}/groups", 1),
+    ("/api/groups/{group_id}/messages", 3),
+    ("/api/messages", 3),
+    ("/api/conversations", 2),
+    ("/api/notifications", 2),
+    ("/api/notifications/unread-count", 2),
+])
+def test_query_budget(client, auth, community, path, budget):
+    url = path.format(**community)
+    with count_queries() as counter:
+        response = client.get(url, headers=auth)
+    assert response.status_code == 200, response.text
+    assert counter.count <= budget, f"{url}: {counter.count} statements\n" + "\n".join(counter.statements)
+
+
+def test_counts_do_not_grow_with_rows(client, auth, community):
+    # one more group full of members and messages, the same number of statements for the lists
+    paths = ["/api/groups", "/api/listings/{listing_id}/groups".format(**community), "/api/messages"]
+    before = {}
+    for path in paths:
+        with count_queries() as counter:
+            client.get(path, headers=auth)
+        before[path] = counter.count
+
+    group = client.post("/api/groups", headers=auth, json={"name": "Another", "description": "flatmates", "listing_id": community["listing_id"]})
+    group_id = group.json()["group_id"]
+    for i in range(MEMBERS):
+        headers = register(client, f"late{i}")
+        client.post(f"/api/groups/{group_id}/join", headers=headers)
+        client.post("/api/messages", headers=headers, json={"recipient_id": community["tester_id"], "content": "late hello"})
+    settle()
+
+    for path in paths:
+        with count_queries() as counter:
+            client.get(path, headers=auth)
+        assert counter.count == before[path], "\n".join(counter.statements)
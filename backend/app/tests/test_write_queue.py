@@ -0,0 +1,85 @@
+"""Group commit: a failing job only loses its savepoint, a failing COMMIT fails the whole batch."""
+import threading
+from concurrent.futures import wait
+
+import pytest
+from sqlalchemy import Column, MetaData, String, Table, event, insert, select
+from sqlalchemy.orm import Session
+
+from database import engine
+from service.write_queue import WriteQueue
+
+rows = Table("write_queue_rows", MetaData(), Column("name", String, primary_key=True))
+
+
+@pytest.fixture
+def write_queue():
+    rows.create(engine, checkfirst=True)
+    yield WriteQueue()
+    rows.drop(engine)
+
+
+def stored():
+    with engine.connect() as connection:
+        return set(connection.scalars(select(rows.c.name)))
+
+
+def add(name, fail=False):
+    def job(db):
+        db.execute(insert(rows).values(name=name))
+        if fail:
+            raise ValueError(name)
+        return name
+    return job
+
+
+def one_batch(write_queue, jobs):
+    """Submit jobs while the writer is busy, so it takes them all in its next batch."""
+    started, release = threading.Event(), threading.Event()
+
+    def hold(db):
+        started.set()
+        release.wait(5)
+
+    first = write_queue.submit(hold)
+    assert started.wait(5)
+    futures = [write_queue.submit(job) for job in jobs]
+    release.set()
+    first.result(5)
+    return futures
+
+
+def test_failing_job_rolls_back_only_its_savepoint(write_queue):
+    futures = one_batch(write_queue, [add("a"), add("b", fail=True), add("c")])
+
+    assert futures[0].result(5) == "a"
+    with pytest.raises(ValueError):
+        futures[1].result(5)
+    assert futures[2].result(5) == "c"
+    assert stored() == {"a", "c"}
+
+
+def test_failed_commit_fails_every_job_in_the_batch(write_queue):
+    def failing_commit(session):
+        if session.info.get("fail_commit"):
+            raise RuntimeError("disk I/O error")
+
+    def fail_commit(db):
+        db.info["fail_commit"] = True
+
+    event.listen(Session, "before_commit", failing_commit)
+    try:
+        futures = one_batch(write_queue, [add("a"), add("b", fail=True), add("c"), fail_commit])
+        wait(futures, 5)
+    finally:
+        event.remove(Session, "before_commit", failing_commit)
+
+    with pytest.raises(ValueError):
+        futures[1].result(5)
+    for future in futures[:1] + futures[2:]:
+        with pytest.raises(RuntimeError):
+            future.result(5)
+    assert stored() == set()
+    # the writer carries on with the next batch
+    assert write_queue.submit(add("d")).result(5) == "d"
+    assert stored() == {"d"}
@@ -0,0 +1,28 @@
+import api from "./api";
+
+// the listing endpoints return one page at a time, the next one is behind the X-Next-Cursor header
+export interface ListingPage {
+  listings: any[];
+  nextCursor: string | null;
+}
+
+export const fetchListingPage = async (
+  url: string,
+  params: Record<string, any> = {},
+  cursor: string | null = null
+): Promise<ListingPage> => {
+  const res = await api.get(url, { params: cursor ? { ...params, cursor } : params });
+  return { listings: res.data, nextCursor: res.headers["x-next-cursor"] ?? null };
+};
+
+// every page, for the few places that need the whole (small) result, e.g. one owner's listings
+export const fetchAllListings = async (url: string, params: Record<string, any> = {}): Promise<any[]> => {
+  const listings: any[] = [];
+  let cursor: string | null = null;
+  do {
+    const page: ListingPage = await fetchListingPage(url, { ...params, limit: 100 }, cursor);
+    listings.push(...page.listings);
+    cursor = page.nextCursor;
+  } while (cursor);
+  return listings;
+};
@@ -1,10 +1,11 @@
 import React, { useState, useEffect } from "react";
 import {
-  Box, Container, Typography, TextField, Grid, Button, MenuItem, Paper
+  Box, Container, Typography, TextField, Grid, Button, Paper, Autocomplete
 } from "@mui/material";
 import Navbar from "../components/Navbar";
 import { useNavigate } from "react-router-dom";
 import api from "../api/api";
+import { fetchListingPage } from "../api/listings";
 
 const CreateGroup = () => {
   const [form, setForm] = useState({
@@ -20,16 +21,20 @@ const CreateGroup = () => {
     listing_id: "",
   });
   const [listings, setListings] = useState<any[]>([]);
+  const [selectedListing, setSelectedListing] = useState<any | null>(null);
+  const [listingQuery, setListingQuery] = useState("");
   const navigate = useNavigate();
 
+  // the picker searches as the user types, /listings only returns a page of the newest ones
   useEffect(() => {
-    fetchListings();
-  }, []);
+    const timer = setTimeout(() => fetchListings(listingQuery), 300);
+    return () => clearTimeout(timer);
+  }, [listingQuery]);
 
-  const fetchListings = async () => {
+  const fetchListings = async (query: string) => {
     try {
-      const res = await api.get("/listings");
-      setListings(res.data);
+      const page = await fetchListingPage("/listings/search", query.trim() ? { q: query.trim() } : {});
+      setListings(page.listings);
     } catch (error: any) {
       console.error("Failed to fetch listings", error);
     }
@@ -151,26 +156,32 @@ const CreateGroup = () => {
             </Grid>
 
             <Grid item xs={12}>
-              <TextField
-                label="Select Listing"
-                select
-                required
-                fullWidth
-                displayEmpty
-                value={form.listing_id}
-                onChange={(e) => handleChange("listing_id", e.target.value)}
-                error={Boolean(errors.listing_id)}
-                helperText={errors.listing_id}
-              >
-                <MenuItem value="" disabled>
-                  Select a listing
-                </MenuItem>
-                {listings.map((listing) => (
-                  <MenuItem key={listing.listing_id} value={listing.listing_id}>
-                    {listing.title} - {listing.location}
-                  </MenuItem>
-                ))}
-              </TextField>
+              <Autocomplete
+                options={listings}
+                // the server already filtered them
+                filterOptions={(options) => options}
+                getOptionLabel={(listing: any) => `${listing.title} - ${listing.location}`}
+                isOptionEqualToValue={(option: any, value: any) => option.listing_id === value.listing_id}
+                value={selectedListing}
+                onChange={(_event, listing: any) => {
+                  setSelectedListing(listing);
+                  handleChange("listing_id", listing ? listing.listing_id : "");
+                }}
+                onInputChange={(_event, value, reason) => {
+                  if (reason === "input") setListingQuery(value);
+                }}
+                renderInput={(params) => (
+                  <TextField
+                    {...params}
+                    label="Select Listing"
+                    placeholder="Search by title, description or location"
+                    required
+                    fullWidth
+                    error={Boolean(errors.listing_id)}
+                    helperText={errors.listing_id}
+                  />
+                )}
+              />
             </Grid>
 
             <Grid item xs={6}>
@@ -7,10 +7,12 @@ import ListingList from "../components/ListingList";
 import Footer from "../components/Footer";
 import Pagination from "@mui/material/Pagination";
 import api from "../api/api";
+import { fetchListingPage } from "../api/listings";
 
 const Listings = () => {
   const [listings, setListings] = useState<any[]>([]);
   const [groups, setGroups] = useState<any[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
   const [currentPage, setCurrentPage] = useState(1);
   const listingsPerPage = 6;
 
@@ -23,17 +25,34 @@ const Listings = () => {
 
   const fetchData = async () => {
     try {
-      const [listingsRes, groupsRes] = await Promise.all([
-        api.get(`/listings/search${locationObj.search}`),
+      const [page, groupsRes] = await Promise.all([
+        fetchListingPage(`/listings/search${locationObj.search}`),
         api.get("/groups"),
       ]);
-      setListings(listingsRes.data);
+      setListings(page.listings);
+      setNextCursor(page.nextCursor);
+      setCurrentPage(1);
       setGroups(groupsRes.data);
     } catch (error) {
       console.error("Failed to fetch listings or groups", error);
     }
   };
 
+  // the server sends pages of 20, the next one is fetched when the pagination runs past what we have
+  const handlePageChange = async (value: number) => {
+    if (value * listingsPerPage > listings.length && nextCursor) {
+      try {
+        const page = await fetchListingPage(`/listings/search${locationObj.search}`, {}, nextCursor);
+        setListings((prev) => [...prev, ...page.listings]);
+        setNextCursor(page.nextCursor);
+      } catch (error) {
+        console.error("Failed to fetch more listings", error);
+        return;
+      }
+    }
+    setCurrentPage(value);
+  };
+
   const groupCountsByListing = groups.reduce((acc: Record<number, number>, group: any) => {
     const listingId = group.listing_id;
     if (listingId) {
@@ -54,7 +73,7 @@ const Listings = () => {
   const mappedListings = currentListings.map(listing => ({
     id: listing.listing_id,
     image: listing.images && listing.images.length > 0
-      ? normalizeImagePath(listing.images[0])
+      ? normalizeImagePath(listing.image_variants?.[0]?.thumb ?? listing.images[0])
       : "/uploads/default-image.jpg",  
     title: listing.title,
     price: listing.price,
@@ -106,9 +125,9 @@ const Listings = () => {
 
         <Box display="flex" justifyContent="center" mt={3}>
           <Pagination
-            count={Math.ceil(listings.length / listingsPerPage)}
+            count={Math.ceil(listings.length / listingsPerPage) + (nextCursor ? 1 : 0)}
             page={currentPage}
-            onChange={(_event, value) => setCurrentPage(value)}
+            onChange={(_event, value) => handlePageChange(value)}
             color="primary"
           />
         </Box>
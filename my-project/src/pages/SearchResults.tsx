@@ -5,7 +5,7 @@ import { Box, Container, Button, Typography } from "@mui/material";
 import ListingList from "../components/ListingList";
 import Footer from "../components/Footer";
 import Pagination from "@mui/material/Pagination";
-import api from "../api/api";
+import { fetchListingPage } from "../api/listings";
 
 const SearchResults = () => {
   const location = useLocation();
@@ -13,6 +13,7 @@ const SearchResults = () => {
 const filters = Object.fromEntries(new URLSearchParams(location.search));
 
   const [listings, setListings] = useState<any[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
   const [currentPage, setCurrentPage] = useState(1);
   const listingsPerPage = 6;
 
@@ -26,9 +27,8 @@ const filters = Object.fromEntries(new URLSearchParams(location.search));
     fetchListings();
   }, [location.state]); // re-fetch if user makes new search
 
-const fetchListings = async () => {
-  try {
-    const cleanedFilters = Object.entries(filters).reduce((acc, [key, value]) => {
+const cleanedFilters = () =>
+  Object.entries(filters).reduce((acc, [key, value]) => {
       if (value !== undefined && value !== null && value !== "") {
         if (["true", "false"].includes(value)) {
           acc[key] = value === "true";
@@ -41,13 +41,32 @@ const fetchListings = async () => {
       return acc;
     }, {} as Record<string, any>);
 
-    const res = await api.get("/listings/search", { params: cleanedFilters });
-    setListings(res.data);
+const fetchListings = async () => {
+  try {
+    const page = await fetchListingPage("/listings/search", cleanedFilters());
+    setListings(page.listings);
+    setNextCursor(page.nextCursor);
+    setCurrentPage(1);
   } catch (error) {
     console.error("Failed to fetch listings", error);
   }
 };
 
+// the server sends pages of 20, the next one is fetched when the pagination runs past what we have
+const handlePageChange = async (value: number) => {
+  if (value * listingsPerPage > listings.length && nextCursor) {
+    try {
+      const page = await fetchListingPage("/listings/search", cleanedFilters(), nextCursor);
+      setListings((prev) => [...prev, ...page.listings]);
+      setNextCursor(page.nextCursor);
+    } catch (error) {
+      console.error("Failed to fetch more listings", error);
+      return;
+    }
+  }
+  setCurrentPage(value);
+};
+
   const indexOfLastListing = currentPage * listingsPerPage;
   const indexOfFirstListing = indexOfLastListing - listingsPerPage;
   const currentListings = listings.slice(indexOfFirstListing, indexOfLastListing);
@@ -55,7 +74,7 @@ const fetchListings = async () => {
   const mappedListings = currentListings.map(listing => ({
     id: listing.listing_id,
     image: listing.images && listing.images.length > 0
-      ? normalizeImagePath(listing.images[0])
+      ? normalizeImagePath(listing.image_variants?.[0]?.thumb ?? listing.images[0])
       : "/uploads/default-image.jpg",
     title: listing.title,
     price: listing.price,
@@ -102,9 +121,9 @@ const fetchListings = async () => {
             <ListingList listings={mappedListings} />
             <Box display="flex" justifyContent="center" mt={3}>
               <Pagination
-                count={Math.ceil(listings.length / listingsPerPage)}
+                count={Math.ceil(listings.length / listingsPerPage) + (nextCursor ? 1 : 0)}
                 page={currentPage}
-                onChange={(_event, value) => setCurrentPage(value)}
+                onChange={(_event, value) => handlePageChange(value)}
                 color="primary" 
               />
             </Box>
@@ -5,6 +5,7 @@ import {
 import { Link, useNavigate } from "react-router-dom";
 import Navbar from "../components/Navbar";
 import api from "../api/api";
+import { fetchAllListings } from "../api/listings";
 import Footer from "../components/Footer";
 import getCurrentUserId from "../utils/getCurrentUserId";
 
@@ -38,10 +39,10 @@ const UserProfileView = () => {
 
   const fetchListingsAndGroups = async (userId: number) => {
     try {
-      const listingsRes = await api.get("/listings/search");
-      setAllListings(listingsRes.data);
+      const ownListings = await fetchAllListings("/listings/search", { owner_id: userId });
+      setAllListings(ownListings);
 
-      const filteredListings = listingsRes.data.filter(
+      const filteredListings = ownListings.filter(
         (listing: any) => listing.owner_id === Number(userId)
       );
       setUserListings(filteredListings);
@@ -176,7 +177,7 @@ const UserProfileView = () => {
                         <CardMedia
                           component="img"
                           sx={{ width: 150 }}
-                          image={`/uploads/${listing.images[0].replace(/^uploads\//, "")}`}
+                          image={`/uploads/${(listing.image_variants?.[0]?.thumb ?? listing.images[0]).replace(/^uploads\//, "")}`}
                           alt={listing.title}
                         />
                       )}
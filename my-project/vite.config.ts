@@ -12,6 +12,7 @@ export default defineConfig({
       '/api': {
         target: 'http://backend:8000',
         changeOrigin: true,
+        ws: true,
       },
       '/uploads': {
         target: 'http://backend:8000',